@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# purpose: time backup and restore end to end on synthetic databases, against a local PostgreSQL and S3 stand-in
+
+import argparse
+import boto3
+import contextlib
+import importlib.util
+import json
+import logging
+import os
+import pathlib
+import psycopg2
+from psycopg2 import sql
+import shutil
+import subprocess
+import threading
+import time
+
+# statements that build each database shape, row counts scale with --scale
+SHAPES = {
+    'small-tables': lambda scale: [
+        statement for index in range(200) for statement in [
+            f'CREATE TABLE small_{index} (id int PRIMARY KEY, v text)',
+            f'INSERT INTO small_{index} SELECT g, md5(g::text) FROM generate_series(1, {int(1000 * scale)}) g',
+        ]],
+    'huge-tables': lambda scale: [
+        statement for index in range(2) for statement in [
+            f'CREATE TABLE huge_{index} (id bigint PRIMARY KEY, a int, b text, c timestamptz)',
+            f'INSERT INTO huge_{index} SELECT g, g % 1000, md5(g::text), now() - g * interval \'1 second\' '
+            f'FROM generate_series(1, {int(2000000 * scale)}) g',
+        ]],
+    'wide-rows': lambda scale: [
+        'CREATE TABLE wide (id int PRIMARY KEY, ' + ', '.join(
+            f'i{column} int, t{column} text, n{column} numeric' for column in range(20)) + ')',
+        'INSERT INTO wide SELECT g, ' + ', '.join(
+            f'g + {column}, md5((g + {column})::text), g * {column}.5' for column in range(20)) +
+        f' FROM generate_series(1, {int(200000 * scale)}) g',
+    ],
+    'many-indexes': lambda scale: [
+        'CREATE TABLE indexed (id int PRIMARY KEY, ' + ', '.join(f'c{column} int' for column in range(20)) + ')',
+        'INSERT INTO indexed SELECT g, ' + ', '.join(f'(g * {column + 7}) % 100003' for column in range(20)) +
+        f' FROM generate_series(1, {int(500000 * scale)}) g',
+    ] + [f'CREATE INDEX indexed_c{column} ON indexed (c{column})' for column in range(20)],
+    'toast-heavy': lambda scale: [
+        'CREATE TABLE toasted (id int PRIMARY KEY, doc text)',
+        # about 8KB of hex per row, stored out of line
+        'INSERT INTO toasted SELECT g, (SELECT string_agg(md5(g::text || s::text), \'\') FROM generate_series(1, 256) s) '
+        f'FROM generate_series(1, {int(20000 * scale)}) g',
+    ],
+}
+
+def load_aurora_operation():
+    # aurora-operation.py is a script rather than a module, so load it by path
+    script_path = pathlib.Path(__file__).resolve().parent.parent / 'ec2-scripts' / 'aurora-operation.py'
+    spec = importlib.util.spec_from_file_location('aurora_operation', script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def start_moto_server(port):
+    from moto.server import ThreadedMotoServer
+    # keep per-request access logs out of the results
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = ThreadedMotoServer(port=port)
+    server.start()
+    return server, f'http://localhost:{port}'
+
+def get_conn_string(args, database):
+    return f'user={args.username} password={args.password} host={args.host} port={args.port} dbname={database}'
+
+def run_sql(args, database, statements):
+    connection = psycopg2.connect(get_conn_string(args, database))
+    connection.autocommit = True
+    try:
+        cur = connection.cursor()
+        for statement in statements:
+            cur.execute(statement)
+    finally:
+        connection.close()
+
+def get_row_counts(conn_string):
+    connection = psycopg2.connect(conn_string)
+    try:
+        cur = connection.cursor()
+        cur.execute('SELECT schemaname, relname FROM pg_stat_user_tables ORDER BY 1, 2')
+        counts = {}
+        for schema, table in cur.fetchall():
+            cur.execute(sql.SQL('SELECT count(*) FROM {}.{}').format(sql.Identifier(schema), sql.Identifier(table)))
+            counts[f'{schema}.{table}'] = cur.fetchone()[0]
+        cur.execute('SELECT pg_database_size(current_database())')
+        return counts, cur.fetchone()[0]
+    finally:
+        connection.close()
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=pathlib.Path(__file__).resolve().parent,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class ResourceSampler:
+    """Peak resident memory of this process and its children, and peak size of a staging directory."""
+
+    def __init__(self, aurora_operation, path, interval):
+        self.aurora_operation = aurora_operation
+        self.path = path
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _get_rss(self):
+        # pg_dump -j, pg_restore -j and codecs are child processes, so the whole tree counts
+        rss = 0
+        for pid in self.aurora_operation.get_process_tree(os.getpid()):
+            try:
+                rss += int(pathlib.Path(f'/proc/{pid}/statm').read_text().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+            except (OSError, IndexError):
+                continue
+        return rss
+
+    def _sample(self):
+        self.peak_rss = max(self.peak_rss, self._get_rss())
+        self.peak_disk = max(self.peak_disk, self.aurora_operation.get_dir_size(self.path))
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self._sample()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        # a phase shorter than the interval is still sampled at its end
+        self._sample()
+
+@contextlib.contextmanager
+def measure_phase(aurora_operation, report, name, path, interval):
+    with ResourceSampler(aurora_operation, path, interval) as sampler:
+        with report.phase(name) as phase:
+            yield phase
+    phase['peak_rss'] = sampler.peak_rss
+    phase['peak_disk'] = sampler.peak_disk
+
+def run_shape(aurora_operation, args, endpoint_url, shape):
+    database = f'benchmark_{shape.replace("-", "_")}'
+    run_sql(args, 'postgres', [f'DROP DATABASE IF EXISTS {database}', f'CREATE DATABASE {database}'])
+    start = time.monotonic()
+    run_sql(args, database, SHAPES[shape](args.scale) + ['ANALYZE'])
+    print(f'Generated {shape} in {time.monotonic() - start:.1f}s')
+    conn_string = get_conn_string(args, database)
+    counts, database_size = get_row_counts(conn_string)
+
+    # the script's own parser, so every option has the value a real run would get
+    op_args = aurora_operation.get_parser().parse_args([
+        '-c', 'benchmark', '-d', database, '-o', 'backup', '-b', args.bucket, '-s', 'benchmark', '-e', args.host,
+        '-r', args.region, '--compression', args.compression, '--dump-jobs', str(args.jobs), '-j', str(args.jobs),
+        '--transfer-concurrency', str(args.concurrency), '--part-size', str(args.part_size),
+        '--restore-profile', args.restore_profile, '--maintenance', args.maintenance])
+    current_time = aurora_operation.get_time()
+    op_args.journal = None
+    op_args.catalog_rows = {table['name']: table['rows'] for table in aurora_operation.get_catalog_table_sizes(conn_string)}
+    report = op_args.report = aurora_operation.RunReport('benchmark', database, 'benchmark', current_time)
+    engine = aurora_operation.TransferEngine(args.region, max_concurrency=args.concurrency,
+        part_size=args.part_size * aurora_operation.MB, endpoint_url=endpoint_url)
+    report.engine = engine
+    env_path = os.getenv('PATH', '/usr/local/bin:/usr/bin')
+    staging_path = f'/tmp/{op_args.cluster}-{database}-{current_time}'
+    s3_prefix = f'manual/{op_args.cluster}/{database}/{current_time}'
+
+    try:
+        with measure_phase(aurora_operation, report, 'compression', staging_path, args.interval):
+            op_args.codec = aurora_operation.choose_compression(engine, conn_string, s3_prefix, env_path, op_args)
+        with measure_phase(aurora_operation, report, 'dump', staging_path, args.interval) as phase:
+            phase['rows'] = sum(counts.values())
+            aurora_operation.perform_db_backup(args.username, args.password, args.port, env_path, current_time, op_args)
+            phase['bytes'] = aurora_operation.get_dir_size(staging_path)
+        with measure_phase(aurora_operation, report, 'upload', staging_path, args.interval):
+            aurora_operation.copy_to_s3(engine, 'manual', current_time, op_args)
+
+        # restore into a fresh database of the same name, as a restore to another cluster would
+        run_sql(args, 'postgres', [f'DROP DATABASE IF EXISTS {database}'])
+        op_args.operation = 'restore'
+        op_args.timestamp = current_time
+        op_args.existing_db = False
+        with measure_phase(aurora_operation, report, 'download', staging_path, args.interval):
+            aurora_operation.copy_from_s3(engine, 'manual', op_args)
+        with measure_phase(aurora_operation, report, 'restore', staging_path, args.interval) as phase:
+            phase['bytes'] = aurora_operation.get_dir_size(staging_path)
+            phase['rows'] = sum(counts.values())
+            aurora_operation.perform_db_restore('manual', args.username, args.password, args.port, env_path, op_args)
+        with measure_phase(aurora_operation, report, 'maintenance', staging_path, args.interval) as phase:
+            results = aurora_operation.vacuum_analyze_tables(args.username, args.password, args.port, env_path, op_args)
+            phase['bytes'] = sum(result['bytes'] for result in results)
+    finally:
+        engine.shutdown()
+        shutil.rmtree(staging_path, ignore_errors=True)
+        report.finish()
+
+    restored_counts, _ = get_row_counts(conn_string)
+    if not args.keep:
+        run_sql(args, 'postgres', [f'DROP DATABASE IF EXISTS {database}'])
+    return {'shape': shape, 'database_size': database_size, 'tables': len(counts), 'rows': sum(counts.values()),
+            'status': report.report['status'], 'verified': restored_counts == counts,
+            'seconds': report.report['seconds'], 'phases': report.report['phases']}
+
+if __name__ == '__main__':
+
+    # python benchmark/e2e-benchmark.py --password postgres --scale 0.1
+    # python benchmark/e2e-benchmark.py --endpoint-url http://localhost:9000 --shapes huge-tables toast-heavy --jobs 8
+    # input parsing
+    parser = argparse.ArgumentParser(description='end to end backup and restore benchmark program')
+    parser.add_argument('--host', help='postgres host the benchmark databases are created on', default='localhost')
+    parser.add_argument('--port', help='postgres port', type=int, default=5432)
+    parser.add_argument('--username', help='postgres user', default='postgres')
+    parser.add_argument('--password', help='postgres password', default='')
+    parser.add_argument('--endpoint-url', help='s3 stand-in url e.g. MinIO, a moto server is started if unset', required=False)
+    parser.add_argument('--s3-port', help='port for the moto server', type=int, default=5000)
+    parser.add_argument('-b', '--bucket', help='benchmark bucket', default='aurora-backup-benchmark')
+    parser.add_argument('-r', '--region', help='aws region', default='us-east-1')
+    parser.add_argument('--shapes', help='database shapes to run', nargs='+', choices=list(SHAPES), default=list(SHAPES))
+    parser.add_argument('--scale', help='multiplier for the row count of every shape', type=float, default=1)
+    parser.add_argument('-j', '--jobs', help='parallel pg_dump and pg_restore jobs', type=int, default=4)
+    parser.add_argument('--concurrency', help='total concurrent s3 requests', type=int, default=16)
+    parser.add_argument('--part-size', help='minimum s3 multipart part size in MB', type=int, default=8)
+    parser.add_argument('--compression', help='none, gzip, zstd or lz4 with an optional :level, or auto', default='gzip:1')
+    parser.add_argument('--restore-profile', help='restore profile', default='default', choices=['default', 'fast-load'])
+    parser.add_argument('--maintenance', help='post-restore table maintenance', default='analyze',
+                        choices=['none', 'analyze', 'vacuum-analyze', 'full'])
+    parser.add_argument('--interval', help='seconds between memory and disk samples', type=float, default=0.2)
+    parser.add_argument('--keep', help='keep the restored databases', action='store_true')
+    parser.add_argument('-o', '--output', help='json results file', default='tmp/e2e-benchmark.json')
+    args = parser.parse_args()
+
+    server = None
+    endpoint_url = args.endpoint_url
+    if endpoint_url is None:
+        server, endpoint_url = start_moto_server(args.s3_port)
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+    s3_client = boto3.client('s3', region_name=args.region, endpoint_url=endpoint_url)
+    try:
+        s3_client.create_bucket(Bucket=args.bucket)
+    except s3_client.exceptions.BucketAlreadyOwnedByYou:
+        pass
+
+    aurora_operation = load_aurora_operation()
+    results = [run_shape(aurora_operation, args, endpoint_url, shape) for shape in args.shapes]
+    for result in results:
+        print(json.dumps({'shape': result['shape'], 'status': result['status'], 'verified': result['verified'],
+            'seconds': round(result['seconds'], 1), **{name: round(phase['mb_per_s'], 1)
+            for name, phase in result['phases'].items()}}))
+
+    settings = {name: getattr(args, name) for name in
+        ['scale', 'jobs', 'concurrency', 'part_size', 'compression', 'restore_profile', 'maintenance']}
+    with open(args.output, 'w') as json_file:
+        json.dump({'commit': get_commit(), 'settings': settings, 'host': aurora_operation.get_host_resources(),
+                   'results': results}, json_file, indent=2)
+
+    if server is not None:
+        server.stop()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# purpose: time perform_db_restore with each restore profile against a local or test PostgreSQL
+
+import argparse
+import importlib.util
+import json
+import os
+import pathlib
+import psycopg2
+import shutil
+import subprocess
+import time
+
+def load_aurora_operation():
+    # aurora-operation.py is a script rather than a module, so load it by path
+    script_path = pathlib.Path(__file__).resolve().parent.parent / 'ec2-scripts' / 'aurora-operation.py'
+    spec = importlib.util.spec_from_file_location('aurora_operation', script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def get_conn_string(args, database):
+    return f'user={args.username} password={args.password} host={args.host} port={args.port} dbname={database}'
+
+def run_sql(args, database, statements):
+    connection = psycopg2.connect(get_conn_string(args, database))
+    connection.autocommit = True
+    try:
+        cur = connection.cursor()
+        for statement in statements:
+            cur.execute(statement)
+    finally:
+        connection.close()
+
+def create_database(args):
+    # a few tables of different sizes, each with a primary key, a secondary index and a foreign key
+    run_sql(args, 'postgres', [f'DROP DATABASE IF EXISTS {args.database}', f'CREATE DATABASE {args.database}'])
+    statements = []
+    for index in range(args.tables):
+        rows = args.rows // 2 ** index
+        statements += [
+            f'CREATE TABLE parent_{index} (id int PRIMARY KEY, v text)',
+            f'CREATE TABLE child_{index} (id bigint PRIMARY KEY, parent_id int REFERENCES parent_{index}(id), v text)',
+            f'CREATE INDEX child_{index}_v ON child_{index}(v)',
+            f'INSERT INTO parent_{index} SELECT g, md5(g::text) FROM generate_series(1, {max(rows // 10, 1)}) g',
+            f'INSERT INTO child_{index} SELECT g, g % {max(rows // 10, 1)} + 1, md5(g::text) FROM generate_series(1, {rows}) g',
+        ]
+    run_sql(args, args.database, statements)
+
+def dump_database(args, dump_path):
+    shutil.rmtree(dump_path, ignore_errors=True)
+    subprocess.run(['pg_dump', '-Fd', '-j', str(args.jobs), '-Z', '1', '-f', dump_path, '-h', args.host,
+        '-p', str(args.port), '-U', args.username, args.database], check=True, env={**os.environ, 'PGPASSWORD': args.password})
+
+def run_profile(aurora_operation, args, dump_path, profile, existing):
+    op_args = argparse.Namespace(cluster='benchmark', database=args.database, endpoint=args.host, operation='restore',
+                jobs=args.jobs, timestamp=profile, restore_profile=profile, no_comments=False,
+                maintenance_work_mem=args.maintenance_work_mem, parallel_maintenance_workers=args.parallel_maintenance_workers,
+                report=aurora_operation.RunReport('benchmark', args.database, 'benchmark', profile))
+    env_path = os.getenv('PATH', '/usr/local/bin:/usr/bin')
+    if existing:
+        # a refresh, prepared as run_operation does: the database stays and its public tables are dropped
+        op_args.existing_db = aurora_operation.check_existing_db(args.username, args.password, args.port, env_path, op_args)
+        aurora_operation.drop_tables(args.username, args.password, args.port, env_path, op_args)
+    else:
+        run_sql(args, 'postgres', [f'DROP DATABASE IF EXISTS {args.database}'])
+        op_args.existing_db = False
+    restore_path = f'/tmp/{op_args.cluster}-{op_args.database}-{profile}'
+    # copytree(dirs_exist_ok=True) needs 3.8
+    shutil.rmtree(restore_path, ignore_errors=True)
+    shutil.copytree(dump_path, restore_path)
+    start = time.monotonic()
+    aurora_operation.perform_db_restore('manual', args.username, args.password, args.port, env_path, op_args)
+    seconds = time.monotonic() - start
+    shutil.rmtree(restore_path, ignore_errors=True)
+    return {'profile': profile, 'target': 'existing' if existing else 'new', 'seconds': seconds,
+            'status': op_args.report.report['status']}
+
+if __name__ == '__main__':
+
+    # python benchmark/restore-benchmark.py --host localhost --username postgres --password postgres --rows 5000000
+    # input parsing
+    parser = argparse.ArgumentParser(description='restore profile benchmark program')
+    parser.add_argument('--host', help='postgres host the benchmark database is created on', default='localhost')
+    parser.add_argument('--port', help='postgres port', type=int, default=5432)
+    parser.add_argument('--username', help='postgres user', default='postgres')
+    parser.add_argument('--password', help='postgres password', default='')
+    parser.add_argument('-d', '--database', help='benchmark database, dropped and recreated', default='restore_benchmark')
+    parser.add_argument('--tables', help='table pairs, each half the rows of the previous one', type=int, default=4)
+    parser.add_argument('--rows', help='rows of the largest child table', type=int, default=1000000)
+    parser.add_argument('-j', '--jobs', help='parallel pg_dump and pg_restore jobs', type=int, default=4)
+    parser.add_argument('--maintenance-work-mem', help='MB of maintenance_work_mem for fast-load', type=int, default=1024)
+    parser.add_argument('--parallel-maintenance-workers', help='max_parallel_maintenance_workers for fast-load',
+                        type=int, default=2)
+    parser.add_argument('-o', '--output', help='json results file', default='tmp/restore-benchmark.json')
+    args = parser.parse_args()
+
+    aurora_operation = load_aurora_operation()
+    dump_path = f'/tmp/{args.database}-dump'
+    create_database(args)
+    dump_database(args, dump_path)
+    # each profile restores into a new database, then over the one it left, as a refresh would
+    results = [run_profile(aurora_operation, args, dump_path, profile, existing)
+        for profile in ['default', 'fast-load'] for existing in [False, True]]
+    for result in results:
+        print(json.dumps(result))
+    shutil.rmtree(dump_path, ignore_errors=True)
+
+    with open(args.output, 'w') as json_file:
+        json.dump({'tables': args.tables, 'rows': args.rows, 'jobs': args.jobs, 'results': results}, json_file)
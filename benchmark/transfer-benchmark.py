@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# purpose: measure aggregate S3 throughput of copy_to_s3/copy_from_s3 against a local S3 stand-in
+
+import argparse
+import boto3
+from boto3.s3.transfer import TransferConfig
+import importlib.util
+import json
+import logging
+import os
+import pathlib
+import shutil
+import time
+
+def load_aurora_operation():
+    # aurora-operation.py is a script rather than a module, so load it by path
+    script_path = pathlib.Path(__file__).resolve().parent.parent / 'ec2-scripts' / 'aurora-operation.py'
+    spec = importlib.util.spec_from_file_location('aurora_operation', script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def start_moto_server(port):
+    from moto.server import ThreadedMotoServer
+    # keep per-request access logs out of the results
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = ThreadedMotoServer(port=port)
+    server.start()
+    return server, f'http://localhost:{port}'
+
+def generate_files(path, count, size):
+    pathlib.Path(path).mkdir(parents=True, exist_ok=True)
+    block = os.urandom(min(size, 1024 * 1024 * 4))
+    for index in range(count):
+        with open(f'{path}/{index:04d}.dat.gz', 'wb') as f:
+            remaining = size
+            while remaining > 0:
+                f.write(block[:remaining])
+                remaining -= len(block)
+    with open(f'{path}/toc.dat', 'wb') as f:
+        f.write(get_empty_toc())
+
+def get_empty_toc():
+    # a directory format toc.dat header with no entries, enough for the manifest's toc index
+    def write_int(value):
+        return bytes([0]) + value.to_bytes(4, 'little')
+    def write_str(value):
+        return write_int(len(value)) + value.encode()
+    return b'PGDMP' + bytes([1, 15, 0, 4, 8, 3, 0]) + b''.join(write_int(0) for _ in range(7)) + \
+        write_str('benchmark') + write_str('16.0') + write_str('16.0') + write_int(0)
+
+def run_legacy(args, endpoint_url, input_path, s3_prefix):
+    # the previous behaviour: one file at a time with 25KB parts
+    s3_resource = boto3.resource('s3', region_name=args.region, endpoint_url=endpoint_url)
+    config = TransferConfig(multipart_threshold=1024 * 25, max_concurrency=8,
+                multipart_chunksize=1024 * 25, use_threads=True)
+    for filepath in pathlib.Path(input_path).glob('*'):
+        s3_resource.Object(args.bucket, f'{s3_prefix}/{filepath.name}').upload_file(str(filepath), Config=config)
+    shutil.rmtree(input_path)
+
+def run_layout(aurora_operation, args, endpoint_url, layout, count, size):
+    timestamp = f'{layout}-{int(time.time())}'
+    op_args = argparse.Namespace(cluster='benchmark', database=layout, bucket=args.bucket,
+                region=args.region, timestamp=timestamp, incremental=False, catalog_rows={}, verify_sample=100,
+                journal=None,
+                codec={'codec': 'gzip', 'level': 1, 'method': 'native'},
+                report=aurora_operation.RunReport('benchmark', layout, 'benchmark', timestamp))
+    input_path = f'/tmp/{op_args.cluster}-{op_args.database}-{timestamp}'
+    s3_prefix = f'manual/{op_args.cluster}/{op_args.database}/{timestamp}'
+    total_bytes = count * size
+    results = {'layout': layout, 'files': count, 'file_size': size, 'bytes': total_bytes}
+
+    generate_files(input_path, count, size)
+    if args.legacy:
+        start = time.monotonic()
+        run_legacy(args, endpoint_url, input_path, s3_prefix)
+        results['legacy_upload_mb_per_s'] = total_bytes / aurora_operation.MB / (time.monotonic() - start)
+
+    generate_files(input_path, count, size)
+    engine = aurora_operation.TransferEngine(args.region, max_concurrency=args.concurrency,
+        max_bandwidth=args.max_bandwidth * aurora_operation.MB if args.max_bandwidth else None,
+        endpoint_url=endpoint_url)
+    start = time.monotonic()
+    aurora_operation.copy_to_s3(engine, 'manual', timestamp, op_args)
+    results['upload_mb_per_s'] = total_bytes / aurora_operation.MB / (time.monotonic() - start)
+
+    start = time.monotonic()
+    aurora_operation.copy_from_s3(engine, 'manual', op_args)
+    results['download_mb_per_s'] = total_bytes / aurora_operation.MB / (time.monotonic() - start)
+
+    # ranged reads against the manifest checksums, as verify runs after a nightly backup
+    start = time.monotonic()
+    manifest = aurora_operation.get_remote_manifest(engine, s3_prefix, op_args)
+    aurora_operation.verify_backup_blocks(engine,
+        aurora_operation.check_backup_objects(engine, s3_prefix, manifest, op_args), op_args)
+    results['verify_mb_per_s'] = total_bytes / aurora_operation.MB / (time.monotonic() - start)
+    engine.shutdown()
+    shutil.rmtree(input_path)
+    return results
+
+if __name__ == '__main__':
+
+    # python benchmark/transfer-benchmark.py --legacy
+    # python benchmark/transfer-benchmark.py --endpoint-url http://localhost:9000 --concurrency 32
+    # input parsing
+    parser = argparse.ArgumentParser(description='s3 transfer benchmark program')
+    parser.add_argument('--endpoint-url', help='s3 stand-in url e.g. MinIO, a moto server is started if unset', required=False)
+    parser.add_argument('--port', help='port for the moto server', type=int, default=5000)
+    parser.add_argument('-b', '--bucket', help='benchmark bucket', default='aurora-backup-benchmark')
+    parser.add_argument('-r', '--region', help='aws region', default='us-east-1')
+    parser.add_argument('--concurrency', help='total concurrent s3 requests', type=int, default=16)
+    parser.add_argument('--max-bandwidth', help='s3 bandwidth limit in MB/s', type=float, required=False)
+    parser.add_argument('--small-files', help='file count for the many-small-files layout', type=int, default=2000)
+    parser.add_argument('--small-size', help='file size in KB for the many-small-files layout', type=int, default=64)
+    parser.add_argument('--huge-files', help='file count for the few-huge-files layout', type=int, default=2)
+    parser.add_argument('--huge-size', help='file size in MB for the few-huge-files layout', type=int, default=1024)
+    parser.add_argument('--legacy', help='also time the previous one-file-at-a-time uploads', action='store_true')
+    parser.add_argument('-o', '--output', help='json results file', default='tmp/transfer-benchmark.json')
+    args = parser.parse_args()
+
+    server = None
+    endpoint_url = args.endpoint_url
+    if endpoint_url is None:
+        server, endpoint_url = start_moto_server(args.port)
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+    s3_client = boto3.client('s3', region_name=args.region, endpoint_url=endpoint_url)
+    try:
+        s3_client.create_bucket(Bucket=args.bucket)
+    except s3_client.exceptions.BucketAlreadyOwnedByYou:
+        pass
+
+    aurora_operation = load_aurora_operation()
+    results = [
+        run_layout(aurora_operation, args, endpoint_url, 'small', args.small_files, args.small_size * 1024),
+        run_layout(aurora_operation, args, endpoint_url, 'huge', args.huge_files, args.huge_size * aurora_operation.MB),
+    ]
+    for result in results:
+        print(json.dumps(result))
+
+    with open(args.output, 'w') as json_file:
+        json.dump({'concurrency': args.concurrency, 'max_bandwidth': args.max_bandwidth, 'results': results}, json_file)
+
+    if server is not None:
+        server.stop()
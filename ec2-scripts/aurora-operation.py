@@ -1,16 +1,49 @@
 import argparse 
 import boto3
-from boto3.s3.transfer import TransferConfig
 import base64
+from botocore.config import Config
 from botocore.exceptions import ClientError
+import collections
+import concurrent.futures
+import contextlib
+import copy
 import datetime
+import fnmatch
+import functools
+import gzip
+import hashlib
+import io
 import json
+import math
 import os
 import pathlib
 import psycopg2
+from psycopg2 import sql
+import random
+import re
+import resource
+import shlex
 import shutil
+import sqlite3
 import subprocess
 import sys
+import threading
+import time
+
+MB = 1024 * 1024
+GB = 1024 * MB
+# S3 multipart limits, with a floor above the 5MB minimum to keep request counts down
+S3_MIN_PART_SIZE = 8 * MB
+S3_MAX_PART_SIZE = 5 * 1024 * MB
+S3_MAX_PARTS = 10000
+MULTIPART_THRESHOLD = 64 * MB
+S3_MAX_COPY_SIZE = 5 * 1024 * MB
+# marks content-addressed blobs, which only prune deletes once no manifest references them
+BLOB_TAGGING = 'content-addressed=true'
+# delete_objects takes at most this many keys per request
+S3_MAX_DELETE_KEYS = 1000
+# <database>/blobs/<sha256[:2]>/<sha256>, as upload_content_addressed names them
+BLOB_KEY_PATTERN = re.compile(r'/blobs/[0-9a-f]{2}/[0-9a-f]{64}$')
 
 def get_nested(data, *args):
     if args and data:
@@ -27,13 +60,14 @@ def get_time():
     current_time = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
     return current_time
 
-def get_secret(secret_name, region):
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region
-    )
+def get_secret(secret_name, region, client=None):
+    # Create a Secrets Manager client, unless a worker passes its own
+    if client is None:
+        session = boto3.session.Session()
+        client = session.client(
+            service_name='secretsmanager',
+            region_name=region
+        )
 
     try:
         get_secret_value_response = client.get_secret_value(
@@ -65,21 +99,293 @@ def get_secret(secret_name, region):
             decoded_binary_secret = base64.b64decode(get_secret_value_response['SecretBinary'])
             return decoded_binary_secret
 
-def perform_db_backup(instance_username, instance_password, instance_port, env_path, current_time, args):
-    print(f'Backing up {args.database} database from cluster {args.endpoint}')
+# file suffix and valid levels for each codec; zstd and lz4 are native in pg_dump 16+
+# ratio is a typical compressed-to-COPY-text size, for backups made before the measured ratio was recorded
+CODECS = {
+    'none': {'suffix': '', 'levels': (0, 0), 'default_level': 0, 'ratio': 1},
+    'gzip': {'suffix': '.gz', 'levels': (1, 9), 'default_level': 1, 'ratio': 0.3},
+    'zstd': {'suffix': '.zst', 'levels': (1, 19), 'default_level': 3, 'ratio': 0.25},
+    'lz4': {'suffix': '.lz4', 'levels': (1, 12), 'default_level': 1, 'ratio': 0.45},
+}
+NATIVE_CODEC_VERSION = 16
+# candidates measured by --compression auto
+AUTO_CODECS = ['none', 'gzip:1', 'gzip:6', 'zstd:1', 'zstd:3', 'zstd:9', 'lz4:1']
+SAMPLE_SIZE = 16 * MB
+
+CODEC_NONE = {'codec': 'none', 'level': 0, 'method': 'none'}
+# a file being compressed or decompressed, renamed into place only once it is complete
+PARTIAL_SUFFIX = '.partial'
+
+def parse_compression(value):
+    codec, _, level = value.partition(':')
+    if codec not in CODECS:
+        raise argparse.ArgumentTypeError(f'unknown compression codec {codec}')
+    level = int(level) if level else CODECS[codec]['default_level']
+    low, high = CODECS[codec]['levels']
+    if not low <= level <= high:
+        raise argparse.ArgumentTypeError(f'{codec} level must be between {low} and {high}')
+    return {'codec': codec, 'level': level}
+
+def get_pg_dump_version(env_path):
+    # e.g. pg_dump (PostgreSQL) 13.7
+    output = subprocess.run(f'PATH={env_path} pg_dump --version', shell=True, check=True,
+        stdout=subprocess.PIPE, text=True).stdout
+    return int(re.search(r'(\d+)', output.split(')')[-1]).group(1))
+
+def pg_dump_supports_codec(env_path, codec):
+    if get_pg_dump_version(env_path) < NATIVE_CODEC_VERSION:
+        return False
+    # the compression spec is validated before connecting, so an unreachable host is enough to ask
+    command1 = f'PATH={env_path} pg_dump --compress={codec["codec"]}:{codec["level"]} ' \
+               f'--host=/nonexistent --no-password --schema-only -f /dev/null postgres'
+    output = subprocess.run(command1, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    return 'does not support' not in output.stderr
+
+def get_compression_method(codec, env_path):
+    # pg_dump compresses natively where it can, otherwise files are compressed after dumping
+    if codec['codec'] == 'none':
+        return {**codec, 'method': 'none'}
+    if codec['codec'] == 'gzip' or pg_dump_supports_codec(env_path, codec):
+        return {**codec, 'method': 'native'}
+    if shutil.which(codec['codec']) is None:
+        raise Exception(f'{codec["codec"]} compression needs the {codec["codec"]} command or pg_dump {NATIVE_CODEC_VERSION}+ built with it')
+    return {**codec, 'method': 'stream'}
+
+def get_compression_dump_option(codec):
+    if codec['method'] == 'native' and codec['codec'] != 'gzip':
+        return f'--compress={codec["codec"]}:{codec["level"]}'
+    if codec['method'] == 'native':
+        return f'-Z {codec["level"]}'
+    return '-Z 0'
+
+def get_codec_command(codec, decompress=False):
+    if decompress:
+        return [codec['codec'], '-q', '-d', '-c']
+    return [codec['codec'], '-q', f'-{codec["level"]}', '-c']
+
+def run_codec_file(full_path, target_path, command):
+    # an interrupted run leaves only a .partial file, never a truncated one that looks finished
+    partial_path = target_path + PARTIAL_SUFFIX
+    with open(full_path, 'rb') as src, open(partial_path, 'wb') as dst:
+        subprocess.run(command, stdin=src, stdout=dst, check=True)
+    os.replace(partial_path, target_path)
+    os.remove(full_path)
+    return target_path
+
+def compress_file(full_path, codec):
+    # used for the stream method, where pg_dump wrote the file uncompressed
+    return run_codec_file(full_path, full_path + CODECS[codec['codec']]['suffix'], get_codec_command(codec))
+
+def decompress_file(full_path, codec):
+    suffix = CODECS[codec['codec']]['suffix']
+    if codec['method'] != 'stream' or not full_path.endswith(suffix):
+        return full_path
+    return run_codec_file(full_path, full_path[:-len(suffix)], get_codec_command(codec, decompress=True))
+
+@contextlib.contextmanager
+def open_compressed_writer(full_path, codec):
+    if codec['codec'] == 'none':
+        with open(full_path, 'wb') as f:
+            yield f
+    elif codec['codec'] == 'gzip':
+        with gzip.open(full_path, 'wb', compresslevel=codec['level']) as f:
+            yield f
+    else:
+        with open(full_path, 'wb') as dst:
+            proc = subprocess.Popen(get_codec_command(codec), stdin=subprocess.PIPE, stdout=dst)
+            try:
+                yield proc.stdin
+            finally:
+                proc.stdin.close()
+                if proc.wait() != 0:
+                    raise Exception(f'{codec["codec"]} compression of {full_path} exited with {proc.returncode}')
+
+@contextlib.contextmanager
+def open_compressed_reader(full_path, codec):
+    if codec['codec'] == 'none':
+        with open(full_path, 'rb') as f:
+            yield f
+    elif codec['codec'] == 'gzip':
+        with gzip.open(full_path, 'rb') as f:
+            yield f
+    else:
+        with open(full_path, 'rb') as src:
+            proc = subprocess.Popen(get_codec_command(codec, decompress=True), stdin=src, stdout=subprocess.PIPE)
+            try:
+                yield proc.stdout
+            finally:
+                proc.stdout.close()
+                proc.wait()
+
+def copy_stream(src, dst):
+    for chunk in iter(functools.partial(src.read, MB), b''):
+        dst.write(chunk)
+
+@contextlib.contextmanager
+def open_compressing_stream(target, codec):
+    # like open_compressed_writer, but into a file object such as an S3 upload stream
+    if codec['codec'] == 'none':
+        yield target
+    elif codec['codec'] == 'gzip':
+        with gzip.GzipFile(fileobj=target, mode='wb', compresslevel=codec['level'], mtime=0) as f:
+            yield f
+    else:
+        proc = subprocess.Popen(get_codec_command(codec), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        pump = threading.Thread(target=copy_stream, args=(proc.stdout, target))
+        pump.start()
+        try:
+            yield proc.stdin
+        finally:
+            proc.stdin.close()
+            pump.join()
+            if proc.wait() != 0:
+                raise Exception(f'{codec["codec"]} compression exited with {proc.returncode}')
+
+@contextlib.contextmanager
+def open_decompressing_stream(source, codec, check=False):
+    # check raises if the codec command failed; leave it off where the reader may stop early
+    if codec['codec'] == 'none':
+        yield source
+    elif codec['codec'] == 'gzip':
+        with gzip.GzipFile(fileobj=source, mode='rb') as f:
+            yield f
+    else:
+        proc = subprocess.Popen(get_codec_command(codec, decompress=True), stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+
+        def feed():
+            try:
+                copy_stream(source, proc.stdin)
+            except (BrokenPipeError, ValueError):
+                # the reader stopped early, e.g. after an archive header
+                pass
+            finally:
+                proc.stdin.close()
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        try:
+            yield proc.stdout
+        finally:
+            proc.stdout.close()
+            feeder.join()
+            if proc.wait() != 0 and check:
+                raise Exception(f'{codec["codec"]} decompression exited with {proc.returncode}')
+
+def get_backup_codec(manifest):
+    # backups made before codecs were recorded are native gzip
+    return manifest.get('compression', {'codec': 'gzip', 'level': 1, 'method': 'native'})
+
+def measure_codec(codec, sample):
+    start = time.monotonic()
+    if codec['codec'] == 'none':
+        compressed_size = len(sample)
+    elif codec['codec'] == 'gzip':
+        compressed_size = len(gzip.compress(sample, compresslevel=codec['level'], mtime=0))
+    else:
+        compressed_size = len(subprocess.run(get_codec_command(codec), input=sample,
+            stdout=subprocess.PIPE, check=True).stdout)
+    return compressed_size / len(sample), len(sample) / max(time.monotonic() - start, 1e-6)
+
+def get_table_samples(conn_string, count=4):
+    # a random block sample from each of the largest tables, capped at SAMPLE_SIZE
+    connection = psycopg2.connect(conn_string)
+    samples = []
+    try:
+        cur = connection.cursor()
+        cur.execute("""SELECT n.nspname, c.relname, pg_relation_size(c.oid)
+                       FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+                       WHERE c.relkind = 'r' AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+                       AND pg_relation_size(c.oid) > 0
+                       ORDER BY 3 DESC LIMIT %s""", (count,))
+        for schema, table, size in cur.fetchall():
+            percent = min(100.0, 100.0 * SAMPLE_SIZE / size)
+            buffer = io.BytesIO()
+            cur.copy_expert(sql.SQL('COPY (SELECT * FROM {}.{} TABLESAMPLE SYSTEM ({})) TO STDOUT').format(
+                sql.Identifier(schema), sql.Identifier(table), sql.Literal(percent)), buffer)
+            if buffer.tell() > 0:
+                samples.append((f'{schema}.{table}', size, buffer.getvalue()[:SAMPLE_SIZE]))
+    finally:
+        connection.close()
+    return samples
 
+def measure_upload_throughput(engine, s3_prefix, args):
+    # time a multipart probe object through the shared transfer pool, streamed from memory so nothing touches disk
+    probe_size = MULTIPART_THRESHOLD + S3_MIN_PART_SIZE * 4
+    block = os.urandom(S3_MIN_PART_SIZE)
+    start = time.monotonic()
+    with engine.open_upload_stream(args.bucket, f'{s3_prefix}/probe') as stream:
+        for offset in range(0, probe_size, len(block)):
+            stream.write(block[:probe_size - offset])
+    seconds = time.monotonic() - start
+    engine.client.delete_object(Bucket=args.bucket, Key=f'{s3_prefix}/probe')
+    return probe_size / seconds
+
+def choose_compression(engine, conn_string, s3_prefix, env_path, args):
+    if args.compression != 'auto':
+        return get_compression_method(args.compression, env_path)
+
+    samples = get_table_samples(conn_string)
+    if not samples:
+        return get_compression_method(parse_compression('gzip'), env_path)
+    network = measure_upload_throughput(engine, s3_prefix, args)
+    cpus = os.cpu_count() or 1
+    print(f'Measured upload throughput of {network / MB:.1f}MB/s with {cpus} cpus')
+
+    best = None
+    for value in AUTO_CODECS:
+        codec = parse_compression(value)
+        # codecs that can be neither native nor streamed are left out
+        if codec['codec'] in ('zstd', 'lz4') and shutil.which(codec['codec']) is None:
+            continue
+        # weight each sample by the size of the table it came from
+        total = sum(size for name, size, sample in samples)
+        ratio = speed = 0
+        for name, size, sample in samples:
+            sample_ratio, sample_speed = measure_codec(codec, sample)
+            ratio += sample_ratio * size / total
+            speed += sample_speed * size / total
+        # compression and upload overlap, so the slower of the two sets the pace
+        seconds_per_byte = max(1 / (speed * cpus), ratio / network)
+        print(f'Codec {value}: ratio {ratio:.3f}, {speed / MB:.1f}MB/s per cpu, '
+              f'{1 / seconds_per_byte / MB:.1f}MB/s of table data end to end')
+        if best is None or seconds_per_byte < best[0]:
+            best = (seconds_per_byte, codec, ratio)
+    print(f'Selected {best[1]["codec"]}:{best[1]["level"]} compression')
+    # the measured ratio goes into the manifest, restores size their disk by it
+    return {**get_compression_method(best[1], env_path), 'ratio': round(best[2], 3)}
+
+def get_dump_command(instance_username, instance_port, env_path, output_path, args, dump_options=''):
     command1 =  f'PATH={env_path} ' \
-                f'pg_dump -Fd '\
+                f'pg_dump -Fd {dump_options}'\
                 f'--host={args.endpoint} ' \
                 f'--username={instance_username} ' \
                 f'--no-password ' \
                 f'--port={instance_port} ' \
-                f'-Z 1 ' \
-                f'-j 8 ' \
-                f'-f /tmp/{args.cluster}-{args.database}-{current_time} ' \
+                f'{get_compression_dump_option(args.codec)} ' \
+                f'-j {args.dump_jobs} ' \
+                f'-f {output_path} ' \
                 f'{args.database}'
+    return command1
+
+def perform_db_backup(instance_username, instance_password, instance_port, env_path, current_time, args, sharded_export=None):
+    output_path = f'/tmp/{args.cluster}-{args.database}-{current_time}'
+    if args.journal is not None and 'dump' in args.journal.steps and os.path.isdir(output_path):
+        # the staged files were written with the codec chosen then, whatever was chosen now
+        args.codec = args.journal.steps['dump']['codec']
+        print(f'Resuming with the staged dump of {args.database} in {output_path}')
+        return True
+    print(f'Backing up {args.database} database from cluster {args.endpoint}')
+    if args.journal is not None:
+        # anything already uploaded came from another snapshot
+        args.journal.reset()
+    shutil.rmtree(output_path, ignore_errors=True)
 
     try:
+        dump_options = ''
+        if sharded_export is not None:
+            dump_options = sharded_export.start()
+        command1 = get_dump_command(instance_username, instance_port, env_path, output_path, args, dump_options)
+
         bufsize = 1024 * 1024 * 1 # 1MB
 
         proc1 = subprocess.Popen(command1, shell=True, stdin=subprocess.PIPE, \
@@ -88,40 +394,1048 @@ def perform_db_backup(instance_username, instance_password, instance_port, env_p
             })
         out, err = proc1.communicate()
         if proc1.returncode != 0:
+            args.report.error(f'Dump of {args.database} database exited with {proc1.returncode}')
             return None
+        if sharded_export is not None:
+            sharded_export.finish(output_path)
+        if args.journal is not None:
+            args.journal.record({'event': 'step', 'name': 'dump', 'codec': args.codec})
+        return True
 
     except Exception as e:
-            print(f'Exception during dump of {args.database} database from cluster {args.endpoint}')
-            print(e)
+            args.report.error(f'Exception during dump of {args.database} database from cluster {args.endpoint}', e)
+    finally:
+        if sharded_export is not None:
+            sharded_export.close()
 
-def perform_db_restore(backup_type, instance_username, instance_password, instance_port, env_path, args):
-    print(f'Restoring {args.database} database to cluster {args.endpoint} on port {instance_port}')
-    # pg_restore -U postgres -Ft -C -d db1
-    # pg_restore --dbname=DBNAME --no-tablespaces --host=HOSTNAME --port=5432 --username=USERNAME --verbose -F d -j 6 /mnt/backup
+def get_process_tree(root_pid):
+    # pg_dump -j forks worker processes, so collect every descendant of the dump command
+    children = {}
+    for stat_path in pathlib.Path('/proc').glob('[0-9]*/stat'):
+        try:
+            stat = stat_path.read_text()
+        except OSError:
+            continue
+        # process name is wrapped in parentheses and may contain spaces
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(stat_path.parent.name))
+
+    pids = [root_pid]
+    for pid in pids:
+        pids.extend(children.get(pid, []))
+    return pids
+
+def get_open_files(pids):
+    open_files = set()
+    for pid in pids:
+        fd_dir = f'/proc/{pid}/fd'
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                open_files.add(os.readlink(f'{fd_dir}/{fd}'))
+            except OSError:
+                continue
+    return open_files
+
+def get_closed_files(output_path, pids):
+    # list the directory before inspecting file descriptors; a file that is listed
+    # but not open by any pg_dump process has been fully written
+    try:
+        file_names = os.listdir(output_path)
+    except FileNotFoundError:
+        return []
+    open_files = get_open_files(pids)
+    return [file_name for file_name in file_names
+        if os.path.join(output_path, file_name) not in open_files and not file_name.endswith(PARTIAL_SUFFIX)]
+
+def perform_pipelined_backup(engine, backup_type, instance_username, instance_password, instance_port, env_path, current_time, args, sharded_export=None):
+    print(f'Backing up {args.database} database from cluster {args.endpoint} with pipelined upload')
+
+    output_path = os.path.realpath(f'/tmp/{args.cluster}-{args.database}-{current_time}')
+    s3_prefix = f'{backup_type}/{args.cluster}/{args.database}/{current_time}'
+
+    uploads = {}
+    try:
+        dump_options = ''
+        if sharded_export is not None:
+            dump_options = sharded_export.start()
+        command1 = get_dump_command(instance_username, instance_port, env_path, output_path, args, dump_options)
+
+        proc1 = subprocess.Popen(command1, shell=True, stdin=subprocess.PIPE, \
+            stdout=subprocess.PIPE, env={
+            'PGPASSWORD': instance_password
+            })
+
+        dump_finished = False
+        while not dump_finished:
+            dump_finished = proc1.poll() is not None
+            if dump_finished and proc1.returncode == 0 and sharded_export is not None:
+                # the manifest is swept up with the last dump files, ahead of toc.dat
+                sharded_export.finish(output_path)
+            # once pg_dump has exited every remaining file is closed
+            pids = [] if dump_finished else get_process_tree(proc1.pid)
+            for file_name in get_closed_files(output_path, pids):
+                # toc.dat is uploaded last so the backup only looks complete when it is
+                if file_name in ('toc.dat', 'manifest.json') or file_name in uploads:
+                    continue
+                uploads[file_name] = upload_backup_file(engine, f'{output_path}/{file_name}', s3_prefix, args,
+                    remove=True)
+            if not dump_finished:
+                time.sleep(1)
+
+        failed = wait_for_transfers(uploads, args.bucket)
+
+        if proc1.returncode != 0:
+            args.report.error(f'Dump of {args.database} database exited with {proc1.returncode}, not marking backup complete')
+            return None
+        if failed:
+            args.report.error(f'Not all files were copied to {args.bucket}, not marking backup complete')
+            return None
+
+        upload_backup_index(engine, output_path, s3_prefix, uploads, args)
+        print(f'Pipelined backup of {len(uploads) + 1} files to s3 prefix {s3_prefix} complete')
+
+    except Exception as e:
+            args.report.error(f'Exception during pipelined backup of {args.database} database from cluster {args.endpoint}', e)
+    finally:
+        if sharded_export is not None:
+            sharded_export.close()
+        shutil.rmtree(output_path, ignore_errors=True)
+
+# custom format pg_dump archive of everything a streamed backup does not COPY
+STREAM_DUMP_FILE = 'database.dump'
+
+def get_stream_dump_command(instance_username, instance_port, env_path, args, dump_options=''):
     command1 =  f'PATH={env_path} ' \
-                f'pg_restore -C ' \
+                f'pg_dump -Fc {dump_options}'\
                 f'--host={args.endpoint} ' \
                 f'--username={instance_username} ' \
                 f'--no-password ' \
                 f'--port={instance_port} ' \
-                f'-v ' \
-                f'-d postgres ' \
-                f'/tmp/{args.cluster}-{args.database}-{args.timestamp} ' 
+                f'{get_compression_dump_option(args.codec)} ' \
+                f'{args.database}'
+    return command1
 
-    try:
-        bufsize = 1024 * 1024 * 1 # 1MB
+def perform_streaming_backup(engine, backup_type, instance_username, instance_password, instance_port, env_path, current_time, args, sharded_export):
+    print(f'Backing up {args.database} database from cluster {args.endpoint} by streaming to s3')
 
-        proc1 = subprocess.Popen(command1, shell=True, stdin=subprocess.PIPE, \
-            stdout=subprocess.PIPE, bufsize=bufsize, env={
+    s3_prefix = f'{backup_type}/{args.cluster}/{args.database}/{current_time}'
+    proc1 = None
+    try:
+        # tables are COPY streams under the exported snapshot, pg_dump streams the rest
+        dump_options = sharded_export.start()
+        command1 = get_stream_dump_command(instance_username, instance_port, env_path, args, dump_options)
+        proc1 = subprocess.Popen(command1, shell=True, stdout=subprocess.PIPE, env={
             'PGPASSWORD': instance_password
             })
-        out, err = proc1.communicate()
-        if proc1.returncode != 0:
+        # pg_dump compresses natively unless the codec has to be applied to its output
+        dump_codec = args.codec if args.codec['method'] == 'stream' else CODEC_NONE
+        with engine.open_upload_stream(args.bucket, f'{s3_prefix}/{STREAM_DUMP_FILE}',
+                {'ContentType': 'application/octet-stream'}) as stream:
+            with open_compressing_stream(stream, dump_codec) as f:
+                copy_stream(proc1.stdout, f)
+            if proc1.wait() != 0:
+                raise Exception(f'Dump of {args.database} database exited with {proc1.returncode}')
+
+        manifest = sharded_export.get_manifest()
+        manifest['compression'] = args.codec
+        manifest['stream'] = {'dump': STREAM_DUMP_FILE}
+        manifest['files'][STREAM_DUMP_FILE] = {**stream.result, 'file': STREAM_DUMP_FILE}
+        add_backup_summary(manifest, try_build_toc_index(engine, s3_prefix, None, manifest, args), args)
+        # manifest.json goes last, a streamed backup is only complete once it is present
+        engine.client.put_object(Bucket=args.bucket, Key=f'{s3_prefix}/manifest.json',
+            Body=json.dumps(manifest).encode(), ContentType='application/json')
+        print(f'Streamed backup of {len(get_shard_chunks(manifest)) + 1} objects to s3 prefix {s3_prefix} complete')
+
+    except Exception as e:
+            args.report.error(f'Exception during streaming backup of {args.database} database from cluster {args.endpoint}', e)
+    finally:
+        sharded_export.close()
+        if proc1 is not None and proc1.poll() is None:
+            proc1.kill()
+
+def write_manifest(output_path, manifest):
+    with open(f'{output_path}/manifest.json', 'w') as json_file:
+        json.dump(manifest, json_file, indent=2)
+
+def read_manifest(restore_path):
+    manifest_path = f'{restore_path}/manifest.json'
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as json_file:
+        return json.load(json_file)
+
+def get_shard_tables(cur, threshold):
+    cur.execute("""SELECT n.nspname, c.relname, c.oid, pg_relation_size(c.oid)
+                   FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+                   WHERE c.relkind = 'r' AND c.relpersistence = 'p'
+                   AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+                   AND pg_relation_size(c.oid) >= %s
+                   ORDER BY 4 DESC""", (threshold,))
+    return cur.fetchall()
+
+def get_shard_ranges(cur, schema, table, oid, size, chunk_count):
+    # split on a single-column integer primary key when there is one, otherwise on ctid blocks
+    # where ctid ranges are tid range scans (PostgreSQL 14+), otherwise into a single chunk
+    cur.execute("""SELECT a.attname FROM pg_index i
+                   JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+                   WHERE i.indrelid = %s AND i.indisprimary AND i.indnatts = 1
+                   AND a.atttypid IN ('int2'::regtype, 'int4'::regtype, 'int8'::regtype)""", (oid,))
+    row = cur.fetchone()
+    if row is not None:
+        column = sql.Identifier(row[0])
+        cur.execute(sql.SQL('SELECT min({0}), max({0}) FROM ONLY {1}.{2}').format(column,
+            sql.Identifier(schema), sql.Identifier(table)))
+        low, high = cur.fetchone()
+        if low is None:
+            return row[0], []
+        step = math.ceil((high - low + 1) / chunk_count)
+        return row[0], [sql.SQL('{0} >= {1} AND {0} < {2}').format(column, sql.Literal(start),
+            sql.Literal(start + step)).as_string(cur) for start in range(low, high + 1, step)]
+
+    # before 14 every ctid range reads the whole table, so N chunks would be N full scans
+    cur.execute("SELECT current_setting('server_version_num')::int, current_setting('block_size')::bigint")
+    server_version, block_size = cur.fetchone()
+    if server_version < 140000:
+        return None, ['true']
+    blocks = math.ceil(size / block_size)
+    step = math.ceil(blocks / chunk_count)
+    ranges = []
+    for start in range(0, blocks, step):
+        where = sql.SQL('ctid >= {}::tid').format(sql.Literal(f'({start},0)'))
+        # the last range is open ended so nothing past the measured size is missed
+        if start + step < blocks:
+            where = sql.SQL('{} AND ctid < {}::tid').format(where, sql.Literal(f'({start + step},0)'))
+        ranges.append(where.as_string(cur))
+    return 'ctid', ranges
+
+def get_copy_columns(cur, oid):
+    # generated columns are recomputed on load and cannot be copied in
+    cur.execute("""SELECT attname FROM pg_attribute
+                   WHERE attrelid = %s AND attnum > 0 AND NOT attisdropped AND attgenerated = ''
+                   ORDER BY attnum""", (oid,))
+    return [row[0] for row in cur.fetchall()]
+
+class ShardedExport:
+    """Export tables above --shard-threshold as concurrent COPY ranges beside pg_dump.
+
+    A coordinator transaction exports its snapshot; pg_dump (--snapshot) and every COPY
+    worker import it, so the sharded tables are consistent with the rest of the dump.
+    pg_dump skips their data with --exclude-table-data, and manifest.json records how
+    the chunks map back to tables.
+    """
+
+    def __init__(self, engine, conn_string, s3_prefix, args):
+        self.engine = engine
+        self.conn_string = conn_string
+        self.s3_prefix = s3_prefix
+        self.args = args
+        self.connection = None
+        self.shards = []
+        self.files = {}
+        self.futures = []
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.shard_jobs)
+        self.shard_path = f'/tmp/{args.cluster}-{args.database}-shards-{s3_prefix.rsplit("/", 1)[-1]}'
+
+    def start(self):
+        self.connection = psycopg2.connect(self.conn_string)
+        self.connection.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        cur = self.connection.cursor()
+        cur.execute('SELECT pg_export_snapshot()')
+        self.snapshot_id = cur.fetchone()[0]
+
+        chunk_size = self.args.shard_chunk_size * MB
+        # streamed backups COPY every table with data unless a threshold leaves small ones to pg_dump
+        threshold = max(1, int((self.args.shard_threshold or 0) * 1024 * MB))
+        if not self.args.stream:
+            pathlib.Path(self.shard_path).mkdir(parents=True, exist_ok=True)
+        dump_options = f'--snapshot={self.snapshot_id} '
+        for index, (schema, table, oid, size) in enumerate(get_shard_tables(cur, threshold)):
+            key, ranges = get_shard_ranges(cur, schema, table, oid, size, max(1, math.ceil(size / chunk_size)))
+            shard = {'schema': schema, 'table': table, 'bytes': size, 'key': key,
+                'columns': get_copy_columns(cur, oid), 'chunks': []}
+            for chunk_index, where in enumerate(ranges):
+                chunk = {'file': f'shard-{index:04d}-{chunk_index:04d}.copy{CODECS[self.args.codec["codec"]]["suffix"]}',
+                    'where': where}
+                shard['chunks'].append(chunk)
+                self.futures.append(self.executor.submit(self.export_chunk, shard, chunk))
+            self.shards.append(shard)
+            print(f'Sharding {schema}.{table} ({size / MB:.1f}MB) into {len(ranges)} chunks on {key or "no key"}')
+            dump_options += '--exclude-table-data=' + shlex.quote(f'"{schema}"."{table}"') + ' '
+        cur.close()
+        return dump_options
+
+    def export_chunk(self, shard, chunk):
+        connection = psycopg2.connect(self.conn_string)
+        try:
+            connection.set_session(isolation_level='REPEATABLE READ', readonly=True)
+            cur = connection.cursor()
+            cur.execute('SET TRANSACTION SNAPSHOT %s', (self.snapshot_id,))
+            # ONLY, as pg_dump does, so rows of inheritance children are exported with the children alone
+            query = sql.SQL('COPY (SELECT {} FROM ONLY {}.{} WHERE {}) TO STDOUT').format(
+                sql.SQL(', ').join(map(sql.Identifier, shard['columns'])),
+                sql.Identifier(shard['schema']), sql.Identifier(shard['table']), sql.SQL(chunk['where']))
+            full_path = f'{self.shard_path}/{chunk["file"]}'
+            if self.args.stream:
+                # straight into a multipart upload, nothing is staged locally
+                with self.engine.open_upload_stream(self.args.bucket, f'{self.s3_prefix}/{chunk["file"]}',
+                        {'ContentType': 'application/x-compressed'}) as stream:
+                    with open_compressing_stream(stream, self.args.codec) as f:
+                        cur.copy_expert(query, f)
+                self.files[chunk['file']] = {**stream.result, 'file': chunk['file']}
+            else:
+                with open_compressed_writer(full_path, self.args.codec) as f:
+                    cur.copy_expert(query, f)
+            chunk['rows'] = cur.rowcount
+            connection.rollback()
+        finally:
+            connection.close()
+        if self.args.stream:
+            return
+        result = self.engine.upload_file(full_path, self.args.bucket, f'{self.s3_prefix}/{chunk["file"]}',
+            extra_args={'ContentType': 'application/x-compressed'}).result()
+        self.files[chunk['file']] = {**result, 'file': chunk['file']}
+        os.remove(full_path)
+
+    def close(self):
+        # shutdown(cancel_futures=True) needs Python 3.9, the EC2 host runs 3.7
+        for future in self.futures:
+            future.cancel()
+        self.executor.shutdown(wait=True)
+        # the exported snapshot stays valid until the coordinator transaction ends
+        if self.connection is not None:
+            self.connection.close()
+        shutil.rmtree(self.shard_path, ignore_errors=True)
+
+    def get_manifest(self):
+        try:
+            for future in self.futures:
+                future.result()
+        finally:
+            self.close()
+        return {'version': 1, 'snapshot': self.snapshot_id, 'shards': self.shards, 'files': self.files}
+
+    def finish(self, output_path):
+        write_manifest(output_path, self.get_manifest())
+
+def load_shard_stream(conn_string, shard, reader):
+    connection = psycopg2.connect(conn_string)
+    try:
+        cur = connection.cursor()
+        query = sql.SQL('COPY {}.{} ({}) FROM STDIN').format(sql.Identifier(shard['schema']),
+            sql.Identifier(shard['table']), sql.SQL(', ').join(map(sql.Identifier, shard['columns'])))
+        cur.copy_expert(query, reader)
+        connection.commit()
+    finally:
+        connection.close()
+
+def load_shard_chunk(conn_string, shard, chunk_path, codec):
+    with open_compressed_reader(chunk_path, codec) as f:
+        load_shard_stream(conn_string, shard, f)
+    os.remove(chunk_path)
+
+def get_shard_chunks(manifest):
+    return {chunk['file']: shard for shard in manifest.get('shards', []) for chunk in shard['chunks']}
+
+def load_shards(conn_string, manifest, restore_path, args):
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(load_shard_chunk, conn_string, shard, f'{restore_path}/{file_name}',
+            get_backup_codec(manifest)): file_name
+            for file_name, shard in get_shard_chunks(manifest).items()}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                args.report.error(f'Exception during load of {futures[future]} to database {args.database}', e)
+                failed.append(futures[future])
+    return failed
+
+def get_restore_command(instance_username, instance_port, env_path, restore_options, restore_path, args):
+    if args.operation == 'restore' and args.no_comments:
+        restore_options += ' --no-comments'
+    command1 =  f'PATH={env_path} ' \
+                f'pg_restore {restore_options} ' \
+                f'--host={args.endpoint} ' \
+                f'--username={instance_username} ' \
+                f'--no-password ' \
+                f'--port={instance_port} ' \
+                f'{restore_path} '
+    return command1
+
+def get_restore_env(instance_password, args):
+    env = {'PGPASSWORD': instance_password}
+    if args.restore_profile == 'fast-load':
+        # session settings for every pg_restore connection, nothing changes server wide
+        env['PGOPTIONS'] = ' '.join(f'-c {name}={value}' for name, value in {
+            'synchronous_commit': 'off',
+            'maintenance_work_mem': f'{args.maintenance_work_mem}MB',
+            'max_parallel_maintenance_workers': args.parallel_maintenance_workers,
+        }.items())
+    return env
+
+def get_target_options(args):
+    # a refresh keeps the existing database, so the archive's objects are replaced in it rather than created with it
+    if args.existing_db:
+        return f'--clean --if-exists -d {args.database}'
+    return '-C -d postgres'
+
+def run_pg_restore(instance_username, instance_password, instance_port, env_path, restore_options, restore_path, args):
+    command1 = get_restore_command(instance_username, instance_port, env_path, restore_options, restore_path, args)
+
+    bufsize = 1024 * 1024 * 1 # 1MB
+
+    proc1 = subprocess.Popen(command1, shell=True, stdin=subprocess.PIPE, \
+        stdout=subprocess.PIPE, bufsize=bufsize, env=get_restore_env(instance_password, args))
+    out, err = proc1.communicate()
+    return proc1.returncode
+
+def perform_db_restore(backup_type, instance_username, instance_password, instance_port, env_path, args):
+    print(f'Restoring {args.database} database to cluster {args.endpoint} on port {instance_port}')
+    # pg_restore -U postgres -Ft -C -d db1
+    # pg_restore --dbname=DBNAME --no-tablespaces --host=HOSTNAME --port=5432 --username=USERNAME --verbose -F d -j 6 /mnt/backup
+    restore_path = f'/tmp/{args.cluster}-{args.database}-{args.timestamp}'
+
+    try:
+        manifest = read_manifest(restore_path)
+        if args.restore_profile == 'fast-load':
+            return perform_fast_load_restore(instance_username, instance_password, instance_port, env_path,
+                restore_path, manifest, args)
+        if manifest.get('shards'):
+            # sharded tables are loaded between the data and post-data sections
+            returncode = run_pg_restore(instance_username, instance_password, instance_port, env_path,
+                f'{get_target_options(args)} -v -j {args.jobs} --section=pre-data --section=data', restore_path, args)
+            conn_string = f'user={instance_username} password={instance_password} host={args.endpoint} port={instance_port} dbname={args.database}'
+            failed = load_shards(conn_string, manifest, restore_path, args)
+            post_returncode = run_pg_restore(instance_username, instance_password, instance_port, env_path,
+                f'-v -j {args.jobs} --section=post-data -d {args.database}', restore_path, args)
+            if returncode != 0 or failed or post_returncode != 0:
+                args.report.error(f'Restore of {args.database} exited with {returncode}/{post_returncode} '
+                    f'and {len(failed)} failed shard chunks')
+                return None
+            return True
+
+        returncode = run_pg_restore(instance_username, instance_password, instance_port, env_path,
+            f'{get_target_options(args)} -v -j {args.jobs}', restore_path, args)
+        if returncode != 0:
+            args.report.error(f'Restore of {args.database} exited with {returncode}')
             return None
 
     except Exception as e:
-            print(f'Exception during restore of {args.database} database to cluster {args.endpoint}')
-            print(e)
+            args.report.error(f'Exception during restore of {args.database} database to cluster {args.endpoint}', e)
+
+def is_superuser(conn_string):
+    connection = connect(conn_string)
+    try:
+        cur = connection.cursor()
+        cur.execute('SELECT rolsuper FROM pg_roles WHERE rolname = current_user')
+        return cur.fetchone()[0]
+    finally:
+        connection.close()
+
+def get_relation_sizes(conn_string):
+    connection = connect(conn_string)
+    try:
+        cur = connection.cursor()
+        cur.execute("""SELECT n.nspname || '.' || c.relname, pg_relation_size(c.oid)
+                       FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+                       WHERE c.relkind IN ('r', 'm', 'p')""")
+        return dict(cur.fetchall())
+    finally:
+        connection.close()
+
+# post-data entries built one pg_restore each, foreign keys only once the keys they reference exist
+POST_DATA_BUILD_TYPES = [{'INDEX', 'CONSTRAINT'}, {'FK CONSTRAINT'}]
+
+def restore_toc_entry(instance_username, instance_password, instance_port, env_path, entry, restore_path, args):
+    list_path = write_restore_list(f'{restore_path}.{entry["dump_id"]}.list', [entry])
+    returncode = run_pg_restore(instance_username, instance_password, instance_port, env_path,
+        f'-L {list_path} -d {args.database}', restore_path, args)
+    os.remove(list_path)
+    if returncode != 0:
+        raise Exception(f'pg_restore of {entry["type"]} {entry["schema"]}.{entry["name"]} exited with {returncode}')
+
+def run_post_data_builds(instance_username, instance_password, instance_port, env_path, batch, toc, sizes, restore_path, args):
+    # up to --jobs builds at once, largest table first, each after the entries it depends on
+    pending = sorted(batch, key=lambda entry: sizes.get(entry['dump_id'], 0), reverse=True)
+    batch_ids = {entry['dump_id'] for entry in batch}
+    finished, running, failed = set(), {}, []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        while pending or running:
+            ready = [entry for entry in pending
+                if not (set(toc.get(entry['dump_id'], {}).get('deps', [])) & batch_ids) - finished]
+            # with nothing running and nothing ready, the first pending entry goes ahead rather than wait forever
+            for entry in (ready or ([] if running else pending[:1]))[:args.jobs - len(running)]:
+                pending.remove(entry)
+                running[executor.submit(restore_toc_entry, instance_username, instance_password, instance_port,
+                    env_path, entry, restore_path, args)] = entry
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                entry = running.pop(future)
+                # a failed build still releases its dependents, which then fail on their own
+                finished.add(entry['dump_id'])
+                try:
+                    future.result()
+                except Exception as e:
+                    args.report.error(f'Exception during post-data restore to database {args.database}', e)
+                    failed.append(entry['dump_id'])
+    return failed
+
+def restore_post_data(instance_username, instance_password, instance_port, env_path, restore_path, conn_string, args):
+    # the entries pg_restore --section=post-data would run, with the comments and acls that follow them
+    entries = get_toc_entries(env_path, restore_path, '--section=post-data')
+    with open(f'{restore_path}/toc.dat', 'rb') as f:
+        toc = {entry['dump_id']: entry for entry in TocReader(f).read()['entries']}
+    # an index or constraint is as large as the table it depends on, now that the data is loaded
+    relation_sizes = get_relation_sizes(conn_string)
+    sizes = {entry['dump_id']: max([relation_sizes.get(f'{toc[dep]["schema"]}.{toc[dep]["name"]}', 0)
+        for dep in toc.get(entry['dump_id'], {}).get('deps', []) if dep in toc] or [0]) for entry in entries}
+
+    failed = []
+    built = set()
+    for types in POST_DATA_BUILD_TYPES:
+        batch = [entry for entry in entries if entry['type'] in types]
+        failed += run_post_data_builds(instance_username, instance_password, instance_port, env_path, batch, toc,
+            sizes, restore_path, args)
+        built.update(entry['dump_id'] for entry in batch)
+    print(f'Built {len(built) - len(failed)} of {len(built)} indexes and constraints with up to {args.jobs} at once')
+
+    # triggers, rules, index attachments and the rest in archive order
+    remaining = [entry for entry in entries if entry['dump_id'] not in built]
+    if remaining:
+        list_path = write_restore_list(f'{restore_path}.post-data.list', remaining)
+        returncode = run_pg_restore(instance_username, instance_password, instance_port, env_path,
+            f'-v -L {list_path} -d {args.database}', restore_path, args)
+        os.remove(list_path)
+        if returncode != 0:
+            args.report.error(f'post-data restore of {args.database} exited with {returncode}')
+            failed.append('post-data')
+    return failed
+
+def perform_fast_load_restore(instance_username, instance_password, instance_port, env_path, restore_path, manifest, args):
+    # tables are created bare, loaded in parallel, and only then get their indexes, constraints and triggers
+    print(f'Restoring {args.database} with the fast-load profile')
+    returncode = run_pg_restore(instance_username, instance_password, instance_port, env_path,
+        f'{get_target_options(args)} -v --section=pre-data', restore_path, args)
+    if returncode != 0:
+        args.report.error(f'pre-data restore of {args.database} exited with {returncode}')
+        return None
+
+    conn_string = f'user={instance_username} password={instance_password} host={args.endpoint} port={instance_port} dbname={args.database}'
+    data_options = f'-v -a -j {args.jobs} -d {args.database}'
+    # disabling triggers needs a superuser, and only matters for triggers already present in the database
+    if is_superuser(conn_string):
+        data_options += ' --disable-triggers'
+    data_returncode = run_pg_restore(instance_username, instance_password, instance_port, env_path,
+        data_options, restore_path, args)
+    failed = load_shards(conn_string, manifest, restore_path, args)
+    failed += restore_post_data(instance_username, instance_password, instance_port, env_path, restore_path,
+        conn_string, args)
+    if data_returncode != 0 or failed:
+        args.report.error(f'Fast-load restore of {args.database} exited with {data_returncode} '
+            f'and {len(failed)} failed shard chunks or post-data entries')
+        return None
+    return True
+
+# multi-word object types that can appear in pg_restore -l output, longest first
+TOC_ENTRY_TYPES = sorted([
+    'TABLE DATA', 'SEQUENCE SET', 'SEQUENCE OWNED BY', 'FK CONSTRAINT', 'CHECK CONSTRAINT',
+    'DEFAULT ACL', 'BLOB METADATA', 'LARGE OBJECT', 'MATERIALIZED VIEW', 'MATERIALIZED VIEW DATA',
+    'TEXT SEARCH CONFIGURATION', 'TEXT SEARCH DICTIONARY', 'TEXT SEARCH PARSER', 'TEXT SEARCH TEMPLATE',
+    'FOREIGN DATA WRAPPER', 'FOREIGN SERVER', 'FOREIGN TABLE', 'USER MAPPING', 'EVENT TRIGGER',
+    'OPERATOR CLASS', 'OPERATOR FAMILY', 'ACCESS METHOD', 'INDEX ATTACH', 'TABLE ATTACH',
+    'PUBLICATION TABLE', 'PUBLICATION TABLES IN SCHEMA', 'PROCEDURAL LANGUAGE', 'DATABASE PROPERTIES',
+    'SECURITY LABEL', 'SHELL TYPE',
+], key=len, reverse=True)
+
+def parse_toc_entry(line):
+    # e.g. 3345; 0 16390 TABLE DATA public foo postgres
+    dump_id, catalog_ids = line.split(';', 1)
+    table_oid, oid, rest = catalog_ids.strip().split(' ', 2)
+    entry_type = next((t for t in TOC_ENTRY_TYPES if rest.startswith(t + ' ')), rest.split(' ', 1)[0])
+    fields = rest[len(entry_type) + 1:].split(' ')
+    return {
+        'dump_id': int(dump_id),
+        'type': entry_type,
+        'schema': fields[0],
+        'name': ' '.join(fields[1:-1]),
+        'owner': fields[-1],
+        'line': line,
+    }
+
+def get_toc_entries(env_path, restore_path, restore_options=''):
+    # pg_restore -l only reads toc.dat, so it works before any data file is present
+    command1 = f'PATH={env_path} pg_restore -l {restore_options} {restore_path}'
+    # entry names are in the database encoding, which need not be UTF-8
+    output = subprocess.run(command1, shell=True, check=True, stdout=subprocess.PIPE, text=True, errors='replace').stdout
+    return [parse_toc_entry(line) for line in output.splitlines() if line and not line.startswith(';')]
+
+def write_restore_list(list_path, entries):
+    with open(list_path, 'w') as f:
+        for entry in entries:
+            f.write(entry['line'] + '\n')
+    return list_path
+
+def restore_table_data(instance_username, instance_password, instance_port, env_path, entry, data_path, restore_path, codec, args):
+    data_path = decompress_file(data_path, codec)
+    list_path = write_restore_list(f'{restore_path}.{entry["dump_id"]}.list', [entry])
+    returncode = run_pg_restore(instance_username, instance_password, instance_port, env_path,
+        f'--section=data -L {list_path} -d {args.database}', restore_path, args)
+    os.remove(list_path)
+    if returncode != 0:
+        raise Exception(f'pg_restore of {entry["schema"]}.{entry["name"]} exited with {returncode}')
+    # the data file is no longer needed once loaded
+    os.remove(data_path)
+
+def perform_pipelined_restore(engine, backup_type, instance_username, instance_password, instance_port, env_path, args):
+    print(f'Restoring {args.database} database to cluster {args.endpoint} on port {instance_port} with pipelined download')
+
+    s3_prefix = f'{backup_type}/{args.cluster}/{args.database}/{args.timestamp}'
+    restore_path = f'/tmp/{args.cluster}-{args.database}-{args.timestamp}'
+    pathlib.Path(restore_path).mkdir(parents=True, exist_ok=True)
+
+    try:
+        objects = get_backup_objects(engine, s3_prefix, restore_path, args)
+        if 'toc.dat' not in objects:
+            args.report.error(f'No toc.dat under s3 prefix {s3_prefix}, backup is incomplete')
+            return None
+        engine.download_file(args.bucket, objects['toc.dat']['Key'], f'{restore_path}/toc.dat',
+            objects['toc.dat']['Size']).result()
+        manifest = read_manifest(restore_path)
+        shard_chunks = get_shard_chunks(manifest)
+        codec = get_backup_codec(manifest)
+
+        # pre-data only needs toc.dat: create the database, schemas and tables
+        returncode = run_pg_restore(instance_username, instance_password, instance_port, env_path,
+            f'{get_target_options(args)} -v --section=pre-data', restore_path, args)
+        if returncode != 0:
+            # without the tables every load would fail too
+            args.report.error(f'pre-data restore of {args.database} exited with {returncode}')
+            return None
+
+        # match each table data entry to its data file, e.g. 3345.dat.gz, largest first
+        entries = get_toc_entries(env_path, restore_path)
+        files_by_id = {name.split('.', 1)[0]: name for name in objects}
+        data_files = {}
+        for entry in entries:
+            file_name = files_by_id.get(str(entry['dump_id']))
+            if entry['type'] == 'TABLE DATA' and file_name is not None:
+                data_files[file_name] = entry
+        data_files.update({file_name: None for file_name in shard_chunks if file_name in objects})
+        prefetch_order = sorted(data_files, key=lambda name: objects[name]['Size'], reverse=True)
+        # anything else, e.g. blobs.toc and large object files, is fetched after table data
+        prefetch_order += [name for name in objects
+            if name not in data_files and name not in ('toc.dat', 'manifest.json')]
+        conn_string = f'user={instance_username} password={instance_password} host={args.endpoint} port={instance_port} dbname={args.database}'
+
+        # load each table as soon as its file lands, up to --jobs pg_restore processes at once
+        downloads = {}
+        for file_name in prefetch_order:
+            downloads[engine.download_file(args.bucket, objects[file_name]['Key'],
+                f'{restore_path}/{file_name}', objects[file_name]['Size'])] = file_name
+
+        failed = []
+        loads = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as restore_executor:
+            for download in concurrent.futures.as_completed(downloads):
+                file_name = downloads[download]
+                if download.exception() is not None:
+                    args.report.error(f'Exception during download of {file_name} from {args.bucket}', download.exception())
+                    failed.append(file_name)
+                elif file_name in shard_chunks:
+                    loads[restore_executor.submit(load_shard_chunk, conn_string,
+                        shard_chunks[file_name], f'{restore_path}/{file_name}', codec)] = file_name
+                elif file_name in data_files:
+                    loads[restore_executor.submit(restore_table_data, instance_username, instance_password,
+                        instance_port, env_path, data_files[file_name], f'{restore_path}/{file_name}',
+                        restore_path, codec, args)] = file_name
+        for load, file_name in loads.items():
+            try:
+                load.result()
+            except Exception as e:
+                args.report.error(f'Exception during restore of {file_name} to database {args.database}', e)
+                failed.append(file_name)
+
+        # remaining data section entries such as sequence values and large objects
+        remaining = [entry for entry in entries if entry['type'] != 'TABLE DATA']
+        list_path = write_restore_list(f'{restore_path}.list', remaining)
+        data_returncode = run_pg_restore(instance_username, instance_password, instance_port, env_path,
+            f'--section=data -L {list_path} -d {args.database}', restore_path, args)
+        os.remove(list_path)
+        if data_returncode != 0:
+            args.report.error(f'pg_restore of the remaining data entries of {args.database} exited with {data_returncode}')
+
+        # indexes and constraints once all data is loaded
+        if args.restore_profile == 'fast-load':
+            returncode = 1 if restore_post_data(instance_username, instance_password, instance_port, env_path,
+                restore_path, conn_string, args) else 0
+        else:
+            returncode = run_pg_restore(instance_username, instance_password, instance_port, env_path,
+                f'-v -j {args.jobs} --section=post-data -d {args.database}', restore_path, args)
+        if failed or data_returncode != 0 or returncode != 0:
+            args.report.error(f'Pipelined restore of {args.database} finished with {len(failed)} failed files')
+            return None
+
+    except Exception as e:
+            args.report.error(f'Exception during pipelined restore of {args.database} database to cluster {args.endpoint}', e)
+    finally:
+        shutil.rmtree(restore_path, ignore_errors=True)
+
+def get_remote_manifest(engine, s3_prefix, args):
+    try:
+        body = engine.client.get_object(Bucket=args.bucket, Key=f'{s3_prefix}/manifest.json')['Body'].read()
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return {}
+        raise e
+    return json.loads(body)
+
+def restore_stream_section(engine, instance_username, instance_password, instance_port, env_path, restore_options, key, codec, args):
+    # pg_restore reads the archive on stdin straight from S3; sections run in archive order
+    command1 = get_restore_command(instance_username, instance_port, env_path, restore_options, '', args)
+    proc1 = subprocess.Popen(command1, shell=True, stdin=subprocess.PIPE, env=get_restore_env(instance_password, args))
+    try:
+        with engine.open_download_stream(args.bucket, key) as stream:
+            with open_decompressing_stream(stream, codec) as f:
+                copy_stream(f, proc1.stdin)
+    except BrokenPipeError:
+        # pg_restore exited early, its return code says why
+        pass
+    finally:
+        proc1.stdin.close()
+    return proc1.wait()
+
+def load_shard_object(engine, conn_string, shard, key, codec, args):
+    with engine.open_download_stream(args.bucket, key) as stream:
+        with open_decompressing_stream(stream, codec) as f:
+            load_shard_stream(conn_string, shard, f)
+
+def perform_streaming_restore(engine, backup_type, instance_username, instance_password, instance_port, env_path, manifest, args):
+    print(f'Restoring {args.database} database to cluster {args.endpoint} on port {instance_port} by streaming from s3')
+
+    s3_prefix = f'{backup_type}/{args.cluster}/{args.database}/{args.timestamp}'
+    codec = get_backup_codec(manifest)
+    dump_codec = codec if codec['method'] == 'stream' else CODEC_NONE
+    dump_key = f'{s3_prefix}/{manifest["stream"]["dump"]}'
+    conn_string = f'user={instance_username} password={instance_password} host={args.endpoint} port={instance_port} dbname={args.database}'
+
+    try:
+        returncode = restore_stream_section(engine, instance_username, instance_password, instance_port, env_path,
+            f'{get_target_options(args)} -v --section=pre-data', dump_key, dump_codec, args)
+        if returncode != 0:
+            # without the tables every stream would fail too
+            args.report.error(f'pre-data restore of {args.database} exited with {returncode}')
+            return None
+
+        # every COPY stream loads straight from S3, up to --jobs at once
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            futures = {executor.submit(load_shard_object, engine, conn_string, shard, f'{s3_prefix}/{file_name}',
+                codec, args): file_name for file_name, shard in get_shard_chunks(manifest).items()}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    args.report.error(f'Exception during load of {futures[future]} to database {args.database}', e)
+                    failed.append(futures[future])
+
+        # tables left to pg_dump and sequence values, then indexes and constraints
+        data_returncode = restore_stream_section(engine, instance_username, instance_password, instance_port, env_path,
+            f'-v --section=data -d {args.database}', dump_key, dump_codec, args)
+        post_returncode = restore_stream_section(engine, instance_username, instance_password, instance_port, env_path,
+            f'-v --section=post-data -d {args.database}', dump_key, dump_codec, args)
+        if failed or data_returncode != 0 or post_returncode != 0:
+            args.report.error(f'Streamed restore of {args.database} exited with {data_returncode}/{post_returncode} '
+                f'and {len(failed)} failed streams')
+            return None
+        return True
+
+    except Exception as e:
+            args.report.error(f'Exception during streaming restore of {args.database} database to cluster {args.endpoint}', e)
+
+# toc.dat layout, see ReadHead and ReadToc in pg_dump's pg_backup_archiver.c
+# directory archives write the tar format code; both keep a file name per entry
+TOC_FORMATS = {1: 'custom', 3: 'directory', 5: 'directory'}
+TOC_SECTIONS = {1: 'none', 2: 'pre-data', 3: 'data', 4: 'post-data'}
+TOC_INDEX_FILE = 'toc-index.json'
+TOC_INDEX_VERSION = 1
+
+class TocReader:
+    """Reads the header and entries of a pg_dump custom or directory format archive."""
+
+    def __init__(self, f):
+        self.f = f
+
+    def read_bytes(self, length):
+        data = self.f.read(length)
+        if len(data) != length:
+            raise Exception('unexpected end of pg_dump archive header')
+        return data
+
+    def read_byte(self):
+        return self.read_bytes(1)[0]
+
+    def read_int(self):
+        sign = self.read_byte()
+        value = int.from_bytes(self.read_bytes(self.int_size), 'little')
+        return -value if sign else value
+
+    def read_str(self):
+        length = self.read_int()
+        if length < 0:
+            return None
+        # names and comments are in the database encoding, which need not be UTF-8
+        return self.read_bytes(length).decode('utf-8', errors='replace')
+
+    def read(self):
+        if self.read_bytes(5) != b'PGDMP':
+            raise Exception('not a pg_dump archive')
+        major, minor, revision = self.read_byte(), self.read_byte(), self.read_byte()
+        version = (major, minor, revision)
+        if version < (1, 12, 0):
+            raise Exception(f'pg_dump archive version {major}.{minor} is too old to index')
+        self.int_size = self.read_byte()
+        offset_size = self.read_byte()
+        archive_format = TOC_FORMATS.get(self.read_byte(), 'unknown')
+        if version >= (1, 15, 0):
+            self.read_byte()
+        else:
+            self.read_int()
+        for _ in range(7):
+            self.read_int()
+        database, server_version, dump_version = self.read_str(), self.read_str(), self.read_str()
+
+        entries = []
+        for _ in range(self.read_int()):
+            entry = {'dump_id': self.read_int()}
+            self.read_int()
+            entry['table_oid'], entry['oid'] = self.read_str(), self.read_str()
+            entry['name'], entry['type'] = self.read_str(), self.read_str()
+            entry['section'] = TOC_SECTIONS.get(self.read_int(), 'none')
+            self.read_str(), self.read_str(), self.read_str()
+            entry['schema'] = self.read_str() or '-'
+            self.read_str()
+            if version >= (1, 14, 0):
+                self.read_str()
+            if version >= (1, 16, 0):
+                self.read_int()
+            entry['owner'] = self.read_str() or ''
+            self.read_str()
+            entry['deps'] = []
+            while True:
+                dep = self.read_str()
+                if dep is None:
+                    break
+                entry['deps'].append(int(dep))
+            if archive_format == 'directory':
+                entry['file'] = self.read_str()
+            elif archive_format == 'custom':
+                self.read_bytes(1 + offset_size)
+            # the same fields pg_restore -l prints, so entries can go straight into -L lists
+            entry['line'] = f'{entry["dump_id"]}; {entry["table_oid"]} {entry["oid"]} {entry["type"]} ' \
+                            f'{entry["schema"]} {entry["name"]} {entry["owner"]}'
+            entries.append(entry)
+        return {'version': TOC_INDEX_VERSION, 'format': archive_format, 'database': database,
+                'server_version': server_version, 'pg_dump_version': dump_version, 'entries': entries}
+
+def build_toc_index(engine, s3_prefix, restore_path, manifest, args):
+    if manifest.get('stream'):
+        # the archive header and toc sit at the start of the custom format dump
+        codec = get_backup_codec(manifest)
+        with engine.open_download_stream(args.bucket, f'{s3_prefix}/{manifest["stream"]["dump"]}') as stream:
+            with open_decompressing_stream(stream, codec if codec['method'] == 'stream' else CODEC_NONE) as f:
+                index = TocReader(f).read()
+    else:
+        with open(f'{restore_path}/toc.dat', 'rb') as f:
+            index = TocReader(f).read()
+    engine.client.put_object(Bucket=args.bucket, Key=f'{s3_prefix}/{TOC_INDEX_FILE}',
+        Body=json.dumps(index).encode(), ContentType='application/json')
+    print(f'Indexed {len(index["entries"])} toc entries into {s3_prefix}/{TOC_INDEX_FILE}')
+    return index
+
+def get_toc_index(engine, s3_prefix, restore_path, manifest, args):
+    # parsed once per backup, then cached beside it
+    try:
+        body = engine.client.get_object(Bucket=args.bucket, Key=f'{s3_prefix}/{TOC_INDEX_FILE}')['Body'].read()
+        index = json.loads(body)
+        if index.get('version') == TOC_INDEX_VERSION:
+            print(f'Using cached toc index from {s3_prefix}/{TOC_INDEX_FILE}')
+            return index
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+            raise e
+    return build_toc_index(engine, s3_prefix, restore_path, manifest, args)
+
+def try_build_toc_index(engine, s3_prefix, restore_path, manifest, args):
+    # the index only speeds up selective restores, which parse the toc themselves when it is missing
+    try:
+        return build_toc_index(engine, s3_prefix, restore_path, manifest, args)
+    except Exception as e:
+        print(f'Warning: could not index the toc of {s3_prefix}, continuing without {TOC_INDEX_FILE}: {e}')
+        return None
+
+def add_backup_summary(manifest, index, args):
+    # what verify --deep checks the backup against; only COPY row counts are exact
+    manifest['toc'] = {} if index is None else {'entries': len(index['entries']),
+                       'types': dict(collections.Counter(entry['type'] for entry in index['entries']))}
+    manifest['tables'] = {name: {'rows': rows, 'exact': False} for name, rows in args.catalog_rows.items()}
+    for shard in manifest.get('shards', []):
+        manifest['tables'][f'{shard["schema"]}.{shard["table"]}'] = {
+            'rows': sum(chunk['rows'] for chunk in shard['chunks']), 'exact': True}
+
+# entries that belong to a table through their dependencies; an identity column's sequence carries
+# the ALTER TABLE ... ADD GENERATED ... AS IDENTITY and depends on nothing but its table
+TABLE_DEPENDENT_TYPES = {
+    'TABLE DATA', 'DEFAULT', 'SEQUENCE', 'CONSTRAINT', 'CHECK CONSTRAINT', 'FK CONSTRAINT',
+    'INDEX', 'INDEX ATTACH', 'TRIGGER', 'RULE', 'POLICY', 'ROW SECURITY', 'STATISTICS',
+}
+# entries that follow whatever object they are attached to; SEQUENCE OWNED BY depends only on its sequence
+ATTACHED_TYPES = {'COMMENT', 'ACL', 'SECURITY LABEL', 'SEQUENCE SET', 'SEQUENCE OWNED BY'}
+
+def is_selected_table(schema, table, tables, schemas):
+    # tables by schema.name or bare name, or every table in a schema
+    return schema in schemas or table in tables or f'{schema}.{table}' in tables
+
+def select_toc_entries(index, tables, schemas):
+    entries = {entry['dump_id']: entry for entry in index['entries']}
+    selected = {entry['dump_id'] for entry in index['entries']
+        if entry['type'] == 'TABLE' and is_selected_table(entry['schema'], entry['name'], tables, schemas)}
+    table_ids = set(selected)
+    changed = True
+    while changed:
+        changed = False
+        for entry in index['entries']:
+            if entry['dump_id'] in selected:
+                continue
+            deps = set(entry['deps'])
+            # a foreign key from an unselected table stays with that table
+            if entry['type'] in TABLE_DEPENDENT_TYPES and deps & table_ids \
+                    or entry['type'] in ATTACHED_TYPES and deps & selected \
+                    or entry['type'] == 'SEQUENCE' and any(entries[dump_id]['type'] == 'DEFAULT'
+                        and entry['dump_id'] in entries[dump_id]['deps'] for dump_id in selected):
+                selected.add(entry['dump_id'])
+                changed = True
+    return [entry for entry in index['entries'] if entry['dump_id'] in selected]
+
+def restore_selected_list(instance_username, instance_password, instance_port, env_path, restore_options, entries, restore_path, args):
+    if not entries:
+        return 0
+    list_path = write_restore_list(f'{restore_path}.{entries[0]["section"]}.list', entries)
+    returncode = run_pg_restore(instance_username, instance_password, instance_port, env_path,
+        f'{restore_options} -L {list_path} -d {args.database}', restore_path, args)
+    os.remove(list_path)
+    return returncode
+
+def perform_selective_restore(engine, backup_type, instance_username, instance_password, instance_port, env_path, manifest, args):
+    print(f'Restoring tables {args.table or []} and schemas {args.schema or []} from {args.timestamp} into existing database {args.database}')
+
+    s3_prefix = f'{backup_type}/{args.cluster}/{args.database}/{args.timestamp}'
+    restore_path = f'/tmp/{args.cluster}-{args.database}-{args.timestamp}'
+    pathlib.Path(restore_path).mkdir(parents=True, exist_ok=True)
+    conn_string = f'user={instance_username} password={instance_password} host={args.endpoint} port={instance_port} dbname={args.database}'
+    codec = get_backup_codec(manifest)
+    streamed = bool(manifest.get('stream'))
+
+    try:
+        objects = {} if streamed else get_backup_objects(engine, s3_prefix, restore_path, args)
+        if not streamed:
+            if 'toc.dat' not in objects:
+                args.report.error(f'No toc.dat under s3 prefix {s3_prefix}, backup is incomplete')
+                return None
+            engine.download_file(args.bucket, objects['toc.dat']['Key'], f'{restore_path}/toc.dat',
+                objects['toc.dat']['Size']).result()
+        entries = select_toc_entries(get_toc_index(engine, s3_prefix, restore_path, manifest, args),
+            set(args.table or []), set(args.schema or []))
+        tables = {(entry['schema'], entry['name']) for entry in entries if entry['type'] == 'TABLE'}
+        if not tables:
+            args.report.error(f'No tables in {s3_prefix} match {args.table} or schemas {args.schema}')
+            return None
+        print(f'Restoring {len(tables)} tables and {len(entries) - len(tables)} dependent objects')
+        sections = {section: [entry for entry in entries if entry['section'] == section]
+            for section in ('pre-data', 'data', 'post-data')}
+        shard_chunks = {file_name: shard for file_name, shard in get_shard_chunks(manifest).items()
+            if (shard['schema'], shard['table']) in tables}
+
+        def restore_section(restore_options, section_entries):
+            if streamed:
+                if not section_entries:
+                    return 0
+                list_path = write_restore_list(f'{restore_path}.{section_entries[0]["section"]}.list', section_entries)
+                dump_codec = codec if codec['method'] == 'stream' else CODEC_NONE
+                returncode = restore_stream_section(engine, instance_username, instance_password, instance_port,
+                    env_path, f'{restore_options} -L {list_path} -d {args.database}',
+                    f'{s3_prefix}/{manifest["stream"]["dump"]}', dump_codec, args)
+                os.remove(list_path)
+                return returncode
+            return restore_selected_list(instance_username, instance_password, instance_port, env_path,
+                restore_options, section_entries, restore_path, args)
+
+        # drop and recreate the selected tables, their sequences and defaults, in one transaction so a
+        # failed drop (e.g. a foreign key from a table that was not selected) leaves the old tables as they were
+        returncode = restore_section('--clean --if-exists --single-transaction -v', sections['pre-data'])
+        if returncode != 0:
+            # loading data now would append to the old, still populated tables
+            args.report.error(f'pre-data restore of selected tables exited with {returncode}, '
+                f'skipping their data and post-data')
+            return None
+
+        # only the data files of the selected tables are fetched, largest first
+        files_by_id = {name.split('.', 1)[0]: name for name in objects}
+        data_files = {}
+        for entry in sections['data']:
+            file_name = files_by_id.get(str(entry['dump_id']))
+            if entry['type'] == 'TABLE DATA' and file_name is not None:
+                data_files[file_name] = entry
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as restore_executor:
+            loads = {}
+            if streamed:
+                for file_name, shard in shard_chunks.items():
+                    loads[restore_executor.submit(load_shard_object, engine, conn_string, shard,
+                        f'{s3_prefix}/{file_name}', codec, args)] = file_name
+            else:
+                downloads = {}
+                for file_name in sorted(list(data_files) + list(shard_chunks), key=lambda name: objects[name]['Size'],
+                        reverse=True):
+                    downloads[engine.download_file(args.bucket, objects[file_name]['Key'],
+                        f'{restore_path}/{file_name}', objects[file_name]['Size'])] = file_name
+                for download in concurrent.futures.as_completed(downloads):
+                    file_name = downloads[download]
+                    if download.exception() is not None:
+                        args.report.error(f'Exception during download of {file_name} from {args.bucket}', download.exception())
+                        failed.append(file_name)
+                    elif file_name in shard_chunks:
+                        loads[restore_executor.submit(load_shard_chunk, conn_string,
+                            shard_chunks[file_name], f'{restore_path}/{file_name}', codec)] = file_name
+                    else:
+                        loads[restore_executor.submit(restore_table_data, instance_username, instance_password,
+                            instance_port, env_path, data_files[file_name], f'{restore_path}/{file_name}',
+                            restore_path, codec, args)] = file_name
+            for load in concurrent.futures.as_completed(loads):
+                try:
+                    load.result()
+                except Exception as e:
+                    args.report.error(f'Exception during restore of {loads[load]} to database {args.database}', e)
+                    failed.append(loads[load])
+
+        # sequence values, and for streamed backups the small tables left in the dump
+        remaining = [entry for entry in sections['data'] if entry['type'] != 'TABLE DATA' or streamed]
+        data_returncode = restore_section('-v', remaining)
+        # indexes and constraints; a directory archive can build them in parallel
+        post_returncode = restore_section('-v' if streamed else f'-v -j {args.jobs}', sections['post-data'])
+        if failed or data_returncode != 0 or post_returncode != 0:
+            args.report.error(f'Selective restore of {args.database} exited with {data_returncode}/{post_returncode} '
+                f'and {len(failed)} failed files')
+            return None
+        return True
+
+    except Exception as e:
+            args.report.error(f'Exception during selective restore of {args.database} database to cluster {args.endpoint}', e)
+    finally:
+        shutil.rmtree(restore_path, ignore_errors=True)
 
 def check_existing_db(instance_username, instance_password, instance_port, env_path, args):
     print(f'Checking if database, {args.database} exists on cluster {args.endpoint} on port {instance_port}')
@@ -132,8 +1446,7 @@ def check_existing_db(instance_username, instance_password, instance_port, env_p
         connection = psycopg2.connect(conn_string)
         print('Connected to database')
     except Exception as e:
-        print('Unable to connect to database')
-        print(e)
+        args.report.error('Unable to connect to database', e)
     try:
         if connection is not None:
             connection.autocommit = True
@@ -148,8 +1461,7 @@ def check_existing_db(instance_username, instance_password, instance_port, env_p
         cur.close()
         connection.close()
     except Exception as e:
-            print(f'Exception during check if database {args.database} exists on cluster {args.endpoint}')
-            print(e)
+            args.report.error(f'Exception during check if database {args.database} exists on cluster {args.endpoint}', e)
     return db_found
 
 def drop_tables(instance_username, instance_password, instance_port, env_path, args):
@@ -161,8 +1473,7 @@ def drop_tables(instance_username, instance_password, instance_port, env_path, a
         connection = psycopg2.connect(conn_string)
         print('Connected to database')
     except Exception as e:
-        print('Unable to connect to database')
-        print(e)
+        args.report.error('Unable to connect to database', e)
     try:
         if connection is not None:
             connection.autocommit = True
@@ -176,38 +1487,73 @@ def drop_tables(instance_username, instance_password, instance_port, env_path, a
         cur.close()
         connection.close()
     except Exception as e:
-            print(f'Exception during dropping tables on database {args.database} on cluster {args.endpoint}')
-            print(e)
+            args.report.error(f'Exception during dropping tables on database {args.database} on cluster {args.endpoint}', e)
     return db_found
 
+MAINTENANCE_COMMANDS = {
+    'analyze': 'ANALYZE',
+    'vacuum-analyze': 'VACUUM (ANALYZE)',
+    'full': 'VACUUM (FULL, ANALYZE)',
+}
+
+def get_maintenance_tables(connection):
+    # every user table and materialized view, largest first so the longest tasks start earliest
+    cur = connection.cursor()
+    cur.execute("""SELECT n.nspname, c.relname, pg_total_relation_size(c.oid)
+                   FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+                   WHERE c.relkind IN ('r', 'm')
+                   AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+                   AND n.nspname NOT LIKE 'pg_toast%%' AND n.nspname NOT LIKE 'pg_temp%%'
+                   ORDER BY 3 DESC""")
+    tables = cur.fetchall()
+    cur.close()
+    return tables
+
+def maintain_table(conn_string, connections, local, command, schema, table, size):
+    # one connection per worker thread, reused for every table it picks up
+    if not hasattr(local, 'connection'):
+        local.connection = psycopg2.connect(conn_string)
+        local.connection.autocommit = True
+        connections.append(local.connection)
+    start = time.monotonic()
+    cur = local.connection.cursor()
+    cur.execute(sql.SQL('{} {}.{}').format(sql.SQL(command), sql.Identifier(schema), sql.Identifier(table)))
+    cur.close()
+    seconds = time.monotonic() - start
+    print(f'{command} {schema}.{table} ({size / MB:.1f}MB) took {seconds:.1f}s')
+    return {'schema': schema, 'table': table, 'bytes': size, 'seconds': seconds}
+
 def vacuum_analyze_tables(instance_username, instance_password, instance_port, env_path, args):
-    print(f'Vacuum and analyze for tables on database, {args.database}, on cluster {args.endpoint} on port {instance_port}')
-    connection = None
-    db_found = False
+    if args.maintenance == 'none':
+        return []
+    command = MAINTENANCE_COMMANDS[args.maintenance]
+    print(f'Running {command} for tables on database, {args.database}, on cluster {args.endpoint} on port {instance_port} with {args.maintenance_jobs} workers')
+    conn_string = f'user={instance_username} password={instance_password} host={args.endpoint} port={instance_port} dbname={args.database}'
+    results = []
+    connections = []
     try:
-        conn_string = f'user={instance_username} password={instance_password} host={args.endpoint} port={instance_port} dbname={args.database}'
         connection = psycopg2.connect(conn_string)
-        print('Connected to database')
-    except Exception as e:
-        print('Unable to connect to database')
-        print(e)
-    try:
-        if connection is not None:
-            connection.autocommit = True
-            print("hi")
-            cur = connection.cursor()
-            cur.execute("SELECT table_schema,table_name FROM information_schema.tables WHERE table_schema = 'public' ORDER BY table_schema,table_name")
-            cur_result = cur.fetchall()
-            print(cur_result)
-            for row in cur_result:
-                print(f'Vacuum and analyze table: {row[1]}')
-                cur.execute("VACUUM(FULL, ANALYZE, VERBOSE) " + row[1])
-        cur.close()
+        tables = get_maintenance_tables(connection)
         connection.close()
+        if args.table or args.schema:
+            tables = [(schema, table, size) for schema, table, size in tables
+                if is_selected_table(schema, table, set(args.table or []), set(args.schema or []))]
+
+        local = threading.local()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.maintenance_jobs) as executor:
+            futures = {executor.submit(maintain_table, conn_string, connections, local, command, schema, table, size):
+                f'{schema}.{table}' for schema, table, size in tables}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    args.report.error(f'Exception during {command} of table {futures[future]} on database {args.database}', e)
     except Exception as e:
-            print(f'Exception during vacuum and analyze tables on database {args.database} on cluster {args.endpoint}')
-            print(e)
-    return db_found
+            args.report.error(f'Exception during {command} of tables on database {args.database} on cluster {args.endpoint}', e)
+    finally:
+        for connection in connections:
+            connection.close()
+    return results
 
 def perform_roles_backup(backup_type, instance_username, instance_password, instance_port, env_path, current_time, args):
     print(f'Backing up roles from cluster {args.endpoint}')
@@ -235,112 +1581,1790 @@ def perform_roles_backup(backup_type, instance_username, instance_password, inst
 
         proc2 = subprocess.Popen(command2, shell=True, stdin=proc1.stdout, stdout=subprocess.PIPE)
         proc2.wait()
+        proc1.wait()
+        if proc1.returncode != 0 or proc2.returncode != 0:
+            args.report.error(f'Roles dump exited with {proc1.returncode}, upload with {proc2.returncode}')
     except Exception as e:
-        print(f'Exception during dump of roles data from cluster {args.endpoint}')
-        print(e)
+        args.report.error(f'Exception during dump of roles data from cluster {args.endpoint}', e)
+
+def hash_file(full_path, block_size):
+    # the whole file's sha256, plus one per block for verify to check with ranged reads
+    sha256 = hashlib.sha256()
+    blocks = []
+    with open(full_path, 'rb') as f:
+        while True:
+            block_sha256 = hashlib.sha256()
+            length = 0
+            while length < block_size:
+                chunk = f.read(min(MB, block_size - length))
+                if not chunk:
+                    break
+                sha256.update(chunk)
+                block_sha256.update(chunk)
+                length += len(chunk)
+            if length:
+                blocks.append([length, block_sha256.hexdigest()])
+            if length < block_size:
+                break
+    return sha256.hexdigest(), blocks
+
+def get_block_ranges(blocks):
+    offset = 0
+    for length, sha256 in blocks:
+        yield offset, length, sha256
+        offset += length
 
-def copy_to_s3(backup_type, current_time, args):
-    s3_resource = boto3.resource('s3', region_name=args.region)
+def get_upload_parts(results):
+    # part results carry their checksums for the manifest, S3 only takes number and etag
+    parts = [{'PartNumber': result['PartNumber'], 'ETag': result['ETag']} for result in results]
+    return parts, [[result['Size'], result['SHA256']] for result in results]
+
+def get_part_size(file_size, min_part_size=S3_MIN_PART_SIZE):
+    # smallest whole-MB part size that keeps the object within the S3 part count limit
+    part_size = math.ceil(math.ceil(file_size / S3_MAX_PARTS) / MB) * MB
+    return min(max(part_size, min_part_size), S3_MAX_PART_SIZE)
+
+class BandwidthLimiter:
+    def __init__(self, max_bytes_per_second):
+        self.max_bytes_per_second = max_bytes_per_second
+        self.lock = threading.Lock()
+        self.next_available = time.monotonic()
+
+    def consume(self, amount):
+        # reserve a slot for this amount of data and sleep until it is reached
+        with self.lock:
+            now = time.monotonic()
+            start = max(self.next_available, now)
+            self.next_available = start + amount / self.max_bytes_per_second
+        if start > now:
+            time.sleep(start - now)
+
+class Budget:
+    """Units that may be in use at once, e.g. bytes of stream parts or pg_dump jobs; acquire blocks until they free up."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.in_use = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, amount):
+        with self.condition:
+            # a part larger than the whole budget still goes through on its own
+            self.condition.wait_for(lambda: self.in_use == 0 or self.in_use + amount <= self.max_bytes)
+            self.in_use += amount
+
+    def release(self, amount):
+        with self.condition:
+            self.in_use -= amount
+            self.condition.notify_all()
+
+class S3UploadStream:
+    """Write-only file object that uploads into one multipart upload without touching disk.
+
+    Each part is buffered until full, then uploaded from the engine pool within the
+    engine's stream memory budget. Part size doubles every thousand parts, so an
+    object of unknown size stays within the S3 part count limit.
+    """
+
+    def __init__(self, engine, bucket, key, extra_args):
+        self.engine = engine
+        self.bucket = bucket
+        self.key = key
+        self.upload_id = engine.client.create_multipart_upload(Bucket=bucket, Key=key, **extra_args)['UploadId']
+        self.buffer = bytearray()
+        self.parts = []
+        self.size = 0
+        self.start = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def get_part_size(self):
+        part_size = self.engine.part_size * 2 ** (len(self.parts) // 1000)
+        return min(part_size, S3_MAX_PART_SIZE)
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.get_part_size():
+            part_size = self.get_part_size()
+            self._submit_part(bytes(self.buffer[:part_size]))
+            del self.buffer[:part_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _submit_part(self, data):
+        self.engine.stream_budget.acquire(len(data))
+        self.size += len(data)
+        future = self.engine.executor.submit(self.engine._upload_stream_part, self.bucket, self.key,
+            self.upload_id, len(self.parts) + 1, data)
+        future.add_done_callback(lambda f, amount=len(data): self.engine.stream_budget.release(amount))
+        self.parts.append(future)
+
+    def close(self):
+        # the last part may be short, and an empty stream still needs one part
+        if self.buffer or not self.parts:
+            self._submit_part(bytes(self.buffer))
+            self.buffer = bytearray()
+        try:
+            parts, blocks = get_upload_parts([future.result() for future in self.parts])
+            response = self.engine.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key,
+                UploadId=self.upload_id, MultipartUpload={'Parts': parts})
+        except Exception:
+            self.abort()
+            raise
+        self.engine._record('upload', self.key, self.size, self.start)
+        # kept for the manifest, a with block has no other way to hand it back
+        self.result = {'key': self.key, 'size': self.size, 'etag': response['ETag'], 'blocks': blocks}
+        return self.result
+
+    def abort(self):
+        for future in self.parts:
+            future.cancel()
+        concurrent.futures.wait(self.parts)
+        self.engine.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+class S3DownloadStream:
+    """Read-only file object over a single GET, throttled and recorded like other transfers."""
+
+    def __init__(self, engine, bucket, key):
+        self.engine = engine
+        self.key = key
+        self.body = engine.client.get_object(Bucket=bucket, Key=key)['Body']
+        self.size = 0
+        self.start = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read(self, amount=-1):
+        data = self.body.read(None if amount is None or amount < 0 else amount)
+        self.engine._throttle(len(data))
+        self.size += len(data)
+        return data
+
+    def close(self):
+        self.body.close()
+        self.engine._record('download', self.key, self.size, self.start)
+
+class TransferJournal:
+    """Append-only checkpoint of finished files, multipart uploads and parts, and downloaded ranges.
+
+    Every event is flushed and fsynced before the work it records is treated as done, so a
+    rerun of the same operation and timestamp can replay it and skip what already finished.
+    """
+
+    def __init__(self, path, resume):
+        self.path = path
+        self.lock = threading.Lock()
+        self.files = {}
+        self.uploads = {}
+        self.downloads = {}
+        self.steps = {}
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        self._apply(json.loads(line))
+                    except ValueError:
+                        # the last line may be torn by whatever stopped the previous attempt
+                        break
+            print(f'Resuming from {path}: {len(self.files)} files and {len(self.steps)} steps already done')
+        self.journal_file = open(path, 'a' if resume else 'w')
+
+    def _apply(self, event):
+        if event['event'] == 'file':
+            self.files[event['key']] = event['result']
+        elif event['event'] == 'upload':
+            self.uploads[event['key']] = {**event, 'parts': {}}
+        elif event['event'] == 'part' and self.uploads.get(event['key'], {}).get('upload_id') == event['upload_id']:
+            self.uploads[event['key']]['parts'][event['part']['PartNumber']] = event['part']
+        elif event['event'] == 'download':
+            self.downloads[event['key']] = {**event, 'offsets': set()}
+        elif event['event'] == 'range' and event['key'] in self.downloads:
+            self.downloads[event['key']]['offsets'].add(event['offset'])
+        elif event['event'] == 'step':
+            self.steps[event['name']] = event
+        elif event['event'] == 'reset':
+            self.files, self.uploads, self.downloads, self.steps = {}, {}, {}, {}
+
+    def record(self, event):
+        with self.lock:
+            self._apply(event)
+            self.journal_file.write(json.dumps(event) + '\n')
+            self.journal_file.flush()
+            os.fsync(self.journal_file.fileno())
+
+    def reset(self):
+        if self.files or self.uploads or self.downloads or self.steps:
+            self.record({'event': 'reset'})
+
+    def get_file(self, key, size):
+        result = self.files.get(key)
+        return result if result is not None and result['size'] == size else None
+
+    def remove(self):
+        self.journal_file.close()
+        os.remove(self.path)
+
+def get_journal_path(cluster, database, timestamp, operation):
+    return f'/tmp/{cluster}-{database}-{timestamp}-{operation}.journal'
+
+def get_latest_journal_timestamp(cluster, database, operation, journal_dir='/tmp'):
+    # the timestamp is matched exactly, so db does not pick up the journals of db-archive
+    pattern = re.compile(re.escape(f'{cluster}-{database}-') + r'(\d{8}T\d{6}Z)' + re.escape(f'-{operation}.journal'))
+    timestamps = sorted(match.group(1) for match in map(pattern.fullmatch, os.listdir(journal_dir)) if match)
+    return timestamps[-1] if timestamps else None
+
+class TransferEngine:
+    """Single bounded worker pool and S3 client shared by every transfer of a run.
+
+    Files below MULTIPART_THRESHOLD are one request each; larger files are split into
+    parts sized by get_part_size from a part_size floor, and every part is a task in the same pool, so total
+    concurrency stays at max_concurrency however many files are in flight. With a journal, finished
+    files and parts are checkpointed and skipped on a rerun, and failed multipart uploads are left
+    open to be resumed.
+    """
+
+    def __init__(self, region, max_concurrency=16, max_bandwidth=None, endpoint_url=None, part_size=S3_MIN_PART_SIZE,
+                 stream_memory=256 * MB, journal=None):
+        config = Config(max_pool_connections=max_concurrency,
+                        retries={'max_attempts': 10, 'mode': 'adaptive'})
+        self.client = boto3.session.Session().client('s3', region_name=region,
+                        endpoint_url=endpoint_url, config=config)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency)
+        # work that waits on transfers, e.g. compressing or hashing before an upload,
+        # runs here so it never holds a slot in the transfer pool
+        self.staging_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency)
+        self.limiter = BandwidthLimiter(max_bandwidth) if max_bandwidth else None
+        self.part_size = part_size
+        self.stream_budget = Budget(stream_memory)
+        self.journal = journal
+        self.lock = threading.Lock()
+        self.bytes_transferred = 0
+        self.transfers = []
+        self.first_byte = None
+
+    def shutdown(self):
+        self.staging_executor.shutdown(wait=True)
+        self.executor.shutdown(wait=True)
+
+    def with_journal(self, journal):
+        # the same client, pools and limits, checkpointing into another journal
+        engine = copy.copy(self)
+        engine.journal = journal
+        return engine
+
+    def list_objects(self, bucket, prefix):
+        objects = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            objects.extend(page.get('Contents', []))
+        return objects
+
+    def _throttle(self, amount):
+        if self.limiter is not None:
+            self.limiter.consume(amount)
+        with self.lock:
+            self.bytes_transferred += amount
+            if self.first_byte is None:
+                self.first_byte = time.monotonic()
+
+    def _record(self, direction, key, size, start):
+        with self.lock:
+            self.transfers.append({'direction': direction, 'key': key, 'bytes': size,
+                'seconds': time.monotonic() - start})
+
+    def _record_file(self, result):
+        if self.journal is not None:
+            self.journal.record({'event': 'file', 'key': result['key'], 'result': result})
+        return result
+
+    def _run_parts(self, future, part_tasks, on_complete, on_failure):
+        # fan parts out to the shared pool; the last part to finish settles the file future
+        results = [None] * len(part_tasks)
+        remaining = [len(part_tasks)]
+        errors = []
+        if not part_tasks:
+            # every part was done by an earlier attempt
+            future.set_result(on_complete(results))
+            return
+
+        def part_done(index, task):
+            try:
+                results[index] = task.result()
+            except Exception as e:
+                errors.append(e)
+            with self.lock:
+                remaining[0] -= 1
+                finished = remaining[0] == 0
+            if not finished:
+                return
+            try:
+                if errors:
+                    on_failure()
+                    future.set_exception(errors[0])
+                else:
+                    future.set_result(on_complete(results))
+            except Exception as e:
+                future.set_exception(e)
+
+        for index, (fn, fn_args) in enumerate(part_tasks):
+            task = self.executor.submit(fn, *fn_args)
+            task.add_done_callback(functools.partial(part_done, index))
+
+    def _read_range(self, full_path, offset, length):
+        with open(full_path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        self._throttle(len(data))
+        return data
+
+    def _put_object(self, full_path, bucket, key, size, extra_args, start):
+        data = self._read_range(full_path, 0, size)
+        response = self.client.put_object(Bucket=bucket, Key=key, Body=data, **extra_args)
+        self._record('upload', key, size, start)
+        return self._record_file({'key': key, 'size': size, 'etag': response['ETag'],
+                'blocks': [[size, hashlib.sha256(data).hexdigest()]]})
+
+    def _upload_part(self, full_path, bucket, key, upload_id, part_number, offset, length):
+        data = self._read_range(full_path, offset, length)
+        part = self._upload_part_data(bucket, key, upload_id, part_number, data)
+        if self.journal is not None:
+            self.journal.record({'event': 'part', 'key': key, 'upload_id': upload_id, 'part': part})
+        return part
+
+    def _get_resumable_upload(self, bucket, key, size, part_size):
+        # parts the journal recorded that S3 still holds, for an upload that was neither completed nor aborted
+        upload = self.journal.uploads.get(key) if self.journal is not None else None
+        if upload is None or upload['size'] != size or upload['part_size'] != part_size:
+            return None, {}
+        try:
+            held = {}
+            for page in self.client.get_paginator('list_parts').paginate(Bucket=bucket, Key=key,
+                    UploadId=upload['upload_id']):
+                held.update({part['PartNumber']: part['ETag'] for part in page.get('Parts', [])})
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchUpload'):
+                return None, {}
+            raise e
+        return upload['upload_id'], {number: part for number, part in upload['parts'].items()
+            if held.get(number) == part['ETag']}
+
+    def _upload_stream_part(self, bucket, key, upload_id, part_number, data):
+        self._throttle(len(data))
+        return self._upload_part_data(bucket, key, upload_id, part_number, data)
+
+    def _upload_part_data(self, bucket, key, upload_id, part_number, data):
+        response = self.client.upload_part(Bucket=bucket, Key=key, UploadId=upload_id,
+            PartNumber=part_number, Body=data)
+        return {'PartNumber': part_number, 'ETag': response['ETag'], 'Size': len(data),
+                'SHA256': hashlib.sha256(data).hexdigest()}
+
+    def _start_multipart_upload(self, future, full_path, bucket, key, size, extra_args, start):
+        part_size = get_part_size(size, self.part_size)
+        try:
+            upload_id, done_parts = self._get_resumable_upload(bucket, key, size, part_size)
+            if upload_id is None:
+                upload_id = self.client.create_multipart_upload(Bucket=bucket, Key=key,
+                    **extra_args)['UploadId']
+                if self.journal is not None:
+                    self.journal.record({'event': 'upload', 'key': key, 'upload_id': upload_id,
+                        'size': size, 'part_size': part_size})
+        except Exception as e:
+            future.set_exception(e)
+            return
+        # parts finished by an earlier attempt resolve straight from the journal
+        if done_parts:
+            print(f'Resuming upload of {key} with {len(done_parts)} parts already done')
+        part_tasks = [(done_parts.get, (part_number + 1,)) if part_number + 1 in done_parts else
+            (self._upload_part, (full_path, bucket, key, upload_id, part_number + 1,
+            offset, min(part_size, size - offset)))
+            for part_number, offset in enumerate(range(0, size, part_size))]
+
+        def complete(results):
+            parts, blocks = get_upload_parts(results)
+            response = self.client.complete_multipart_upload(Bucket=bucket, Key=key,
+                UploadId=upload_id, MultipartUpload={'Parts': parts})
+            self._record('upload', key, size - sum(part['Size'] for part in done_parts.values()), start)
+            return self._record_file({'key': key, 'size': size, 'etag': response['ETag'], 'blocks': blocks})
+
+        def abort():
+            # a journaled upload stays open for the rerun, the bucket lifecycle aborts what is never resumed
+            if self.journal is None:
+                self.client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+
+        self._run_parts(future, part_tasks, complete, abort)
+
+    def open_upload_stream(self, bucket, key, extra_args=None):
+        return S3UploadStream(self, bucket, key, extra_args or {})
+
+    def open_download_stream(self, bucket, key):
+        return S3DownloadStream(self, bucket, key)
+
+    def _get_finished(self, key, size):
+        # a file an earlier attempt finished, as an already resolved future
+        result = self.journal.get_file(key, size) if self.journal is not None else None
+        if result is None:
+            return None
+        future = concurrent.futures.Future()
+        future.set_result(result)
+        return future
+
+    def upload_file(self, full_path, bucket, key, extra_args=None):
+        extra_args = extra_args or {}
+        size = os.path.getsize(full_path)
+        finished = self._get_finished(key, size)
+        if finished is not None:
+            return finished
+        start = time.monotonic()
+        if size < MULTIPART_THRESHOLD:
+            return self.executor.submit(self._put_object, full_path, bucket, key, size, extra_args, start)
+        future = concurrent.futures.Future()
+        self.executor.submit(self._start_multipart_upload, future, full_path, bucket, key,
+            size, extra_args, start)
+        return future
+
+    def _get_range(self, bucket, key, full_path, offset, length):
+        response = self.client.get_object(Bucket=bucket, Key=key,
+            Range=f'bytes={offset}-{offset + length - 1}')
+        with open(full_path, 'r+b') as f:
+            f.seek(offset)
+            for chunk in response['Body'].iter_chunks(chunk_size=MB):
+                self._throttle(len(chunk))
+                f.write(chunk)
+            if self.journal is not None:
+                # the range only counts as done once it is on disk
+                f.flush()
+                os.fsync(f.fileno())
+                self.journal.record({'event': 'range', 'key': key, 'offset': offset})
+
+    def _get_object(self, bucket, key, full_path, size, start):
+        response = self.client.get_object(Bucket=bucket, Key=key)
+        with open(full_path, 'wb') as f:
+            for chunk in response['Body'].iter_chunks(chunk_size=MB):
+                self._throttle(len(chunk))
+                f.write(chunk)
+            if self.journal is not None:
+                f.flush()
+                os.fsync(f.fileno())
+        self._record('download', key, size, start)
+        return self._record_file({'key': key, 'size': size})
+
+    def download_file(self, bucket, key, full_path, size):
+        if os.path.exists(full_path) and os.path.getsize(full_path) == size:
+            finished = self._get_finished(key, size)
+            if finished is not None:
+                return finished
+        start = time.monotonic()
+        if size < MULTIPART_THRESHOLD:
+            return self.executor.submit(self._get_object, bucket, key, full_path, size, start)
+        part_size = get_part_size(size, self.part_size)
+        download = self.journal.downloads.get(key) if self.journal is not None else None
+        if download is not None and download['size'] == size and download['part_size'] == part_size \
+                and os.path.exists(full_path) and os.path.getsize(full_path) == size:
+            done_offsets = download['offsets']
+            print(f'Resuming download of {key} with {len(done_offsets)} parts already done')
+        else:
+            # preallocate so ranged parts can be written in place in any order
+            with open(full_path, 'wb') as f:
+                f.truncate(size)
+            done_offsets = set()
+            if self.journal is not None:
+                self.journal.record({'event': 'download', 'key': key, 'size': size, 'part_size': part_size})
+        part_tasks = [(self._get_range, (bucket, key, full_path, offset, min(part_size, size - offset)))
+            for offset in range(0, size, part_size) if offset not in done_offsets]
+
+        def complete(results):
+            self._record('download', key, size - sum(min(part_size, size - offset) for offset in done_offsets), start)
+            return self._record_file({'key': key, 'size': size})
+
+        future = concurrent.futures.Future()
+        self._run_parts(future, part_tasks, complete, lambda: None)
+        return future
+
+    def _hash_range(self, bucket, key, offset, length):
+        response = self.client.get_object(Bucket=bucket, Key=key,
+            Range=f'bytes={offset}-{offset + length - 1}')
+        sha256 = hashlib.sha256()
+        for chunk in response['Body'].iter_chunks(chunk_size=MB):
+            self._throttle(len(chunk))
+            sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def hash_range(self, bucket, key, offset, length):
+        # read and hashed in memory, verify never lands backup data on disk
+        return self.executor.submit(self._hash_range, bucket, key, offset, length)
+
+    def object_exists(self, bucket, key):
+        try:
+            self.client.head_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise e
+        return True
+
+    def _refresh_object(self, bucket, key, size, extra_args):
+        # an in-place copy restarts the object's age without moving data off S3, so prune's grace
+        # period covers a reused blob until the backup reusing it has written its manifest
+        copy_args = {'MetadataDirective': 'REPLACE', **extra_args}
+        if size <= S3_MAX_COPY_SIZE:
+            self.client.copy_object(Bucket=bucket, Key=key, CopySource={'Bucket': bucket, 'Key': key}, **copy_args)
+        else:
+            self.client.copy({'Bucket': bucket, 'Key': key}, bucket, key, ExtraArgs=copy_args)
+
+    def upload_content_addressed(self, full_path, bucket, blob_prefix, extra_args):
+        size = os.path.getsize(full_path)
+        # hashed locally, a reused blob has no upload to take part checksums from
+        sha256, blocks = hash_file(full_path, get_part_size(size, self.part_size))
+        key = f'{blob_prefix}/{sha256[:2]}/{sha256}'
+        uploaded = not self.object_exists(bucket, key)
+        if uploaded:
+            self.upload_file(full_path, bucket, key, {**extra_args, 'Tagging': BLOB_TAGGING}).result()
+        else:
+            self._refresh_object(bucket, key, size, extra_args)
+        return {'key': key, 'size': size, 'sha256': sha256, 'uploaded': uploaded, 'blocks': blocks}
+
+
+def get_transfer_engine(args):
+    if worker_cache is not None:
+        return worker_cache.get_engine(args)
+    max_bandwidth = args.max_bandwidth * MB if args.max_bandwidth else None
+    return TransferEngine(args.region, max_concurrency=args.transfer_concurrency,
+        max_bandwidth=max_bandwidth, part_size=args.part_size * MB, stream_memory=args.stream_memory * MB,
+        journal=args.journal)
+
+def wait_for_transfers(futures, bucket):
+    failed = []
+    for key, future in futures.items():
+        try:
+            future.result()
+        except Exception as e:
+            print(f'Exception during transfer of {key} with bucket {bucket}')
+            print(e)
+            failed.append(key)
+    return failed
+
+def stage_backup_file(engine, full_path, s3_prefix, args, remove):
+    if args.codec['method'] == 'stream' and full_path.endswith('.dat') and not full_path.endswith('/toc.dat'):
+        full_path = compress_file(full_path, args.codec)
+    extra_args = {'ContentType': 'application/x-compressed'}
+    if args.incremental:
+        # stored once per content under the database's blob prefix, referenced from manifest.json
+        blob_prefix = f'{s3_prefix.rsplit("/", 1)[0]}/blobs'
+        result = engine.upload_content_addressed(full_path, args.bucket, blob_prefix, extra_args)
+    else:
+        result = engine.upload_file(full_path, args.bucket, f'{s3_prefix}/{os.path.basename(full_path)}',
+            extra_args).result()
+    # only free local disk once the upload is confirmed
+    if remove:
+        os.remove(full_path)
+    return {**result, 'file': os.path.basename(full_path)}
+
+def prune_blobs(engine, s3_prefix, args):
+    # manifests are kept as long as their backups, so only a blob no manifest references can go, and only
+    # once it is older than the grace period: a running backup uploads or refreshes its blobs before its manifest
+    blobs, manifests = [], []
+    for obj in engine.list_objects(args.bucket, s3_prefix):
+        if BLOB_KEY_PATTERN.search(obj['Key']):
+            blobs.append(obj)
+        elif obj['Key'].endswith('/manifest.json'):
+            manifests.append(obj['Key'][:-len('/manifest.json')])
+    referenced = set()
+    # a manifest that cannot be read raises here, before anything is deleted
+    for manifest in engine.executor.map(lambda prefix: get_remote_manifest(engine, prefix, args), manifests):
+        referenced.update(backup_file['key'] for backup_file in manifest.get('files', {}).values())
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=args.prune_grace_days)
+    unreferenced = [obj for obj in blobs if obj['Key'] not in referenced]
+    expired = [obj for obj in unreferenced if obj['LastModified'] < cutoff]
+    size = sum(obj['Size'] for obj in expired)
+    print(f'{len(manifests)} manifests under {s3_prefix} reference {len(blobs) - len(unreferenced)} of {len(blobs)} blobs, '
+          f'{len(unreferenced) - len(expired)} unreferenced blobs are within the grace period, '
+          f'{"would delete" if args.dry_run else "deleting"} {len(expired)} ({size / MB:.1f}MB)')
+    if not args.dry_run:
+        for start in range(0, len(expired), S3_MAX_DELETE_KEYS):
+            response = engine.client.delete_objects(Bucket=args.bucket, Delete={'Quiet': True, 'Objects': [
+                {'Key': obj['Key']} for obj in expired[start:start + S3_MAX_DELETE_KEYS]]})
+            for error in response.get('Errors', []):
+                args.report.error(f'Could not delete blob {error["Key"]}: {error["Message"]}')
+    return {'bytes': size}
+
+def upload_backup_file(engine, full_path, s3_prefix, args, remove=False):
+    # compression and hashing run on the staging pool, ahead of the transfer pool
+    return engine.staging_executor.submit(stage_backup_file, engine, full_path, s3_prefix, args, remove)
+
+def upload_backup_index(engine, input_path, s3_prefix, uploads, args):
+    # manifest.json and then toc.dat, once every data file is in place
+    manifest = read_manifest(input_path)
+    manifest['compression'] = args.codec
+    files = {result['file']: result for result in (future.result() for future in uploads.values())}
+    if args.incremental:
+        reused = sum(1 for backup_file in files.values() if not backup_file['uploaded'])
+        print(f'Incremental backup reused {reused} of {len(uploads)} unchanged data files')
+    # toc.dat is uploaded after the manifest, so its checksums are taken from the local copy
+    toc_size = os.path.getsize(f'{input_path}/toc.dat')
+    toc_sha256, toc_blocks = hash_file(f'{input_path}/toc.dat', get_part_size(toc_size, engine.part_size))
+    manifest['files'] = {**manifest.get('files', {}), **files, 'toc.dat': {'key': f'{s3_prefix}/toc.dat',
+        'size': toc_size, 'sha256': toc_sha256, 'blocks': toc_blocks, 'file': 'toc.dat'}}
+    add_backup_summary(manifest, try_build_toc_index(engine, s3_prefix, input_path, manifest, args), args)
+    write_manifest(input_path, manifest)
+    engine.upload_file(f'{input_path}/manifest.json', args.bucket, f'{s3_prefix}/manifest.json',
+        extra_args={'ContentType': 'application/json'}).result()
+    engine.upload_file(f'{input_path}/toc.dat', args.bucket, f'{s3_prefix}/toc.dat',
+        extra_args={'ContentType': 'application/x-compressed'}).result()
+
+def copy_to_s3(engine, backup_type, current_time, args):
     # get file list
     input_path = f'/tmp/{args.cluster}-{args.database}-{current_time}'
+    s3_prefix = f'{backup_type}/{args.cluster}/{args.database}/{current_time}'
 
+    uploads = {}
     for filepath in pathlib.Path(input_path).glob('**/*'):
-        full_path = str(filepath.absolute())
-        file_name = str(filepath.name)
-        s3_key_name = f'{backup_type}/{args.cluster}/{args.database}/{current_time}/{file_name}'
+        # toc.dat goes last so a prefix that has it holds the complete backup
+        if filepath.name in ('toc.dat', 'manifest.json') or not filepath.is_file():
+            continue
+        if filepath.name.endswith(PARTIAL_SUFFIX):
+            # left by an interrupted compression, whose source file is still staged
+            filepath.unlink()
+            continue
+        uploads[filepath.name] = upload_backup_file(engine, str(filepath.absolute()), s3_prefix, args)
+    failed = wait_for_transfers(uploads, args.bucket)
+    if failed:
+        args.report.error(f'{len(failed)} files were not copied to {args.bucket}, not marking backup complete')
+    else:
         try:
-            config = TransferConfig(multipart_threshold=1024 * 25, 
-                        max_concurrency=8,
-                        multipart_chunksize=1024 * 25,
-                        use_threads=True)
-
-            s3_resource.Object(args.bucket, s3_key_name).upload_file(full_path,
-                ExtraArgs={'ContentType': 'application/x-compressed'},
-                Config=config
-                )
+            upload_backup_index(engine, input_path, s3_prefix, uploads, args)
         except Exception as e:
-            print(f'Exception during copy of {s3_key_name} to {args.bucket}')
-            print(e)
+            args.report.error(f'Exception during copy of manifest and toc.dat to {args.bucket}', e)
+            failed = ['manifest.json', 'toc.dat']
+    if failed:
+        print(f'Keeping {input_path}, rerun with --resume -t {current_time} to finish the upload')
+        return
     # clean up files once copied 
     shutil.rmtree(input_path)
 
-def copy_from_s3(backup_type, args):
-    s3_resource = boto3.resource('s3', region_name=args.region)
-    bucket = s3_resource.Bucket(args.bucket)
+def get_backup_objects(engine, s3_prefix, restore_path, args):
+    # files under the timestamp prefix, plus the blobs an incremental manifest points at
+    objects = {obj['Key'].rsplit('/', 1)[-1]: obj for obj in engine.list_objects(args.bucket, f'{s3_prefix}/')}
+    if 'manifest.json' in objects:
+        engine.download_file(args.bucket, objects['manifest.json']['Key'], f'{restore_path}/manifest.json',
+            objects['manifest.json']['Size']).result()
+        for file_name, backup_file in read_manifest(restore_path).get('files', {}).items():
+            objects.setdefault(file_name, {'Key': backup_file['key'], 'Size': backup_file['size']})
+    return objects
+
+def decompress_download(full_path, codec, args):
+    decompress_file(full_path, codec)
+    if args.journal is not None:
+        args.journal.record({'event': 'step', 'name': f'decompress:{os.path.basename(full_path)}'})
+
+def copy_from_s3(engine, backup_type, args):
     # get file list
     s3_prefix = f'{backup_type}/{args.cluster}/{args.database}/{args.timestamp}'
     download_dir = f'/tmp/{args.cluster}-{args.database}-{args.timestamp}'
     pathlib.Path(download_dir).mkdir(parents=True, exist_ok=True)
 
     print(f'Downloading from s3 prefix of {s3_prefix}')
-    prefix_objs = bucket.objects.filter(Prefix=s3_prefix)
-    for obj in prefix_objs:
+    downloads = {}
+    for s3_file_name, obj in get_backup_objects(engine, s3_prefix, download_dir, args).items():
+        if s3_file_name == 'manifest.json':
+            continue
+        if args.journal is not None and f'decompress:{s3_file_name}' in args.journal.steps:
+            # downloaded and decompressed by an earlier attempt
+            continue
+        download_full_path = f'{download_dir}/{s3_file_name}'
+        downloads[obj['Key']] = engine.download_file(args.bucket, obj['Key'], download_full_path, obj['Size'])
+    failed = wait_for_transfers(downloads, args.bucket)
+    if failed:
+        args.report.error(f'{len(failed)} files were not copied from {args.bucket}')
+
+    # undo compression that was applied after pg_dump, so pg_restore sees plain .dat files
+    manifest = read_manifest(download_dir)
+    codec = get_backup_codec(manifest)
+    if codec['method'] == 'stream':
+        shard_chunks = get_shard_chunks(manifest)
+        decompressions = {file_path.name: engine.staging_executor.submit(decompress_download, str(file_path), codec, args)
+            for file_path in pathlib.Path(download_dir).glob(f'*.dat{CODECS[codec["codec"]]["suffix"]}')
+            if file_path.name not in shard_chunks}
+        failed = wait_for_transfers(decompressions, args.bucket)
+        if failed:
+            args.report.error(f'{len(failed)} files could not be decompressed')
+
+def check_backup_objects(engine, s3_prefix, manifest, args):
+    # sizes and etags from one listing; blobs outside the prefix take a head request each
+    listed = {obj['Key']: obj for obj in engine.list_objects(args.bucket, f'{s3_prefix}/')}
+    heads = {file_name: engine.executor.submit(engine.client.head_object, Bucket=args.bucket, Key=backup_file['key'])
+        for file_name, backup_file in manifest['files'].items() if backup_file['key'] not in listed}
+    present = {}
+    for file_name, backup_file in manifest['files'].items():
+        if file_name in heads:
+            try:
+                response = heads[file_name].result()
+            except ClientError as e:
+                args.report.error(f'{file_name} is missing from {args.bucket}/{backup_file["key"]}', e)
+                continue
+            obj = {'Size': response['ContentLength'], 'ETag': response['ETag']}
+        else:
+            obj = listed[backup_file['key']]
+        if obj['Size'] != backup_file['size']:
+            args.report.error(f'{file_name} is {obj["Size"]} bytes, the manifest has {backup_file["size"]}')
+        elif backup_file.get('etag') and obj['ETag'] != backup_file['etag']:
+            args.report.error(f'{file_name} has etag {obj["ETag"]}, the manifest has {backup_file["etag"]}')
+        else:
+            present[file_name] = backup_file
+    return present
+
+def verify_backup_blocks(engine, files, args):
+    # every block is a ranged GET on the shared pool, largest files first
+    checks = {}
+    for file_name, backup_file in sorted(files.items(), key=lambda item: item[1]['size'], reverse=True):
+        blocks = list(get_block_ranges(backup_file['blocks']))
+        for index, (offset, length, sha256) in enumerate(blocks):
+            # the first and last block are always read, so a truncated file shows up at any sample rate
+            if length == 0 or (0 < index < len(blocks) - 1 and random.random() * 100 >= args.verify_sample):
+                continue
+            future = engine.hash_range(args.bucket, backup_file['key'], offset, length)
+            checks[future] = (file_name, offset, length, sha256)
+    verified = 0
+    for future in concurrent.futures.as_completed(checks):
+        file_name, offset, length, sha256 = checks[future]
         try:
-            s3_key_name = obj.key
-            s3_file_name = s3_key_name.rsplit('/', 1)[-1]
-            download_full_path = f'{download_dir}/{s3_file_name}'
-            config = TransferConfig(multipart_threshold=1024 * 25, 
-                        max_concurrency=8,
-                        multipart_chunksize=1024 * 25,
-                        use_threads=True)
-
-            s3_resource.Object(args.bucket, s3_key_name).download_file(download_full_path,
-                        Config=config
-            )
+            if future.result() != sha256:
+                args.report.error(f'{file_name} does not match its checksum at offset {offset}')
+            else:
+                verified += length
         except Exception as e:
-            print(f'Exception during download of {s3_key_name} to {args.bucket}')
+            args.report.error(f'Exception during read of {file_name} at offset {offset}', e)
+    print(f'Checked {len(checks)} blocks, {verified / MB:.1f}MB matched their checksums')
+    return verified
+
+def count_object_rows(engine, key, codec, args):
+    # a full decode without touching disk; COPY text is one row per line
+    lines, tail = 0, b''
+    with engine.open_download_stream(args.bucket, key) as stream:
+        with open_decompressing_stream(stream, codec, check=True) as f:
+            for chunk in iter(functools.partial(f.read, MB), b''):
+                lines += chunk.count(b'\n')
+                tail = (tail + chunk)[-5:]
+    # pg_dump data files end with a \. line and two empty ones
+    return lines - 3 if tail.endswith(b'\\.\n\n\n') else lines
+
+def get_data_file_tables(index, manifest):
+    # data file and COPY chunk names to the table their rows belong to
+    tables = {entry['file']: f'{entry["schema"]}.{entry["name"]}' for entry in index['entries'] if entry.get('file')}
+    file_tables = {}
+    for file_name in manifest['files']:
+        data_file = file_name.split('.dat', 1)[0] + '.dat'
+        if data_file in tables:
+            file_tables[file_name] = tables[data_file]
+    for file_name, shard in get_shard_chunks(manifest).items():
+        file_tables[file_name] = f'{shard["schema"]}.{shard["table"]}'
+    return file_tables
+
+def verify_backup_archive(engine, instance_username, instance_password, instance_port, env_path, s3_prefix, verify_path, manifest, args):
+    # pg_restore -l proves pg_restore can read the toc, then every data stream is decoded
+    codec = get_backup_codec(manifest)
+    list_path = f'{verify_path}/restore.list'
+    if manifest.get('stream'):
+        dump_key = manifest['files'][manifest['stream']['dump']]['key']
+        dump_codec = codec if codec['method'] == 'stream' else CODEC_NONE
+        returncode = restore_stream_section(engine, instance_username, instance_password, instance_port, env_path,
+            f'-l -f {list_path}', dump_key, dump_codec, args)
+        with open(list_path, errors='replace') as f:
+            listed = [parse_toc_entry(line.strip()) for line in f if line.strip() and not line.startswith(';')]
+    else:
+        toc = manifest['files']['toc.dat']
+        engine.download_file(args.bucket, toc['key'], f'{verify_path}/toc.dat', toc['size']).result()
+        listed, returncode = get_toc_entries(env_path, verify_path), 0
+    if returncode != 0:
+        args.report.error(f'pg_restore -l of the backup exited with {returncode}')
+        return 0
+
+    index = get_toc_index(engine, s3_prefix, verify_path, manifest, args)
+    if manifest.get('toc') and manifest['toc']['entries'] != len(index['entries']):
+        args.report.error(f'The toc has {len(index["entries"])} entries, the manifest has {manifest["toc"]["entries"]}')
+    # pg_restore -l leaves out a few header entries, but never a data entry
+    dump_ids = {entry['dump_id'] for entry in listed}
+    unlisted = [entry['dump_id'] for entry in index['entries'] if entry['section'] == 'data' and entry['dump_id'] not in dump_ids]
+    if unlisted or dump_ids - {entry['dump_id'] for entry in index['entries']}:
+        args.report.error(f'pg_restore -l and the toc index disagree, {len(unlisted)} data entries are not listed')
+
+    file_tables = get_data_file_tables(index, manifest)
+    rows = collections.Counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(count_object_rows, engine, manifest['files'][file_name]['key'],
+            codec if file_name.endswith(CODECS[codec['codec']]['suffix']) else CODEC_NONE, args): file_name
+            for file_name in file_tables}
+        if manifest.get('stream'):
+            # the rest of the custom format dump decodes through pg_restore
+            futures[executor.submit(restore_stream_section, engine, instance_username, instance_password,
+                instance_port, env_path, '-f /dev/null', dump_key, dump_codec, args)] = manifest['stream']['dump']
+        for future in concurrent.futures.as_completed(futures):
+            file_name = futures[future]
+            try:
+                if file_name in file_tables:
+                    rows[file_tables[file_name]] += future.result()
+                elif future.result() != 0:
+                    args.report.error(f'pg_restore decode of {file_name} exited with {future.result()}')
+            except Exception as e:
+                args.report.error(f'Exception during decode of {file_name}', e)
+    for name, table in manifest.get('tables', {}).items():
+        if table['exact'] and rows[name] != table['rows']:
+            args.report.error(f'{name} has {rows[name]} rows, the manifest has {table["rows"]}')
+    print(f'Decoded {len(file_tables)} data files with {sum(rows.values())} rows')
+    return sum(rows.values())
+
+def perform_backup_verify(engine, backup_type, instance_username, instance_password, instance_port, env_path, args):
+    print(f'Verifying backup {args.timestamp} of {args.database} against its manifest')
+
+    s3_prefix = f'{backup_type}/{args.cluster}/{args.database}/{args.timestamp}'
+    verify_path = f'/tmp/{args.cluster}-{args.database}-{args.timestamp}'
+    pathlib.Path(verify_path).mkdir(parents=True, exist_ok=True)
+    result = {'bytes': 0, 'rows': 0}
+    errors = len(args.report.report['errors'])
+    try:
+        manifest = get_remote_manifest(engine, s3_prefix, args)
+        if 'toc' not in manifest:
+            args.report.error(f'No manifest with checksums under s3 prefix {s3_prefix}, backup is incomplete or too old to verify')
+            return result
+        files = check_backup_objects(engine, s3_prefix, manifest, args)
+        result['bytes'] = verify_backup_blocks(engine, files, args)
+        if args.deep:
+            result['rows'] = verify_backup_archive(engine, instance_username, instance_password, instance_port,
+                env_path, s3_prefix, verify_path, manifest, args)
+        print(f'Backup {args.timestamp} of {args.database}: {len(manifest["files"])} files, '
+              f'{"failed verification" if len(args.report.report["errors"]) > errors else "verified"}')
+
+    except Exception as e:
+            args.report.error(f'Exception during verify of backup {args.timestamp} of {args.database}', e)
+    finally:
+        shutil.rmtree(verify_path, ignore_errors=True)
+    return result
+
+EMF_NAMESPACE = 'AuroraBackup'
+EMF_METRICS = [('Seconds', 'Seconds'), ('Bytes', 'Bytes'), ('TransferredBytes', 'Bytes'), ('Rows', 'Count'),
+               ('CpuSeconds', 'Seconds'), ('ChildCpuSeconds', 'Seconds'), ('Failed', 'Count')]
+
+def get_cpu_seconds(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+class RunReport:
+    """Wall time, bytes, rows and resource usage of each phase of a run.
+
+    Phases are timed with phase(). An exception leaving a phase, or an error() from the
+    steps that print and carry on, marks the phase and the run as failed.
+    """
+
+    def __init__(self, cluster, database, operation, current_time):
+        self.report = {'cluster': cluster, 'database': database or 'all', 'operation': operation,
+                       'timestamp': current_time, 'status': 'success', 'phases': {}, 'files': [], 'errors': []}
+        self.engine = None
+        self.current = None
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        # the transfer engine can be shared by databases backed up side by side
+        self.key_filter = f'/{cluster}/{database}/' if database else f'/{cluster}/'
+
+    @property
+    def failed(self):
+        return self.report['status'] == 'failed'
+
+    def get_transfers(self, start=0):
+        if self.engine is None:
+            return []
+        return [transfer for transfer in self.engine.transfers[start:] if self.key_filter in transfer['key']]
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        entry = {'status': 'success', 'seconds': 0, 'bytes': 0, 'rows': 0}
+        self.report['phases'][name] = entry
+        previous, self.current = self.current, name
+        transfers = len(self.engine.transfers) if self.engine else 0
+        cpu_seconds, child_cpu_seconds = get_cpu_seconds(resource.RUSAGE_SELF), get_cpu_seconds(resource.RUSAGE_CHILDREN)
+        start = time.monotonic()
+        try:
+            yield entry
+        except Exception as e:
+            self.error(f'Exception during {name} phase of {self.report["database"]}', e)
+            raise
+        finally:
+            self.current = previous
+            entry['seconds'] = time.monotonic() - start
+            entry['transferred_bytes'] = sum(transfer['bytes'] for transfer in self.get_transfers(transfers))
+            # pipelined phases only know their size from what was transferred
+            entry['bytes'] = entry['bytes'] or entry['transferred_bytes']
+            entry['mb_per_s'] = entry['bytes'] / MB / max(entry['seconds'], 1e-6)
+            # python threads compress, hash and transfer; pg_dump, pg_restore and codecs are child processes
+            entry['cpu_seconds'] = get_cpu_seconds(resource.RUSAGE_SELF) - cpu_seconds
+            entry['child_cpu_seconds'] = get_cpu_seconds(resource.RUSAGE_CHILDREN) - child_cpu_seconds
+            entry['child_max_rss'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+            print(f'Phase {name} {entry["status"]} in {entry["seconds"]:.1f}s, {entry["bytes"] / MB:.1f}MB, '
+                  f'{entry["rows"]} rows')
+
+    def error(self, message, e=None):
+        print(message)
+        if e is not None:
             print(e)
+        with self.lock:
+            self.report['status'] = 'failed'
+            self.report['errors'].append({'phase': self.current, 'message': message,
+                                          'error': None if e is None else str(e)})
+            if self.current in self.report['phases']:
+                self.report['phases'][self.current]['status'] = 'failed'
 
-def main():
+    def finish(self):
+        self.report['seconds'] = time.monotonic() - self.start
+        # how long the run took to move its first byte to or from s3, cold start included
+        if self.engine is not None and self.engine.first_byte is not None:
+            self.report['ttfb_seconds'] = self.engine.first_byte - self.start
+        if self.engine is not None:
+            self.report['files'] = [{**transfer, 'mb_per_s': transfer['bytes'] / MB / max(transfer['seconds'], 1e-6)}
+                for transfer in self.get_transfers()]
+
+    def write(self, report_path):
+        with open(report_path, 'w') as f:
+            json.dump(self.report, f, indent=2)
+        print(f'Run report written to {report_path}')
+
+def get_emf_events(report):
+    # one event per phase and one for the whole run, each a metric set with its own dimensions
+    timestamp = int(time.time() * 1000)
+    phases = {**report['phases'], 'run': {'seconds': report['seconds'], 'status': report['status'],
+              'bytes': sum(phase['bytes'] for phase in report['phases'].values())}}
+    events = []
+    for name, phase in phases.items():
+        event = {
+            '_aws': {'Timestamp': timestamp, 'CloudWatchMetrics': [{'Namespace': EMF_NAMESPACE,
+                'Dimensions': [['Cluster', 'Database', 'Operation', 'Phase']],
+                'Metrics': [{'Name': metric, 'Unit': unit} for metric, unit in EMF_METRICS]}]},
+            'Cluster': report['cluster'], 'Database': report['database'], 'Operation': report['operation'],
+            'Phase': name, 'Seconds': phase['seconds'], 'Bytes': phase['bytes'],
+            'TransferredBytes': phase.get('transferred_bytes', 0), 'Rows': phase.get('rows', 0),
+            'CpuSeconds': phase.get('cpu_seconds', 0), 'ChildCpuSeconds': phase.get('child_cpu_seconds', 0),
+            'Failed': int(phase['status'] == 'failed'),
+        }
+        events.append({'timestamp': timestamp, 'message': json.dumps(event)})
+    return events
+
+def put_emf_events(report, log_group, region):
+    client = boto3.client('logs', region_name=region)
+    log_stream = f'aurora-operation/{report["cluster"]}/{report["database"]}/{report["timestamp"]}'
+    try:
+        try:
+            client.create_log_stream(logGroupName=log_group, logStreamName=log_stream)
+        except client.exceptions.ResourceNotFoundException:
+            client.create_log_group(logGroupName=log_group)
+            client.create_log_stream(logGroupName=log_group, logStreamName=log_stream)
+        except client.exceptions.ResourceAlreadyExistsException:
+            pass
+        client.put_log_events(logGroupName=log_group, logStreamName=log_stream, logEvents=get_emf_events(report))
+        print(f'Run metrics written to {log_group} stream {log_stream}')
+    except Exception as e:
+        # metrics are best effort, the run's own status stands
+        print(f'Exception during write of run metrics to {log_group}')
+        print(e)
+
+def get_dir_size(path):
+    return sum(file_path.stat().st_size for file_path in pathlib.Path(path).glob('**/*') if file_path.is_file())
+
+def connect(conn_string):
+    # a worker keeps catalog connections open between jobs
+    if worker_cache is not None:
+        return worker_cache.connect(conn_string)
+    return psycopg2.connect(conn_string)
+
+def get_row_count(conn_string):
+    connection = connect(conn_string)
+    try:
+        cur = connection.cursor()
+        cur.execute('SELECT coalesce(sum(n_live_tup), 0) FROM pg_stat_user_tables')
+        return int(cur.fetchone()[0])
+    finally:
+        connection.close()
+
+# connections left free on the database for other sessions during a run
+RESERVED_CONNECTIONS = 5
+# rough compressed-to-table size for disk estimates when the codec is not yet known
+DUMP_SIZE_RATIO = 0.5
+# transfer worker count bounds, and the share of free memory in-flight parts may use
+MIN_TRANSFER_CONCURRENCY = 8
+MAX_TRANSFER_CONCURRENCY = 64
+TRANSFER_MEMORY_SHARE = 0.25
+# memory allowed per pg_dump/pg_restore worker when sizing the ec2 instance
+WORKER_MEMORY = 256 * MB
+# candidate ec2 types for terraform-backup: name, vcpus, memory GB
+EC2_TYPES = [
+    ('m6i.large', 2, 8), ('m6i.xlarge', 4, 16), ('m6i.2xlarge', 8, 32), ('m6i.4xlarge', 16, 64),
+    ('m6i.8xlarge', 32, 128), ('m6i.12xlarge', 48, 192), ('m6i.16xlarge', 64, 256),
+]
+# plan setting and the option that overrides it
+PLAN_SETTINGS = {'dump_jobs': 'dump_jobs', 'restore_jobs': 'jobs', 'transfer_concurrency': 'transfer_concurrency',
+                 'part_size': 'part_size'}
+
+def get_host_resources(path='/tmp'):
+    memory_available = 0
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                memory_available = int(line.split()[1]) * 1024
+    return {'cpus': os.cpu_count() or 1, 'memory_available': memory_available,
+            'disk_free': shutil.disk_usage(path).free}
+
+def get_connection_limits(conn_string):
+    connection = connect(conn_string)
+    try:
+        cur = connection.cursor()
+        cur.execute("SELECT current_setting('max_connections')::int, (SELECT count(*) FROM pg_stat_activity)")
+        max_connections, used_connections = cur.fetchone()
+    finally:
+        connection.close()
+    return {'max_connections': max_connections, 'used_connections': used_connections}
+
+def get_catalog_table_sizes(conn_string):
+    # table data size is what pg_dump -j and pg_restore -j split their work by
+    connection = connect(conn_string)
+    try:
+        cur = connection.cursor()
+        cur.execute("""SELECT s.schemaname || '.' || s.relname, pg_relation_size(s.relid), s.n_live_tup
+                       FROM pg_stat_user_tables s JOIN pg_class c ON c.oid = s.relid
+                       WHERE c.relkind = 'r'
+                       ORDER BY 2 DESC""")
+        return [{'name': name, 'size': size, 'rows': rows} for name, size, rows in cur.fetchall()]
+    finally:
+        connection.close()
+
+def get_backup_table_sizes(s3_prefix, restore_path, args):
+    # restores size their work by the backup's data files, the database may not exist yet
+    pathlib.Path(restore_path).mkdir(parents=True, exist_ok=True)
+    engine = TransferEngine(args.region, max_concurrency=MIN_TRANSFER_CONCURRENCY)
+    try:
+        objects = get_backup_objects(engine, s3_prefix, restore_path, args)
+    finally:
+        engine.shutdown()
+    return sorted([{'name': file_name, 'size': obj['Size']} for file_name, obj in objects.items()
+        if ('.dat' in file_name or file_name.startswith('shard-')) and file_name != 'toc.dat'], key=lambda table: table['size'], reverse=True)
+
+def choose_ec2_type(vcpus, memory):
+    for name, type_vcpus, type_memory in EC2_TYPES:
+        if type_vcpus >= vcpus and type_memory * GB >= memory:
+            return name
+    return EC2_TYPES[-1][0]
+
+def get_expansion_ratio(codec):
+    # staged bytes per byte of backup object; only streamed codecs are decompressed on disk before pg_restore
+    if codec['method'] != 'stream':
+        return 1
+    return 1 / (codec.get('ratio') or CODECS[codec['codec']]['ratio'])
+
+def get_useful_jobs(sizes):
+    total, largest = sum(sizes), max(sizes, default=0)
+    return max(1, min(len(sizes), math.ceil(total / largest) if largest else 1))
+
+def compute_plan(tables, limits, host, args, codec=None):
+    sizes = [table['size'] for table in tables if table['size'] > 0] or [0]
+    total, largest = sum(sizes), max(sizes)
+    # backups are sized from table data; restores from the backup's objects, which are already compressed
+    if codec is None:
+        file_ratio = disk_ratio = DUMP_SIZE_RATIO
+    else:
+        file_ratio, disk_ratio = 1, get_expansion_ratio(codec)
+    # workers past total/largest sit idle while the largest table finishes, and
+    # pg_dump/pg_restore -j hold one connection more than their job count
+    useful_jobs = get_useful_jobs(sizes)
+    connection_jobs = max(1, limits['max_connections'] - limits['used_connections'] - RESERVED_CONNECTIONS - 1)
+    jobs = max(1, min(useful_jobs, connection_jobs, host['cpus']))
+
+    # the largest file should split into several parts per worker so the pool stays busy
+    transfer_concurrency = min(MAX_TRANSFER_CONCURRENCY, max(MIN_TRANSFER_CONCURRENCY, host['cpus'] * 4))
+    largest_file = largest * file_ratio
+    part_size = get_part_size(largest_file, min(max(
+        math.ceil(largest_file / (transfer_concurrency * 4) / MB) * MB, S3_MIN_PART_SIZE), 64 * MB))
+    # every in-flight part is held in memory
+    memory_concurrency = int(host['memory_available'] * TRANSFER_MEMORY_SHARE // part_size)
+    transfer_concurrency = max(1, min(transfer_concurrency, memory_concurrency))
+
+    # the default modes stage the whole dump, pipelined modes only the files in flight, streams nothing
+    dump_size = total * disk_ratio
+    disk_needed = dump_size if not args.pipeline else sum(sorted(sizes, reverse=True)[:jobs * 2]) * disk_ratio
+    if args.stream:
+        disk_needed = dump_size = 0
+    warnings = []
+    if disk_needed > host['disk_free']:
+        warnings.append(f'about {disk_needed / GB:.1f}GB of local disk needed, {host["disk_free"] / GB:.1f}GB free')
+    if jobs < useful_jobs:
+        warnings.append(f'{useful_jobs} jobs would be useful, limited to {jobs} by cpus or connections')
+    if largest > total / 2 and largest > GB:
+        warnings.append(f'largest table is {largest / total:.0%} of the data, consider --shard-threshold')
+
+    # the instance that would run every useful job, with room to stage the dump
+    ec2_vcpus = max(2, min(useful_jobs, connection_jobs))
+    ec2_memory = ec2_vcpus * WORKER_MEMORY + transfer_concurrency * part_size * 2
+    return {
+        'inputs': {'tables': len(tables), 'total_size': total, 'largest_table': largest,
+                   'largest_table_name': tables[0]['name'] if tables else None, **limits, **host},
+        'computed': {'dump_jobs': jobs, 'restore_jobs': jobs, 'transfer_concurrency': transfer_concurrency,
+                     'part_size': part_size // MB},
+        'ec2': {'type': choose_ec2_type(ec2_vcpus, ec2_memory), 'vcpus': ec2_vcpus,
+                'memory_gb': math.ceil(ec2_memory / GB), 'volume_size_gb': max(64, math.ceil(dump_size * 1.2 / GB))},
+        'warnings': warnings,
+    }
+
+def read_plan(plan_path):
+    if not os.path.exists(plan_path):
+        return {}
+    with open(plan_path) as f:
+        return json.load(f)
+
+def write_plan(plan_path, plan):
+    with open(plan_path, 'w') as f:
+        json.dump(plan, f, indent=2)
+
+def apply_plan(tables, limits, host, args, codec=None):
+    # command line options win, then overrides edited into the plan file, then computed values
+    plan = compute_plan(tables, limits, host, args, codec)
+    plan['overrides'] = read_plan(args.plan_file).get('overrides', {})
+    plan['settings'] = {}
+    for setting, option in PLAN_SETTINGS.items():
+        value = getattr(args, option)
+        if value is None:
+            value = plan['overrides'].get(setting, plan['computed'][setting])
+            setattr(args, option, value)
+        plan['settings'][setting] = value
+    write_plan(args.plan_file, plan)
+    print(f'Run plan written to {args.plan_file}: {json.dumps(plan["settings"])}')
+    for warning in plan['warnings']:
+        print(f'Plan warning: {warning}')
+    return plan
+
+def run_backup(engine, backup_type, instance_username, instance_password, instance_port, env_path, current_time, tables, args):
+    # one database, phases go to args.report
+    report = args.report
+    conn_string = f'user={instance_username} password={instance_password} host={args.endpoint} port={instance_port} dbname={args.database}'
+    with report.phase('compression'):
+        args.codec = choose_compression(engine, conn_string, f'{backup_type}/{args.cluster}/{args.database}/{current_time}',
+            env_path, args)
+    sharded_export = None
+    if args.shard_threshold or args.stream:
+        sharded_export = ShardedExport(engine, conn_string,
+            f'{backup_type}/{args.cluster}/{args.database}/{current_time}', args)
+    if args.stream:
+        # nothing is staged, the dump phase covers the uploads
+        with report.phase('dump') as phase:
+            phase['rows'] = sum(table['rows'] for table in tables)
+            perform_streaming_backup(engine, backup_type, instance_username, instance_password, instance_port, \
+                env_path, current_time, args, sharded_export)
+    elif args.pipeline:
+        # uploads overlap the dump, so the dump phase covers both
+        with report.phase('dump') as phase:
+            phase['rows'] = sum(table['rows'] for table in tables)
+            perform_pipelined_backup(engine, backup_type, instance_username, instance_password, instance_port, \
+                env_path, current_time, args, sharded_export)
+    else:
+        with report.phase('dump') as dump_phase:
+            dump_phase['rows'] = sum(table['rows'] for table in tables)
+            perform_db_backup(instance_username, instance_password, instance_port, \
+                env_path, current_time, args, sharded_export)
+            dump_phase['bytes'] = get_dir_size(f'/tmp/{args.cluster}-{args.database}-{current_time}')
+        with report.phase('upload'):
+            if dump_phase['status'] == 'failed':
+                print(f'Not copying the failed backup of {args.database} to {args.bucket}')
+                shutil.rmtree(f'/tmp/{args.cluster}-{args.database}-{current_time}', ignore_errors=True)
+            else:
+                copy_to_s3(engine, backup_type, current_time, args)
+    if args.incremental and not report.failed:
+        # blobs of the database's deleted backups, now that this one is complete
+        with report.phase('prune') as phase:
+            phase.update(prune_blobs(engine, f'{backup_type}/{args.cluster}/{args.database}/', args))
+    if args.verify and not report.failed:
+        args.timestamp = current_time
+        with report.phase('verify') as phase:
+            phase.update(perform_backup_verify(engine, backup_type, instance_username, instance_password,
+                instance_port, env_path, args))
+
+# databases no backup can connect to
+CLUSTER_EXCLUDED_DATABASES = ['rdsadmin']
+
+def get_cluster_databases(conn_string, include, exclude):
+    connection = connect(conn_string)
+    try:
+        cur = connection.cursor()
+        cur.execute("""SELECT datname FROM pg_database
+                       WHERE datallowconn AND NOT datistemplate
+                       ORDER BY pg_database_size(oid) DESC""")
+        names = [name for (name,) in cur.fetchall()]
+    finally:
+        connection.close()
+    return [name for name in names
+        if any(fnmatch.fnmatchcase(name, pattern) for pattern in include or ['*'])
+        and not any(fnmatch.fnmatchcase(name, pattern) for pattern in (exclude or []) + CLUSTER_EXCLUDED_DATABASES)]
+
+def get_transfer_journal(timestamp, args):
+    # staged transfers are checkpointed so a failed run can be resumed with the same timestamp
+    if args.pipeline or args.stream or args.table or args.schema:
+        return None
+    return TransferJournal(get_journal_path(args.cluster, args.database, timestamp, args.operation), args.resume)
+
+def is_backup_complete(engine, s3_prefix, args):
+    # toc.dat is uploaded last by staged backups, manifest.json by streamed ones
+    return engine.object_exists(args.bucket, f'{s3_prefix}/toc.dat') or \
+        bool(get_remote_manifest(engine, s3_prefix, args).get('stream'))
+
+def backup_cluster_database(engine, budget, backup_type, instance_username, instance_password, instance_port, env_path, current_time, database, tables, args):
+    # each database gets its own args, journal and run report, the engine and job budget are shared
+    db_args = argparse.Namespace(**vars(args))
+    db_args.database = database
+    db_args.catalog_rows = {table['name']: table['rows'] for table in tables}
+    db_args.dump_jobs = min(get_useful_jobs([table['size'] for table in tables if table['size'] > 0]), args.dump_jobs)
+    report = db_args.report = RunReport(args.cluster, database, 'backup', current_time)
+    report_path = f'/tmp/{args.cluster}-{database}-{current_time}-report.json'
+    if args.resume and is_backup_complete(engine, f'{backup_type}/{args.cluster}/{database}/{current_time}', args):
+        print(f'Backup {current_time} of {database} is already complete, skipping it')
+        return {'database': database, 'status': 'skipped', 'seconds': 0, 'bytes': 0}
+
+    budget.acquire(db_args.dump_jobs)
+    try:
+        print(f'Backing up database {database} of cluster {args.cluster} with {db_args.dump_jobs} jobs')
+        db_args.journal = get_transfer_journal(current_time, db_args)
+        db_engine = engine.with_journal(db_args.journal)
+        report.engine = db_engine
+        try:
+            run_backup(db_engine, backup_type, instance_username, instance_password, instance_port, env_path,
+                current_time, tables, db_args)
+        except Exception as e:
+            report.error(f'Exception during backup of {database} from cluster {args.endpoint}', e)
+        finish_journal(db_args)
+    finally:
+        budget.release(db_args.dump_jobs)
+        report.finish()
+        report.write(report_path)
+        if args.emf:
+            put_emf_events(report.report, args.emf_log_group, args.region)
+    return {'database': database, 'status': report.report['status'], 'seconds': report.report['seconds'],
+            'bytes': report.report['phases'].get('dump', {}).get('bytes', 0), 'report_file': report_path}
+
+def run_cluster_backup(engine, backup_type, instance_username, instance_password, instance_port, env_path, current_time, cluster_tables, args):
+    # largest databases first, each dump takes its jobs from one budget for the whole cluster
+    print(f'Backing up {len(cluster_tables)} databases of cluster {args.cluster} with a budget of {args.dump_jobs} jobs')
+    budget = Budget(args.dump_jobs)
+    databases = sorted(cluster_tables, key=lambda database: sum(table['size'] for table in cluster_tables[database]),
+        reverse=True)
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.dump_jobs) as executor:
+        futures = {executor.submit(backup_cluster_database, engine, budget, backup_type, instance_username,
+            instance_password, instance_port, env_path, current_time, database, cluster_tables[database], args): database
+            for database in databases}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                args.report.error(f'Exception during backup of {futures[future]} from cluster {args.endpoint}', e)
+    results.sort(key=lambda result: databases.index(result['database']))
+    args.report.report['databases'] = results
+    for result in results:
+        print(f'{result["database"]:<40} {result["status"]:<8} {result["seconds"]:>8.1f}s {result["bytes"] / MB:>10.1f}MB')
+        if result['status'] == 'failed':
+            args.report.error(f'Backup of {result["database"]} failed, see {result["report_file"]}')
+
+def finish_journal(args):
+    if args.journal is not None and not args.report.failed:
+        args.journal.remove()
+    elif args.journal is not None:
+        print(f'Checkpoint journal kept in {args.journal.path}, rerun with --resume to continue')
+
+def run_operation(current_time, args):
+    report = args.report
+
+    # required env variables 
+    env_path = os.getenv('PATH', '/usr/local/bin:/usr/bin:/usr/local/sbin:/usr/sbin')
+    user_home = os.getenv('HOME')
+
+    if args.operation == 'prune':
+        # only s3 is read, the database and its secret are not needed
+        s3_prefix = f'manual/{args.cluster}/{args.database}/' if args.database else f'manual/{args.cluster}/'
+        engine = TransferEngine(args.region, max_concurrency=MIN_TRANSFER_CONCURRENCY)
+        try:
+            with report.phase('prune') as phase:
+                phase.update(prune_blobs(engine, s3_prefix, args))
+        finally:
+            engine.shutdown()
+        print(f'{args.operation} for instance {args.cluster} operation {"failed" if report.failed else "complete"}')
+        return
+
+    # gather secret and associated details - required for script
+    with report.phase('secret'):
+        if worker_cache is not None:
+            secret_dict = worker_cache.get_secret(args.secret, args.region)
+        else:
+            secret_dict = get_secret(args.secret, args.region)
+    instance_username = get_nested(secret_dict, 'username')
+    instance_password = get_nested(secret_dict, 'password')
+    instance_port =  get_nested(secret_dict, 'port')
+
+    current_date = get_date()
+
+    # size jobs, transfer concurrency and part size from the catalog and this host
+    conn_string = f'user={instance_username} password={instance_password} host={args.endpoint} port={instance_port} dbname={args.database}'
+    args.plan_file = args.plan_file or f'/tmp/{args.cluster}-{args.database or "all"}-plan.json'
+    with report.phase('plan'):
+        codec = None
+        if args.operation in ('restore', 'verify'):
+            limits = get_connection_limits(f'user={instance_username} password={instance_password} host={args.endpoint} port={instance_port} dbname=postgres')
+            tables = get_backup_table_sizes(f'manual/{args.cluster}/{args.database}/{args.timestamp}',
+                f'/tmp/{args.cluster}-{args.database}-{args.timestamp}', args) if args.timestamp else []
+            # get_backup_table_sizes leaves the backup's manifest.json in the restore path
+            codec = get_backup_codec(read_manifest(f'/tmp/{args.cluster}-{args.database}-{args.timestamp}'))
+        elif not args.database:
+            # the whole cluster is planned as one, its job budget is shared by every database
+            postgres_conn_string = f'user={instance_username} password={instance_password} host={args.endpoint} port={instance_port} dbname=postgres'
+            limits = get_connection_limits(postgres_conn_string)
+            cluster_tables = {database: get_catalog_table_sizes(psycopg2.extensions.make_dsn(postgres_conn_string, dbname=database))
+                for database in get_cluster_databases(postgres_conn_string, args.include_database, args.exclude_database)}
+            tables = sorted([{**table, 'name': f'{database}/{table["name"]}'}
+                for database, database_tables in cluster_tables.items() for table in database_tables],
+                key=lambda table: table['size'], reverse=True)
+        else:
+            limits = get_connection_limits(conn_string)
+            tables = get_catalog_table_sizes(conn_string)
+            # estimates for the manifest, exact counts come from COPY
+            args.catalog_rows = {table['name']: table['rows'] for table in tables}
+        plan = apply_plan(tables, limits, get_host_resources(), args, codec)
+    if args.operation == 'plan':
+        print(json.dumps(plan, indent=2))
+        return
+
+    # a cluster-wide backup keeps one journal per database
+    args.journal = None
+    if args.operation in ('backup', 'restore') and args.database:
+        args.journal = get_transfer_journal(current_time if args.operation == 'backup' else args.timestamp, args)
+
+    # one s3 client and worker pool shared by every transfer in this run
+    engine = get_transfer_engine(args)
+    report.engine = engine
+
+    try:
+        # if no specific database is specified - backup all databases
+        if args.operation == 'backup':
+            backup_type = 'manual'
+            if args.database:
+                print(f'Backing up single database of: {args.database}, on host: {args.endpoint}')
+                run_backup(engine, backup_type, instance_username, instance_password, instance_port, env_path,
+                    current_time, tables, args)
+            else:
+                run_cluster_backup(engine, backup_type, instance_username, instance_password, instance_port, env_path,
+                    current_time, cluster_tables, args)
+            # roles are cluster wide, dumped once however many databases were backed up
+            with report.phase('roles'):
+                perform_roles_backup(backup_type, instance_username, instance_password, instance_port, \
+                    env_path, current_time, args)
+        elif (args.database) and (args.operation == 'restore') and (args.timestamp):
+            backup_type = 'manual'
+            selective = bool(args.table or args.schema)
+            args.existing_db = False
+            # a selective restore replaces only its own tables in the existing database
+            if not selective:
+                with report.phase('prepare'):
+                    args.existing_db = check_existing_db(instance_username, instance_password, instance_port, env_path, args)
+                    if args.existing_db:
+                        drop_tables(instance_username, instance_password, instance_port, env_path, args)
+            print(f'Restoring single database of: {args.database}, on host: {args.endpoint}, backup timestamp of: {args.timestamp} ')
+            manifest = get_remote_manifest(engine, f'{backup_type}/{args.cluster}/{args.database}/{args.timestamp}', args)
+            if selective:
+                with report.phase('restore'):
+                    perform_selective_restore(engine, backup_type, instance_username, instance_password, instance_port,
+                        env_path, manifest, args)
+            elif manifest.get('stream'):
+                # streamed backups have no directory archive, they are always restored as streams
+                with report.phase('restore'):
+                    perform_streaming_restore(engine, backup_type, instance_username, instance_password, instance_port,
+                        env_path, manifest, args)
+            elif args.pipeline:
+                # downloads overlap the restore, so the restore phase covers both
+                with report.phase('restore'):
+                    perform_pipelined_restore(engine, backup_type, instance_username, instance_password, instance_port, env_path, args)
+            else:
+                with report.phase('download'):
+                    copy_from_s3(engine, backup_type, args)
+                with report.phase('restore') as phase:
+                    phase['bytes'] = get_dir_size(f'/tmp/{args.cluster}-{args.database}-{args.timestamp}')
+                    perform_db_restore(backup_type, instance_username, instance_password, instance_port, env_path, args)
+            with report.phase('maintenance') as phase:
+                results = vacuum_analyze_tables(instance_username, instance_password, instance_port, env_path, args)
+                phase['bytes'] = sum(result['bytes'] for result in results)
+                phase['rows'] = get_row_count(conn_string)
+        elif (args.database) and (args.operation == 'verify') and (args.timestamp):
+            with report.phase('verify') as phase:
+                phase.update(perform_backup_verify(engine, 'manual', instance_username, instance_password,
+                    instance_port, env_path, args))
+        else:
+            report.error('No known operation matched')
+    finally:
+        # a worker keeps its engines for the next job
+        if worker_cache is None:
+            engine.shutdown()
+        finish_journal(args)
+    
+    print(f'{args.operation} for instance {args.cluster} operation {"failed" if report.failed else "complete"}')
+
+class WarmConnection:
+    """A cached connection handed out for one query function; close() returns it to the worker cache."""
+
+    def __init__(self, cache, conn_string, connection):
+        self.cache = cache
+        self.conn_string = conn_string
+        self.connection = connection
+
+    def cursor(self):
+        return self.connection.cursor()
+
+    def close(self):
+        self.cache.release(self.conn_string, self.connection)
+
+class WorkerCache:
+    """Clients, secrets, transfer engines and catalog connections kept warm across the jobs of a worker."""
+
+    def __init__(self, secret_ttl):
+        self.secret_ttl = secret_ttl
+        self.clients = {}
+        self.secrets = {}
+        self.engines = {}
+        self.connections = collections.defaultdict(list)
+        self.lock = threading.Lock()
+
+    def get_client(self, service, region):
+        with self.lock:
+            if (service, region) not in self.clients:
+                self.clients[(service, region)] = boto3.session.Session().client(service, region_name=region)
+            return self.clients[(service, region)]
+
+    def get_secret(self, secret_name, region):
+        # rotated secrets are picked up once the ttl runs out
+        cached = self.secrets.get((secret_name, region))
+        if cached is None or time.monotonic() > cached[1]:
+            cached = (get_secret(secret_name, region, self.get_client('secretsmanager', region)),
+                      time.monotonic() + self.secret_ttl)
+            self.secrets[(secret_name, region)] = cached
+        return cached[0]
+
+    def get_engine(self, args):
+        # one engine per distinct sizing, each job gets its own journal and transfer records
+        key = (args.region, args.transfer_concurrency, args.part_size, args.max_bandwidth, args.stream_memory)
+        with self.lock:
+            if key not in self.engines:
+                max_bandwidth = args.max_bandwidth * MB if args.max_bandwidth else None
+                self.engines[key] = TransferEngine(args.region, max_concurrency=args.transfer_concurrency,
+                    max_bandwidth=max_bandwidth, part_size=args.part_size * MB, stream_memory=args.stream_memory * MB)
+        engine = self.engines[key].with_journal(args.journal)
+        engine.transfers = []
+        engine.first_byte = None
+        return engine
+
+    def connect(self, conn_string):
+        with self.lock:
+            idle = self.connections[conn_string]
+            connection = idle.pop() if idle else None
+        if connection is not None:
+            try:
+                # the server may have closed it since the last job
+                connection.cursor().execute('SELECT 1')
+                connection.rollback()
+            except psycopg2.Error:
+                connection.close()
+                connection = None
+        if connection is None:
+            connection = psycopg2.connect(conn_string)
+        return WarmConnection(self, conn_string, connection)
+
+    def release(self, conn_string, connection):
+        if connection.closed:
+            return
+        connection.rollback()
+        with self.lock:
+            self.connections[conn_string].append(connection)
+
+    def close(self):
+        for engine in self.engines.values():
+            engine.shutdown()
+        for idle in self.connections.values():
+            for connection in idle:
+                connection.close()
+
+# set by run_worker, None for a single run
+worker_cache = None
+
+class SpoolQueue:
+    """Local sqlite job spool, the stand-in for SQS on a single host."""
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                                   id INTEGER PRIMARY KEY, body TEXT, status TEXT DEFAULT 'queued',
+                                   enqueued REAL, started REAL, finished REAL, result TEXT)""")
+
+    def put(self, body):
+        self.connection.execute('INSERT INTO jobs (body, enqueued) VALUES (?, ?)', (body, time.time()))
 
+    def get(self, wait_seconds):
+        deadline = time.monotonic() + wait_seconds
+        while True:
+            # one transaction claims the oldest queued job, so several workers can share a spool
+            self.connection.execute('BEGIN IMMEDIATE')
+            row = self.connection.execute(
+                "SELECT id, body, enqueued FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1").fetchone()
+            if row is not None:
+                self.connection.execute("UPDATE jobs SET status = 'running', started = ? WHERE id = ?",
+                    (time.time(), row[0]))
+            self.connection.execute('COMMIT')
+            if row is not None:
+                return {'id': row[0], 'body': row[1], 'enqueued': row[2]}
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(1)
+
+    @contextlib.contextmanager
+    def claim(self, job):
+        # a running row is already hidden from other workers
+        yield
+
+    def done(self, job, status, result):
+        self.connection.execute('UPDATE jobs SET status = ?, finished = ?, result = ? WHERE id = ?',
+            (status, time.time(), json.dumps(result), job['id']))
+
+class SqsQueue:
+    """SQS job queue; a job is deleted once it ran, failed jobs go to the report rather than back to the queue."""
+
+    def __init__(self, url, client, visibility_timeout):
+        self.url = url
+        self.client = client
+        self.visibility_timeout = visibility_timeout
+
+    def put(self, body):
+        self.client.send_message(QueueUrl=self.url, MessageBody=body)
+
+    def get(self, wait_seconds):
+        response = self.client.receive_message(QueueUrl=self.url, MaxNumberOfMessages=1,
+            WaitTimeSeconds=min(wait_seconds, 20), AttributeNames=['SentTimestamp'],
+            VisibilityTimeout=self.visibility_timeout)
+        for message in response.get('Messages', []):
+            return {'id': message['MessageId'], 'body': message['Body'], 'receipt': message['ReceiptHandle'],
+                    'enqueued': int(message['Attributes']['SentTimestamp']) / 1000}
+        return None
+
+    @contextlib.contextmanager
+    def claim(self, job):
+        # a heartbeat keeps the message hidden while the job runs, however long that takes,
+        # so no other worker picks up the same job part way through
+        stopped = threading.Event()
+
+        def extend_visibility():
+            while not stopped.wait(self.visibility_timeout / 3):
+                try:
+                    self.client.change_message_visibility(QueueUrl=self.url, ReceiptHandle=job['receipt'],
+                        VisibilityTimeout=self.visibility_timeout)
+                except Exception as e:
+                    print(f'Exception during visibility heartbeat of job {job["id"]}')
+                    print(e)
+
+        heartbeat = threading.Thread(target=extend_visibility, daemon=True)
+        heartbeat.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            heartbeat.join()
+
+    def done(self, job, status, result):
+        self.client.delete_message(QueueUrl=self.url, ReceiptHandle=job['receipt'])
+
+def get_job_queue(queue, region, visibility_timeout):
+    if queue.startswith('https://'):
+        return SqsQueue(queue, worker_cache.get_client('sqs', region) if worker_cache else
+            boto3.session.Session().client('sqs', region_name=region), visibility_timeout)
+    return SpoolQueue(queue)
+
+def get_worker_parser():
+    parser = argparse.ArgumentParser(description='aurora operation worker, runs queued jobs with warm clients')
+    parser.add_argument('--queue', help='sqs queue url, or the path of a local sqlite job spool', required=True)
+    parser.add_argument('-r', '--region', help='aws region of the sqs queue', default='us-east-1')
+    parser.add_argument('--secret-ttl', help='seconds a secret is reused before it is fetched again', type=int, default=300)
+    parser.add_argument('--wait-seconds', help='seconds to wait for a job before polling again', type=int, default=20)
+    parser.add_argument('--visibility-timeout', help='seconds an sqs job stays hidden from other workers, extended every '
+                        'third of it while the job runs', type=int, default=300)
+    parser.add_argument('--max-jobs', help='exit after this many jobs', type=int, required=False)
+    parser.add_argument('--idle-exit', help='exit once no job arrived for this many seconds', type=int, required=False)
+    return parser
+
+def enqueue_job(argv):
+    # python aurora-operation.py enqueue --queue jobs.db -- -c clu02 -d db3 -o backup ...
+    parser = get_worker_parser()
+    parser.add_argument('job', help='aurora-operation.py options of the job', nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+    job_args = args.job[1:] if args.job[:1] == ['--'] else args.job
+    # the job options are checked now rather than when a worker picks them up
+    get_parser().parse_args(job_args)
+    get_job_queue(args.queue, args.region, args.visibility_timeout).put(json.dumps({'args': job_args}))
+    print(f'Queued job {" ".join(job_args)} on {args.queue}')
+
+def run_worker(argv):
+    global worker_cache
+    args = get_worker_parser().parse_args(argv)
+    worker_cache = WorkerCache(args.secret_ttl)
+    queue = get_job_queue(args.queue, args.region, args.visibility_timeout)
+    print(f'Worker waiting for jobs on {args.queue}')
+    jobs = 0
+    idle_since = time.monotonic()
+    try:
+        while args.max_jobs is None or jobs < args.max_jobs:
+            job = queue.get(args.wait_seconds)
+            if job is None:
+                if args.idle_exit is not None and time.monotonic() - idle_since >= args.idle_exit:
+                    print(f'No job for {args.idle_exit}s, worker exiting')
+                    break
+                continue
+            jobs += 1
+            queued_seconds = time.time() - job['enqueued']
+            job_args = json.loads(job['body'])['args']
+            print(f'Job {job["id"]} started after {queued_seconds:.1f}s in the queue: {" ".join(job_args)}')
+            result = {'queued_seconds': queued_seconds}
+            try:
+                with queue.claim(job):
+                    report = run_job(get_parser(), job_args)
+                result.update({'status': report.report['status'], 'seconds': report.report['seconds'],
+                               'ttfb_seconds': report.report.get('ttfb_seconds')})
+            except (Exception, SystemExit) as e:
+                # bad job options or a failure outside the run report, the worker carries on
+                print(f'Exception during job {job["id"]}')
+                print(e)
+                result['status'] = 'failed'
+            queue.done(job, result['status'], result)
+            ttfb = f'{result["ttfb_seconds"]:.1f}s' if result.get('ttfb_seconds') is not None else 'none'
+            print(f'Job {job["id"]} {result["status"]} in {result.get("seconds", 0):.1f}s, time to first byte {ttfb}')
+            idle_since = time.monotonic()
+    finally:
+        worker_cache.close()
+
+def get_parser():
     # python aurora_operation.py -c clu02 -d db3 -o backup -r us-east-1 -b backup-aurora-prod-us-east-1 -s /aurora/clu02/postgres -e clu02.cluster-ro-crywpxf9avmu.us-east-1.rds.amazonaws.com
+    # python aurora_operation.py -c clu02 -d db3 -o plan -r us-east-1 -b backup-aurora-prod-us-east-1 -s /aurora/clu02/postgres -e clu02.cluster-ro-crywpxf9avmu.us-east-1.rds.amazonaws.com --plan-file tmp/plan.json
     # input parsing
     parser = argparse.ArgumentParser(description='aurora operation program')
-    parser.add_argument('-d', '--database', help='database name', required=True)
-    parser.add_argument('-o', '--operation', help='operation type', required=True, choices=['backup', 'restore'])
+    parser.add_argument('-d', '--database', help='database name, a backup without it covers every database of the cluster',
+                        required=False)
+    parser.add_argument('--include-database', help='cluster-wide backup of only databases matching this pattern, repeatable',
+                        action='append')
+    parser.add_argument('--exclude-database', help='cluster-wide backup skips databases matching this pattern, repeatable',
+                        action='append')
+    parser.add_argument('-o', '--operation', help='operation type, plan only writes the run plan, prune deletes '
+                        'incremental blobs no manifest references', required=True,
+                        choices=['backup', 'restore', 'verify', 'plan', 'prune'])
     parser.add_argument('-b', '--bucket', help='service check', required=True, default=False)
     parser.add_argument('-s', '--secret', help='secret', required=True)
     parser.add_argument('-c', '--cluster', help='cluster name', required=True)
     parser.add_argument('-e', '--endpoint', help='instance endpoint', required=True)
     parser.add_argument('-r', '--region', help='aws region for db', required=True, default='us-east-1')
     parser.add_argument('-t', '--timestamp', help='backup timestamp to restore', required=False)
-    args = parser.parse_args()
+    parser.add_argument('--table', help='restore only this table (schema.table or table) into the existing database, repeatable',
+                        action='append')
+    parser.add_argument('--schema', help='restore only the tables of this schema into the existing database, repeatable',
+                        action='append')
+    parser.add_argument('--verify', help='verify the backup against its manifest once it is complete', action='store_true')
+    parser.add_argument('--verify-sample', help='percent of checksum blocks verify reads, first and last of each file always, '
+                        '100 reads every byte', type=float, default=5)
+    parser.add_argument('--deep', help='verify also lists the archive with pg_restore and decodes every data file',
+                        action='store_true')
+    parser.add_argument('--resume', help='continue a failed backup or restore of the same timestamp (-t, or the latest '
+                        'backup journal) from its checkpoint journal, not for --pipeline or --stream', action='store_true')
+    parser.add_argument('-p', '--pipeline', help='overlap pg_dump/pg_restore with s3 transfers', action='store_true')
+    parser.add_argument('-j', '--jobs', help='parallel pg_restore jobs, planned if unset', type=int, required=False)
+    parser.add_argument('--dump-jobs', help='parallel pg_dump jobs, planned if unset', type=int, required=False)
+    parser.add_argument('--compression', help='none, gzip, zstd or lz4 with an optional :level, or auto',
+                        type=lambda value: value if value == 'auto' else parse_compression(value), default='gzip:1')
+    parser.add_argument('--stream', help='stream the backup into s3 multipart uploads without staging it on local disk',
+                        action='store_true')
+    parser.add_argument('--stream-memory', help='MB of stream parts buffered or in flight at once', type=int, default=256)
+    parser.add_argument('--incremental', help='store data files once by content hash and reference them from the manifest',
+                        action='store_true')
+    parser.add_argument('--prune-grace-days', help='days an unreferenced blob is kept, longer than the longest backup',
+                        type=float, default=2)
+    parser.add_argument('--dry-run', help='prune only reports the blobs it would delete', action='store_true')
+    parser.add_argument('--shard-threshold', help='export tables larger than this many GB as parallel COPY ranges',
+                        type=float, required=False)
+    parser.add_argument('--shard-chunk-size', help='target MB of table per COPY range', type=int, default=1024)
+    parser.add_argument('--shard-jobs', help='concurrent COPY ranges', type=int, default=8)
+    parser.add_argument('--maintenance', help='post-restore table maintenance', default='analyze',
+                        choices=['none', 'analyze', 'vacuum-analyze', 'full'])
+    parser.add_argument('--maintenance-jobs', help='parallel maintenance connections', type=int, default=4)
+    parser.add_argument('--restore-profile', help='fast-load splits the restore into sections with session tuning and '
+                        'concurrent index and constraint builds', default='default', choices=['default', 'fast-load'])
+    parser.add_argument('--maintenance-work-mem', help='MB of maintenance_work_mem per fast-load restore session',
+                        type=int, default=1024)
+    parser.add_argument('--parallel-maintenance-workers', help='max_parallel_maintenance_workers per fast-load restore session',
+                        type=int, default=2)
+    parser.add_argument('--no-comments', help='restore without comments', action='store_true')
+    parser.add_argument('--transfer-concurrency', help='total concurrent s3 requests, planned if unset', type=int, required=False)
+    parser.add_argument('--part-size', help='minimum s3 multipart part size in MB, planned if unset', type=int, required=False)
+    parser.add_argument('--plan-file', help='run plan json, its overrides are applied', required=False)
+    parser.add_argument('--report-file', help='run report json', required=False)
+    parser.add_argument('--emf', help='also write the run report as cloudwatch embedded metric format events',
+                        action='store_true')
+    parser.add_argument('--emf-log-group', help='log group for embedded metric format events', default='/aws/ssm/aurora-backup')
+    parser.add_argument('--max-bandwidth', help='s3 bandwidth limit in MB/s', type=float, required=False)
+    return parser
 
-    # required env variables 
-    env_path = os.getenv('PATH', '/usr/local/bin:/usr/bin:/usr/local/sbin:/usr/sbin')
-    user_home = os.getenv('HOME')
+def run_job(parser, argv):
+    args = parser.parse_args(argv)
+    # prepare-execute.sh passes a placeholder when no timestamp was given
+    if args.timestamp == 'notime':
+        args.timestamp = None
+    if args.stream and args.incremental:
+        parser.error('--incremental needs each data file on disk to hash it, it cannot be combined with --stream')
 
-    # gather secret and associated details - required for script
-    secret_dict = get_secret(args.secret, args.region)
-    instance_username = get_nested(secret_dict, 'username')
-    instance_password = get_nested(secret_dict, 'password')
-    instance_port =  get_nested(secret_dict, 'port')
+    if not args.database and args.operation in ('restore', 'verify'):
+        parser.error(f'{args.operation} needs a database (-d)')
+
+    if args.resume and (args.pipeline or args.stream):
+        parser.error('--resume continues staged transfers, it cannot be combined with --pipeline or --stream')
 
     current_time = get_time()
-    current_date = get_date()
+    if args.resume and args.operation == 'backup' and not (args.database or args.timestamp):
+        parser.error('--resume of a cluster-wide backup needs its timestamp (-t)')
+    if args.resume and args.operation == 'backup':
+        # the resumed backup keeps its original timestamp and s3 prefix
+        current_time = args.timestamp or get_latest_journal_timestamp(args.cluster, args.database, 'backup')
+        if current_time is None:
+            parser.error(f'no backup journal for {args.cluster}/{args.database} to resume')
+    args.report = RunReport(args.cluster, args.database, args.operation, current_time)
+    try:
+        run_operation(current_time, args)
+    finally:
+        args.report.finish()
+        args.report.write(args.report_file or f'/tmp/{args.cluster}-{args.database or "all"}-{current_time}-report.json')
+        if args.emf:
+            put_emf_events(args.report.report, args.emf_log_group, args.region)
+    return args.report
 
-    # if no specific database is specified - backup all databases
-    if (args.database) and (args.operation == 'backup'):
-        print(f'Backing up single database of: {args.database}, on host: {args.endpoint}')
-        backup_type = 'manual'
-        perform_db_backup(instance_username, instance_password, instance_port, \
-            env_path, current_time, args)
-        perform_roles_backup(backup_type, instance_username, instance_password, instance_port, \
-            env_path, current_time, args)
-        copy_to_s3(backup_type, current_time, args)
-    elif (args.database) and (args.operation == 'restore') and (args.timestamp):
-        backup_type = 'manual'
-        db_found = check_existing_db(instance_username, instance_password, instance_port, env_path, args)
-        if db_found == True:
-            drop_tables(instance_username, instance_password, instance_port, env_path, args)
-        print(f'Restoring single database of: {args.database}, on host: {args.endpoint}, backup timestamp of: {args.timestamp} ')
-        copy_from_s3(backup_type, args)
-        perform_db_restore(backup_type, instance_username, instance_password, instance_port, env_path, args)
-        vacuum_analyze_tables(instance_username, instance_password, instance_port, env_path, args)
-    else:
-        print('No known operation matched')
-    
-    print(f'{args.operation} for instance {args.cluster} operation complete')
+def main():
+    # python aurora-operation.py worker --queue /var/spool/aurora-backup/jobs.db
+    if sys.argv[1:2] == ['worker']:
+        run_worker(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ['enqueue']:
+        enqueue_job(sys.argv[2:])
+        return
+    report = run_job(get_parser(), sys.argv[1:])
+    if report.failed:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
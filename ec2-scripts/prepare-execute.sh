@@ -3,7 +3,7 @@
 
 __parse_args() {
     # parsing input arguments
-    while getopts ":h:c:d:o:r:b:s:e:t:" opt; do
+    while getopts ":h:c:d:o:r:b:s:e:t:a:" opt; do
         case ${opt} in
             h)
             echo "Example usage:"
@@ -21,6 +21,7 @@ __parse_args() {
             s) secret=${OPTARG};;
             e) endpoint=${OPTARG};;
             t) timestamp=${OPTARG};;
+            a) extra_args=${OPTARG};;
             \?)
             echo "Invalid Option: -$OPTARG" 1>&2
             exit 1
@@ -37,7 +38,7 @@ __prepare_env() {
     yum -y install which amazon-linux-extras wget shadow-utils awscli unzip
     amazon-linux-extras disable postgresql9.6 2>&1
     amazon-linux-extras enable postgresql13 2>&1
-    yum -y install postgresql
+    yum -y install postgresql zstd lz4
     yum -y clean all
 
     if ! command -v /usr/local/bin/aws
@@ -58,7 +59,9 @@ __aurora_operation() {
     
     # put dummy value if none is set 
     timestamp=${timestamp:-'notime'}   
-    python3 aurora-operation.py -c ${cluster} -d ${database} -o ${operation} -r ${region} -b ${bucket} -s ${secret} -e ${endpoint} -t ${timestamp}
+    # split the extra options on whitespace without glob expansion, e.g. --tables test_*
+    read -r -a extra_options <<< "${extra_args}"
+    python3 aurora-operation.py -c ${cluster} ${database:+-d ${database}} -o ${operation} -r ${region} -b ${bucket} -s ${secret} -e ${endpoint} -t ${timestamp} "${extra_options[@]}"
 }
 
 #### main control flow ####
@@ -1,19 +1,127 @@
-#!/usr/bin/env python 
+#!/usr/bin/env python
 
 import argparse
+import asyncio
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+import functools
+import json
+import random
+import sys
 import time
 
-def ssm_send_command(args):
-    ssm_client = boto3.client('ssm', region_name=args.region) 
-    command_string = f'prepare-execute.sh -c {args.cluster} -d {args.database} -o {args.operation} -b {args.bucket} -s {args.secret} -e {args.endpoint} -r {args.region} -t {args.timestamp}'
-    s3_path = f'https://{args.bucket}.s3.amazonaws.com/ec2-scripts/prepare-execute.sh'
+# get_command_invocation statuses after which the command will not change again
+TERMINAL_STATUSES = {'Success', 'Failed', 'Cancelled', 'TimedOut', 'DeliveryTimedOut', 'ExecutionTimedOut',
+                     'Undeliverable', 'Terminated', 'InvalidPlatform', 'AccessDenied'}
+# first and longest wait between status polls, in seconds
+POLL_MIN_DELAY = 2
+POLL_MAX_DELAY = 30
+# error codes that mean slow down rather than fail
+THROTTLING_ERRORS = {'ThrottlingException', 'Throttling', 'TooManyRequestsException', 'RequestLimitExceeded'}
+# fields every fleet job needs, from the fleet file or the command line
+JOB_FIELDS = ['cluster', 'operation', 'bucket', 'secret', 'endpoint', 'region', 'instance']
 
-    print(f'Submitting SSM command: {command_string}')
-    try:
-        response = ssm_client.send_command(
+def get_command_string(job):
+    command_string = f'prepare-execute.sh -c {job["cluster"]} -o {job["operation"]} -b {job["bucket"]} -s {job["secret"]} -e {job["endpoint"]} -r {job["region"]} -t {job.get("timestamp") or "notime"}'
+    # without a database the backup covers the whole cluster
+    if job.get('database'):
+        command_string += f' -d {job["database"]}'
+    if job.get('extra_args'):
+        command_string += f' -a "{job["extra_args"]}"'
+    return command_string
+
+def get_job_label(job):
+    return f'{job["cluster"]}/{job.get("database") or "all"}'
+
+class ClientFactory:
+    """boto3 clients cached per service, region and profile, with adaptive client side retries."""
+
+    def __init__(self):
+        self.clients = {}
+        self.config = Config(retries={'max_attempts': 10, 'mode': 'adaptive'})
+
+    def get(self, service, region, profile=None):
+        key = (service, region, profile)
+        if key not in self.clients:
+            session = boto3.Session(profile_name=profile) if profile else boto3.Session()
+            self.clients[key] = session.client(service, region_name=region, config=self.config)
+        return self.clients[key]
+
+class ApiLimiter:
+    """Spaces the SSM and logs calls of one account and region, and backs off when they are throttled."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_call = 0
+        self.lock = asyncio.Lock()
+
+    async def call(self, function, **kwargs):
+        for attempt in range(8):
+            async with self.lock:
+                delay = self.next_call - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                self.next_call = time.monotonic() + self.interval
+            try:
+                # boto3 blocks, so every call runs on the default thread pool; asyncio.to_thread needs 3.9
+                return await asyncio.get_running_loop().run_in_executor(None, functools.partial(function, **kwargs))
+            except ClientError as e:
+                if e.response['Error']['Code'] not in THROTTLING_ERRORS or attempt == 7:
+                    raise e
+                await asyncio.sleep(get_backoff_delay(attempt))
+
+def get_backoff_delay(attempt):
+    # exponential with jitter, so waiters started together do not poll together
+    delay = min(POLL_MAX_DELAY, POLL_MIN_DELAY * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+class Fleet:
+    """Runs SSM commands for many jobs at once, bounded per account and region."""
+
+    def __init__(self, clients, max_per_region, api_rate, log_group, output=sys.stdout):
+        self.clients = clients
+        self.max_per_region = max_per_region
+        self.api_rate = api_rate
+        self.log_group = log_group
+        self.output = output
+        self.semaphores = {}
+        self.limiters = {}
+
+    def _get_scope(self, job):
+        scope = (job.get('profile'), job['region'])
+        if scope not in self.semaphores:
+            self.semaphores[scope] = asyncio.Semaphore(self.max_per_region)
+            self.limiters[scope] = ApiLimiter(self.api_rate)
+        return self.semaphores[scope], self.limiters[scope]
+
+    def _print(self, job, message):
+        print(f'[{get_job_label(job)}] {message}', file=self.output, flush=True)
+
+    async def run(self, jobs):
+        return await asyncio.gather(*[self.run_job(job) for job in jobs])
+
+    async def run_job(self, job):
+        result = {**job, 'label': get_job_label(job), 'command_id': None, 'status': 'NotSent', 'seconds': 0}
+        semaphore, limiter = self._get_scope(job)
+        async with semaphore:
+            start = time.monotonic()
+            try:
+                await self._run_command(job, result, limiter)
+            except Exception as e:
+                self._print(job, f'Exception during SSM command on {job["instance"]}: {e}')
+                result['status'] = result['status'] if result['status'] in TERMINAL_STATUSES else 'Error'
+            result['seconds'] = time.monotonic() - start
+        return result
+
+    async def _run_command(self, job, result, limiter):
+        ssm_client = self.clients.get('ssm', job['region'], job.get('profile'))
+        command_string = get_command_string(job)
+        s3_path = f'https://{job["bucket"]}.s3.amazonaws.com/ec2-scripts/prepare-execute.sh'
+        self._print(job, f'Submitting SSM command: {command_string}')
+        response = await limiter.call(ssm_client.send_command,
             InstanceIds=[
-                args.instance
+                job['instance']
             ],
             DocumentName='AWS-RunRemoteScript',
             Parameters={
@@ -26,44 +134,113 @@ def ssm_send_command(args):
                 ]
             },
             CloudWatchOutputConfig={
-                'CloudWatchLogGroupName': '/aws/ssm/aurora-backup',
+                'CloudWatchLogGroupName': self.log_group,
                 'CloudWatchOutputEnabled': True
             }
         )
+        result['command_id'] = command_id = response['Command']['CommandId']
+        result['status'] = 'Pending'
+        self._print(job, f'SSM command in-progress, ID: {command_id}')
 
-        command_id = response['Command']['CommandId']
-        time.sleep(2)
-        output = ssm_client.get_command_invocation(
-            CommandId=command_id,
-            InstanceId=args.instance,
-        )
-        print(f'SSM command in-progress, ID: {command_id}')
-        while output['Status'] != 'Success':
-            time.sleep(3)
-            output = ssm_client.get_command_invocation(CommandId=command_id, InstanceId=args.instance)
-            if (output['Status'] == 'Failed') or (output['Status'] == 'Cancelled') or (output['Status'] == 'TimedOut'):
-                print(f'SSM command complete, ID: {command_id}, status of: {output["Status"]}' )
-                break
-
-    except Exception as e:
-        print(f'Exception during download execution of SSM command {command_string}')
-        print(e)
+        log_streams = {}
+        attempt = 0
+        while result['status'] not in TERMINAL_STATUSES:
+            await asyncio.sleep(get_backoff_delay(attempt))
+            try:
+                output = await limiter.call(ssm_client.get_command_invocation,
+                    CommandId=command_id, InstanceId=job['instance'])
+            except ClientError as e:
+                # the invocation shows up a moment after send_command returns
+                if e.response['Error']['Code'] != 'InvocationDoesNotExist':
+                    raise e
+                output = {'Status': 'Pending'}
+            # polling speeds up again whenever the command moves on
+            attempt = 0 if output['Status'] != result['status'] else attempt + 1
+            result['status'] = output['Status']
+            await self._stream_output(job, command_id, log_streams, limiter)
+        self._print(job, f'SSM command complete, ID: {command_id}, status of: {result["status"]}')
+
+    async def _stream_output(self, job, command_id, log_streams, limiter):
+        # SSM writes one stream per plugin and output, e.g. <command>/<instance>/runShellScript/stdout
+        logs_client = self.clients.get('logs', job['region'], job.get('profile'))
+        try:
+            response = await limiter.call(logs_client.describe_log_streams, logGroupName=self.log_group,
+                logStreamNamePrefix=f'{command_id}/{job["instance"]}/')
+            for stream in response['logStreams']:
+                name = stream['logStreamName']
+                while True:
+                    kwargs = {'nextToken': log_streams[name]} if name in log_streams else {'startFromHead': True}
+                    events = await limiter.call(logs_client.get_log_events, logGroupName=self.log_group,
+                        logStreamName=name, **kwargs)
+                    for event in events['events']:
+                        for line in event['message'].splitlines():
+                            self._print(job, line)
+                    # the forward token stays the same once the stream is read to its end
+                    done = events['nextForwardToken'] == log_streams.get(name)
+                    log_streams[name] = events['nextForwardToken']
+                    if done or not events['events']:
+                        break
+        except ClientError as e:
+            # the log group and streams appear once the instance writes its first output
+            if e.response['Error']['Code'] != 'ResourceNotFoundException':
+                raise e
+
+def print_summary(results, output=sys.stdout):
+    print(f'{"job":<40} {"operation":<10} {"region":<14} {"instance":<20} {"status":<18} {"seconds":>8}  command id',
+          file=output)
+    for result in results:
+        print(f'{result["label"]:<40} {result["operation"]:<10} {result["region"]:<14} {result["instance"]:<20} '
+              f'{result["status"]:<18} {result["seconds"]:>8.0f}  {result["command_id"] or "-"}', file=output)
+    failed = sum(result['status'] != 'Success' for result in results)
+    print(f'{len(results) - failed} of {len(results)} commands succeeded', file=output)
+
+def get_exit_code(results):
+    # the caller, e.g. a scheduler, sees a failure if any one command did not succeed
+    return 0 if all(result['status'] == 'Success' for result in results) else 1
+
+def get_jobs(args):
+    # fleet file jobs take any field they leave out from the command line
+    defaults = {field: getattr(args, field) for field in JOB_FIELDS + ['database', 'timestamp', 'extra_args', 'profile']}
+    if not args.fleet:
+        return [defaults]
+    with open(args.fleet) as f:
+        return [{**defaults, **job} for job in json.load(f)]
+
+def run_fleet(jobs, args, clients=None):
+    fleet = Fleet(clients or ClientFactory(), args.max_per_region, args.api_rate, args.log_group)
+    return asyncio.run(fleet.run(jobs))
 
 if __name__ == '__main__':
 
-    # python execute-ssm.py 
+    # python execute-ssm.py -c clu02 -d db3 -o backup -r us-east-1 -b backup-aurora-prod-us-east-1 -s /aurora/clu02/postgres -e clu02.cluster-ro-crywpxf9avmu.us-east-1.rds.amazonaws.com -i i-0123456789abcdef0
+    # python execute-ssm.py --fleet tmp/fleet.json -o backup --max-per-region 8
     # input parsing
     parser = argparse.ArgumentParser(description='aurora ssm prepprogram')
-    parser.add_argument('-d', '--database', help='database name', required=True)
-    parser.add_argument('-o', '--operation', help='operation type', required=True, choices=['backup', 'restore'])
-    parser.add_argument('-b', '--bucket', help='service check', required=True)
-    parser.add_argument('-s', '--secret', help='secret', required=True)
-    parser.add_argument('-c', '--cluster', help='cluster name', required=True)
-    parser.add_argument('-e', '--endpoint', help='instance endpoint', required=True)
-    parser.add_argument('-r', '--region', help='aws region for db', required=True, default='us-east-1')
+    parser.add_argument('-d', '--database', help='database name, every database of the cluster if unset', required=False)
+    parser.add_argument('-o', '--operation', help='operation type', required=False, choices=['backup', 'restore'])
+    parser.add_argument('-b', '--bucket', help='service check', required=False)
+    parser.add_argument('-s', '--secret', help='secret', required=False)
+    parser.add_argument('-c', '--cluster', help='cluster name', required=False)
+    parser.add_argument('-e', '--endpoint', help='instance endpoint', required=False)
+    parser.add_argument('-r', '--region', help='aws region for db', required=False, default='us-east-1')
     parser.add_argument('-t', '--timestamp', help='backup timestamp to restore', required=False, default='notime')
-    parser.add_argument('-i', '--instance', help='ec2 instance id', required=True)
+    parser.add_argument('-i', '--instance', help='ec2 instance id', required=False)
+    parser.add_argument('-a', '--extra-args', help='additional aurora-operation.py options', required=False, default='')
+    parser.add_argument('--profile', help='aws profile, the account a job runs in', required=False)
+    parser.add_argument('--fleet', help='json list of jobs, each with the fields of the options above', required=False)
+    parser.add_argument('--max-per-region', help='commands running at once per account and region', type=int, default=4)
+    parser.add_argument('--api-rate', help='ssm and logs api calls per second per account and region', type=float,
+                        default=5)
+    parser.add_argument('--log-group', help='cloudwatch log group the command output is streamed from',
+                        default='/aws/ssm/aurora-backup')
     args = parser.parse_args()
 
-    # get ssm command id output
-    command_id = ssm_send_command(args)
+    jobs = get_jobs(args)
+    for job in jobs:
+        missing = [field for field in JOB_FIELDS if not job.get(field)]
+        if missing:
+            parser.error(f'job {json.dumps(job)} is missing {", ".join(missing)}')
+
+    results = run_fleet(jobs, args)
+    print_summary(results)
+    sys.exit(get_exit_code(results))
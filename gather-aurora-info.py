@@ -1,21 +1,79 @@
-#!/usr/bin/env python 
+#!/usr/bin/env python
 
 import argparse
 import boto3
+import datetime
 import json
 import os
+import re
+import time
 
-def get_instance_info(client, db_id):
-    response = client.describe_db_instances(
-        DBInstanceIdentifier=db_id,
-    )
+# cloudwatch metrics each reader is ranked by, averaged over --metrics-minutes
+READER_METRICS = {'lag': 'AuroraReplicaLag', 'cpu': 'CPUUtilization', 'connections': 'DatabaseConnections'}
+# cpu within the same step counts as equally busy, so connections and class decide between them
+CPU_STEP = 10
+
+def get_cluster_instances(client, cluster):
+    # every member in one paginated call rather than one call per instance
+    instances = {}
+    paginator = client.get_paginator('describe_db_instances')
+    for page in paginator.paginate(Filters=[{'Name': 'db-cluster-id', 'Values': [cluster]}]):
+        for instance in page['DBInstances']:
+            instances[instance['DBInstanceIdentifier']] = instance
+    return instances
+
+def get_instance_metrics(cloudwatch, db_ids, minutes):
+    # one get_metric_data call for all readers and metrics, missing datapoints stay unset
+    queries = [{
+        'Id': f'm{index}_{name}',
+        'MetricStat': {
+            'Metric': {'Namespace': 'AWS/RDS', 'MetricName': metric,
+                       'Dimensions': [{'Name': 'DBInstanceIdentifier', 'Value': db_id}]},
+            'Period': 60, 'Stat': 'Average'},
+        } for index, db_id in enumerate(db_ids) for name, metric in READER_METRICS.items()]
+    metrics = {db_id: {} for db_id in db_ids}
+    if not queries:
+        return metrics
+    end = datetime.datetime.utcnow()
+    paginator = cloudwatch.get_paginator('get_metric_data')
+    for page in paginator.paginate(MetricDataQueries=queries, StartTime=end - datetime.timedelta(minutes=minutes),
+                                   EndTime=end):
+        for result in page['MetricDataResults']:
+            index, name = result['Id'][1:].split('_', 1)
+            if result['Values']:
+                metrics[db_ids[int(index)]][name] = sum(result['Values']) / len(result['Values'])
+    return metrics
+
+def get_class_size(instance_class):
+    # relative size of an instance class, e.g. db.r6g.large 2, db.r6g.xlarge 4, db.r6g.4xlarge 16
+    match = re.search(r'\.(\d*)xlarge$', instance_class)
+    if match:
+        return 4 * int(match.group(1) or 1)
+    return 2 if instance_class.endswith('.large') else 1
 
-    az = response['DBInstances'][0]['AvailabilityZone']
-    subnets = response['DBInstances'][0]['DBSubnetGroup']['Subnets']
-    for subnet in subnets:
-        if az in str(subnet):
-            subnet_id = subnet['SubnetIdentifier']
-    return az, subnet_id
+def choose_reader(readers, metrics, max_lag):
+    # lag beyond max_lag rules a reader out, then the least busy and largest wins
+    def get_rank(instance):
+        values = metrics.get(instance['DBInstanceIdentifier'], {})
+        return (values.get('cpu', 0) // CPU_STEP, values.get('connections', 0), -get_class_size(instance['DBInstanceClass']))
+    candidates = [instance for instance in readers
+        if metrics.get(instance['DBInstanceIdentifier'], {}).get('lag', 0) <= max_lag]
+    if not candidates:
+        print(f'No reader within {max_lag}ms of replica lag, choosing among all readers')
+        candidates = readers
+    for instance in sorted(candidates, key=get_rank):
+        values = metrics.get(instance['DBInstanceIdentifier'], {})
+        print(f'Reader {instance["DBInstanceIdentifier"]} ({instance["DBInstanceClass"]}): ' + ', '.join(
+            f'{name} {values[name]:.0f}{unit}' if name in values else f'{name} n/a'
+            for name, unit in [('lag', 'ms'), ('cpu', '%'), ('connections', '')]))
+    return min(candidates, key=get_rank)
+
+def get_subnet_id(instance):
+    az = instance['AvailabilityZone']
+    for subnet in instance['DBSubnetGroup']['Subnets']:
+        if subnet['SubnetAvailabilityZone']['Name'] == az:
+            return subnet['SubnetIdentifier']
+    raise Exception(f'No subnet in az {az} in the subnet group of {instance["DBInstanceIdentifier"]}')
 
 def get_cluster_info(args):
     client = boto3.client('rds', region_name=args.region)
@@ -25,22 +83,48 @@ def get_cluster_info(args):
 
     port = response['DBClusters'][0]['Port']
     members = response['DBClusters'][0]['DBClusterMembers']
+    instances = get_cluster_instances(client, args.cluster)
+    # a cluster can be without a writer for a moment, e.g. during a failover
+    writer = next((instances[member['DBInstanceIdentifier']] for member in members if member['IsClusterWriter']), None)
+    readers = [instances[member['DBInstanceIdentifier']] for member in members
+        if not member['IsClusterWriter'] and instances[member['DBInstanceIdentifier']]['DBInstanceStatus'] == 'available']
 
-    if args.operation == 'backup':
-        endpoint = response['DBClusters'][0]['ReaderEndpoint']
-        for member in members:
-            if member['IsClusterWriter'] == False:
-                db_id = member['DBInstanceIdentifier']
-                az, subnet_id = get_instance_info(client, db_id)
-                print(f'Found reader endpoint of: {endpoint}, instance: {db_id}, in az: {az}')
+    if args.operation == 'backup' and readers:
+        # every pg_dump -j worker goes to the one reader chosen, not round robin over the reader endpoint
+        if args.metrics_file:
+            with open(args.metrics_file) as json_file:
+                metrics = json.load(json_file)
+        else:
+            cloudwatch = boto3.client('cloudwatch', region_name=args.region)
+            metrics = get_instance_metrics(cloudwatch, [reader['DBInstanceIdentifier'] for reader in readers],
+                args.metrics_minutes)
+        instance = choose_reader(readers, metrics, args.max_replica_lag)
+        endpoint = instance['Endpoint']['Address']
+        print(f'Found reader endpoint of: {endpoint}, instance: {instance["DBInstanceIdentifier"]}, in az: {instance["AvailabilityZone"]}')
+    elif writer is None:
+        raise Exception(f'No writer in {args.cluster} for the {args.operation}, it may be failing over; rerun once it has a writer')
+    elif args.operation == 'backup':
+        instance = writer
+        endpoint = instance['Endpoint']['Address']
+        print(f'No available reader in {args.cluster}, backing up from writer: {endpoint}, in az: {instance["AvailabilityZone"]}')
     else:
+        instance = writer
         endpoint = response['DBClusters'][0]['Endpoint']
-        for member in members:
-            if member['IsClusterWriter'] == True:
-                db_id = member['DBInstanceIdentifier']
-                az, subnet_id = get_instance_info(client, db_id)
-                print(f'Found writer endpoint of: {endpoint}, instance: {db_id}, in az: {az}')
-    return endpoint, az, subnet_id
+        print(f'Found writer endpoint of: {endpoint}, instance: {instance["DBInstanceIdentifier"]}, in az: {instance["AvailabilityZone"]}')
+    return {'az': instance['AvailabilityZone'], 'endpoint': endpoint, 'subnet_id': get_subnet_id(instance),
+            'instance': instance['DBInstanceIdentifier'], 'port': port}
+
+def read_cached_info(args):
+    # a repeated run within the ttl reuses the topology of the same cluster, operation and region
+    if args.refresh or not os.path.exists(args.output):
+        return None
+    with open(args.output) as json_file:
+        db_dict = json.load(json_file)
+    cached = db_dict.get('cache', {})
+    if cached.get('key') != [args.cluster, args.operation, args.region] or time.time() - cached.get('time', 0) > args.ttl:
+        return None
+    print(f'Using topology of {args.cluster} cached in {args.output}: {db_dict["endpoint"]}')
+    return db_dict
 
 
 if __name__ == '__main__':
@@ -52,13 +136,23 @@ if __name__ == '__main__':
     parser.add_argument('-c', '--cluster', help='cluster name', required=True)
     parser.add_argument('-o', '--operation', help='operation type', required=True, choices=['backup', 'restore'])
     parser.add_argument('-r', '--region', help='aws region for db', required=True, default='us-east-1')
+    parser.add_argument('--max-replica-lag', help='ms of replica lag above which a reader is not chosen', type=float,
+                        default=1000)
+    parser.add_argument('--metrics-minutes', help='minutes of cloudwatch metrics readers are ranked by', type=int,
+                        default=15)
+    parser.add_argument('--metrics-file', help='json of lag, cpu and connections per reader instance, used instead of cloudwatch',
+                        required=False)
+    parser.add_argument('--ttl', help='seconds the cached topology is reused', type=int, default=900)
+    parser.add_argument('--refresh', help='ignore the cached topology', action='store_true')
+    parser.add_argument('--output', help='topology json for the backup terraform step', default='tmp/db.json')
     args = parser.parse_args()
 
-    # get reader or writer endpoint based upon operation being backup or restore
-    endpoint, az, subnet_id = get_cluster_info(args)
-    
-    # wrote json output to be consumed by backup terrraform step 
-    db_dict = {'az': az, 'endpoint': endpoint, 'subnet_id': subnet_id}
-    
-    with open('tmp/db.json', 'w') as json_file:
-        json.dump(db_dict, json_file)
\ No newline at end of file
+    # get reader instance or writer endpoint based upon operation being backup or restore
+    db_dict = read_cached_info(args)
+    if db_dict is None:
+        db_dict = get_cluster_info(args)
+        db_dict['cache'] = {'key': [args.cluster, args.operation, args.region], 'time': time.time()}
+
+        # wrote json output to be consumed by backup terrraform step
+        with open(args.output, 'w') as json_file:
+            json.dump(db_dict, json_file)
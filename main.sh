@@ -3,12 +3,15 @@
 
 __parse_args() {
     # parsing input arguments
-    while getopts ":h:c:d:o:r:b:s:t:" opt; do
+    while getopts ":h:c:d:o:r:b:s:t:a:p:" opt; do
         case ${opt} in
             h)
             echo "Example usage:"
             echo "  main.sh -c <cluster> -d <database> -o backup -r <region> -b <bucket>"
             echo "  main.sh -c <cluster> -d <database> -o restore -r <region> -b <bucket> -s <secret> -t <timestamp>"
+            echo "  main.sh -c <cluster> -d <database> -o backup -r <region> -b <bucket> -a '--pipeline'"
+            echo "  main.sh -c <cluster> -d <database> -o backup -r <region> -b <bucket> -p tmp/plan.json"
+            echo "  main.sh -c <cluster> -o backup -r <region> -b <bucket> -a '--exclude-database test_*'"
             exit 0
             ;;
             c) cluster=${OPTARG};;
@@ -18,6 +21,8 @@ __parse_args() {
             b) bucket=${OPTARG};;
             s) secret=${OPTARG};;
             t) timestamp=${OPTARG};; # e.g. 20220314T024658Z
+            a) extra_args=${OPTARG};; # additional aurora-operation.py options e.g. '--pipeline'
+            p) plan_file=${OPTARG};; # run plan from aurora-operation.py -o plan, sizes the ec2 instance
             \?)
             echo "Invalid Option: -$OPTARG" 1>&2
             exit 1
@@ -40,7 +45,7 @@ __deploy_terraform() {
         exit 1
     else
         echo "Terraform plan starting from ${1}"
-        terraform -chdir=${1} plan -var-file=${region}.tfvars -lock="false"; planreturn=$?
+        terraform -chdir=${1} plan -var-file=${region}.tfvars ${2} -lock="false"; planreturn=$?
         echo "Terraform plan exit status: $planreturn"
     fi
 
@@ -50,7 +55,7 @@ __deploy_terraform() {
         exit 1
     else
         echo "Terraform apply starting from ${1}"
-        terraform -chdir=${1} apply -var-file=${region}.tfvars -lock="false" -auto-approve >&1 | ( grep "Apply complete" ); applyreturn=$?
+        terraform -chdir=${1} apply -var-file=${region}.tfvars ${2} -lock="false" -auto-approve >&1 | ( grep "Apply complete" ); applyreturn=$?
         echo "Terraform plan exit status: $applyreturn"
     fi
 
@@ -63,7 +68,7 @@ __deploy_terraform() {
 
 __destroy_terraform() {
     echo "Terraform destroy starting from ${1}"
-    terraform -chdir=${1} destroy -var-file=${region}.tfvars -auto-approve; $destroyreturn=$?
+    terraform -chdir=${1} destroy -var-file=${region}.tfvars ${2} -auto-approve; $destroyreturn=$?
 
     if [ $destroyreturn -ne 0 ]
     then
@@ -77,6 +82,14 @@ __output_regional_variables() {
     terraform -chdir=${1} output -json > tmp/terraform-output.json
 }
 
+__plan_terraform_vars() {
+    # ec2 type and volume size recommended by a run plan, if one was given
+    if [ -n "${plan_file}" ]
+    then
+        echo "-var ec2_type=$(jq -r '.ec2.type' ${plan_file}) -var ec2_volume_size=$(jq -r '.ec2.volume_size_gb' ${plan_file})"
+    fi
+}
+
 __sync_ec2_scripts() {
     echo "Syncing scripts to bucket ${1}"
     aws s3 sync ec2-scripts/ s3://${bucket}/ec2-scripts
@@ -88,8 +101,12 @@ __sync_ec2_scripts() {
 # parse arguments
 __parse_args "$@"
 
-# gather aurora info
-python gather-aurora-info.py -c ${cluster} -o ${operation} -r ${region} 
+# gather aurora info, stopping rather than using a tmp/db.json left by an earlier run
+if ! python gather-aurora-info.py -c ${cluster} -o ${operation} -r ${region}
+then
+    echo "Gathering aurora info of ${cluster} exited with error" >&2
+    exit 1
+fi
 
 # apply regional terraform
 __deploy_terraform "terraform-common"
@@ -98,7 +115,8 @@ __deploy_terraform "terraform-common"
 __output_regional_variables "terraform-common" 
 
 # deploy ec2 backup terraform step
-__deploy_terraform "terraform-backup"
+backup_vars=$(__plan_terraform_vars)
+__deploy_terraform "terraform-backup" "${backup_vars}"
 
 # get ec2 id from backup terraform step
 ec2_instance_id=$(terraform -chdir=terraform-backup output -raw ec2_instance_id)
@@ -108,7 +126,7 @@ __sync_ec2_scripts ${bucket}
 
 # Sending SSM command to instance and waiting for completion
 endpoint=$(cat tmp/db.json | jq '.endpoint')
-python3 execute-ssm.py -c $cluster -d $database -o $operation -r $region -b $bucket -s $secret -e $endpoint -i $ec2_instance_id
+python3 execute-ssm.py -c $cluster ${database:+-d $database} -o $operation -r $region -b $bucket -s $secret -e $endpoint -i $ec2_instance_id -a="${extra_args}"
 
 # destroy backup terraform
-__destroy_terraform "terraform-backup"
\ No newline at end of file
+__destroy_terraform "terraform-backup" "${backup_vars}"
\ No newline at end of file
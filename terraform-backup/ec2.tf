@@ -60,7 +60,7 @@ module "ec2_instance" {
       encrypted   = true
       volume_type = "gp3"
       throughput  = 800
-      volume_size = 1024
+      volume_size = var.ec2_volume_size
       iops        = 6000
       tags = local.common_tags
     },
@@ -29,3 +29,8 @@ variable "ec2_type" {
   type        = string
 }
 
+variable "ec2_volume_size" {
+  description = "Root volume size in GB, holds the staged dump"
+  type        = number
+  default     = 1024
+}
@@ -26,6 +26,17 @@ resource "aws_s3_bucket" "backup_bucket" {
 
     tags  = local.common_tags
   }
+
+  # incremental blobs get no age based expiry, a kept manifest can reference a blob of any age;
+  # aurora-operation.py -o prune deletes the ones no manifest references
+
+  # failed runs leave their multipart uploads open for --resume, this removes the ones never resumed
+  lifecycle_rule {
+    id      = "abort-incomplete-multipart"
+    enabled = true
+
+    abort_incomplete_multipart_upload_days = var.s3_days_until_multipart_abort
+  }
   tags  = local.common_tags
 }
 
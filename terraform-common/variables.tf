@@ -44,6 +44,11 @@ variable "s3_days_until_expiry" {
   description = "days until deletion"
   type        = number
 }
+variable "s3_days_until_multipart_abort" {
+  description = "days until an incomplete multipart upload left for --resume is aborted"
+  type        = number
+  default     = 7
+}
 variable "s3_kms_key" {
   description = "kms encryption key"
   type        = string
@@ -0,0 +1,262 @@
+# purpose: unit tests for ec2-scripts/aurora-operation.py that need neither PostgreSQL nor S3
+# python -m unittest discover -s tests
+
+import argparse
+import concurrent.futures
+import importlib.util
+import io
+import os
+import pathlib
+import shutil
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+def load_aurora_operation():
+    # aurora-operation.py is a script rather than a module, so load it by path
+    script_path = pathlib.Path(__file__).resolve().parent.parent / 'ec2-scripts' / 'aurora-operation.py'
+    spec = importlib.util.spec_from_file_location('aurora_operation', script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+aurora_operation = load_aurora_operation()
+
+def get_done_future(result=None):
+    future = concurrent.futures.Future()
+    future.set_result(result)
+    return future
+
+def get_toc_entry(dump_id, entry_type, section, name):
+    return {'dump_id': dump_id, 'type': entry_type, 'section': section, 'schema': 'public', 'name': name,
+            'line': f'{dump_id}; 0 0 {entry_type} public {name} postgres'}
+
+class CompressFileTest(unittest.TestCase):
+
+    codec = {'codec': 'zstd', 'level': 1, 'method': 'stream'}
+
+    def setUp(self):
+        # where copy_to_s3 looks for the staged files of a backup
+        self.current_time = f'{os.getpid()}T000000Z'
+        self.staging_path = f'/tmp/test-db1-{self.current_time}'
+        os.makedirs(self.staging_path)
+        self.addCleanup(shutil.rmtree, self.staging_path, ignore_errors=True)
+        self.full_path = os.path.join(self.staging_path, '3345.dat')
+        with open(self.full_path, 'wb') as f:
+            f.write(b'1\tone\n')
+
+    def test_compressed_file_appears_when_complete(self):
+        with mock.patch.object(aurora_operation, 'get_codec_command', return_value=['cat']):
+            compressed_path = aurora_operation.compress_file(self.full_path, self.codec)
+        self.assertEqual(os.listdir(self.staging_path), ['3345.dat.zst'])
+        self.assertEqual(compressed_path, self.full_path + '.zst')
+
+    def test_interrupted_compression_leaves_no_staged_file(self):
+        with mock.patch.object(aurora_operation, 'get_codec_command', return_value=['false']):
+            with self.assertRaises(subprocess.CalledProcessError):
+                aurora_operation.compress_file(self.full_path, self.codec)
+        self.assertEqual(sorted(os.listdir(self.staging_path)), ['3345.dat', '3345.dat.zst.partial'])
+
+    def test_resumed_upload_skips_partial_files(self):
+        args = argparse.Namespace(cluster='test', database='db1', bucket='bucket')
+        pathlib.Path(self.full_path + '.zst.partial').write_bytes(b'truncated')
+        with mock.patch.object(aurora_operation, 'upload_backup_file') as upload_backup_file, \
+                mock.patch.object(aurora_operation, 'wait_for_transfers', return_value=[]), \
+                mock.patch.object(aurora_operation, 'upload_backup_index'):
+            aurora_operation.copy_to_s3(mock.Mock(), 'manual', self.current_time, args)
+        self.assertEqual([call[0][1] for call in upload_backup_file.call_args_list], [self.full_path])
+
+class JournalTimestampTest(unittest.TestCase):
+
+    def test_journals_of_other_databases_are_ignored(self):
+        journal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, journal_dir, ignore_errors=True)
+        for name in ['clu-db-20240101T000000Z-backup.journal', 'clu-db-20240102T000000Z-restore.journal',
+                     'clu-db-archive-20240103T000000Z-backup.journal', 'clu-db-20240104T000000Z-backup.journal.tmp']:
+            pathlib.Path(journal_dir, name).touch()
+        self.assertEqual(aurora_operation.get_latest_journal_timestamp('clu', 'db', 'backup', journal_dir),
+            '20240101T000000Z')
+        self.assertIsNone(aurora_operation.get_latest_journal_timestamp('clu', 'other', 'backup', journal_dir))
+
+class UploadProbeTest(unittest.TestCase):
+
+    def test_probe_is_streamed_from_memory(self):
+        args = argparse.Namespace(cluster='test', database='db1', bucket='bucket')
+        engine = mock.MagicMock()
+        stream = engine.open_upload_stream.return_value.__enter__.return_value
+        with mock.patch('builtins.open') as open_file:
+            self.assertGreater(aurora_operation.measure_upload_throughput(engine, 'manual/test', args), 0)
+        open_file.assert_not_called()
+        engine.open_upload_stream.assert_called_once_with('bucket', 'manual/test/probe')
+        self.assertEqual(sum(len(call[0][0]) for call in stream.write.call_args_list),
+            aurora_operation.MULTIPART_THRESHOLD + aurora_operation.S3_MIN_PART_SIZE * 4)
+        engine.client.delete_object.assert_called_once_with(Bucket='bucket', Key='manual/test/probe')
+
+class TocReaderTest(unittest.TestCase):
+
+    def get_reader(self, data):
+        reader = aurora_operation.TocReader(io.BytesIO(data))
+        reader.int_size = 4
+        return reader
+
+    def test_read_str_of_non_utf8_database(self):
+        # e.g. a LATIN1 table name, written in the database encoding
+        name = 'café'.encode('latin-1')
+        reader = self.get_reader(b'\x00' + len(name).to_bytes(4, 'little') + name)
+        self.assertEqual(reader.read_str(), 'caf�')
+
+    def test_read_str_null(self):
+        self.assertIsNone(self.get_reader(b'\x01' + (1).to_bytes(4, 'little')).read_str())
+
+def get_index_entry(dump_id, entry_type, name, deps):
+    return {'dump_id': dump_id, 'type': entry_type, 'schema': 'public', 'name': name, 'deps': deps}
+
+class SelectTocEntriesTest(unittest.TestCase):
+
+    # as pg_dump 16 writes them: t has an identity column, u a serial one
+    index = {'entries': [
+        get_index_entry(216, 'TABLE', 't', []),
+        get_index_entry(215, 'SEQUENCE', 't_id_seq', [216]),
+        get_index_entry(218, 'TABLE', 'u', []),
+        get_index_entry(217, 'SEQUENCE', 'u_id_seq', []),
+        get_index_entry(2558, 'SEQUENCE OWNED BY', 'u_id_seq', [217]),
+        get_index_entry(2400, 'DEFAULT', 'u id', [217, 218]),
+        get_index_entry(2549, 'TABLE DATA', 't', [216]),
+        get_index_entry(2551, 'TABLE DATA', 'u', [218]),
+        get_index_entry(2559, 'SEQUENCE SET', 't_id_seq', [215]),
+        get_index_entry(2560, 'SEQUENCE SET', 'u_id_seq', [217]),
+        get_index_entry(2402, 'CONSTRAINT', 't t_pkey', [216]),
+    ]}
+
+    def select(self, tables):
+        return [entry['dump_id'] for entry in aurora_operation.select_toc_entries(self.index, tables, [])]
+
+    def test_identity_column_sequence(self):
+        self.assertEqual(self.select(['t']), [216, 215, 2549, 2559, 2402])
+
+    def test_serial_column_sequence(self):
+        self.assertEqual(self.select(['public.u']), [218, 217, 2558, 2400, 2551, 2560])
+
+class SelectiveRestoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.args = argparse.Namespace(cluster='test', database='db1', timestamp='20240101T000000Z',
+            table=['orders'], schema=None, jobs=2, bucket='bucket', endpoint='localhost')
+        self.args.report = aurora_operation.RunReport('test', 'db1', 'restore', self.args.timestamp)
+        self.engine = mock.Mock()
+        self.engine.download_file.return_value = get_done_future()
+        entries = [get_toc_entry(10, 'TABLE', 'pre-data', 'orders'),
+                   get_toc_entry(20, 'TABLE DATA', 'data', 'orders'),
+                   get_toc_entry(30, 'CONSTRAINT', 'post-data', 'orders orders_pkey')]
+        objects = {'toc.dat': {'Key': 'manual/toc.dat', 'Size': 10},
+                   '20.dat.gz': {'Key': 'manual/20.dat.gz', 'Size': 100}}
+        for name, value in [('get_backup_objects', objects), ('get_toc_index', {}), ('select_toc_entries', entries)]:
+            patcher = mock.patch.object(aurora_operation, name, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def restore(self):
+        return aurora_operation.perform_selective_restore(self.engine, 'manual', 'postgres', 'password', 5432,
+            '/usr/bin', {}, self.args)
+
+    def test_failed_pre_data_skips_data_and_post_data(self):
+        # e.g. a foreign key from a table that was not selected blocks the drop
+        with mock.patch.object(aurora_operation, 'run_pg_restore', return_value=1) as run_pg_restore, \
+                mock.patch.object(aurora_operation, 'restore_table_data') as restore_table_data:
+            self.assertIsNone(self.restore())
+        self.assertEqual(run_pg_restore.call_count, 1)
+        self.assertIn('--single-transaction', run_pg_restore.call_args[0][4])
+        restore_table_data.assert_not_called()
+        self.assertEqual([call[0][1] for call in self.engine.download_file.call_args_list], ['manual/toc.dat'])
+        self.assertTrue(self.args.report.failed)
+
+    def test_pre_data_success_loads_data_and_post_data(self):
+        with mock.patch.object(aurora_operation, 'run_pg_restore', return_value=0) as run_pg_restore, \
+                mock.patch.object(aurora_operation, 'restore_table_data') as restore_table_data:
+            self.assertTrue(self.restore())
+        self.assertEqual(restore_table_data.call_count, 1)
+        self.assertEqual(restore_table_data.call_args[0][4]['dump_id'], 20)
+        # pre-data, then post-data with -j; there are no remaining data entries
+        self.assertEqual(run_pg_restore.call_count, 2)
+        self.assertIn('-j 2', run_pg_restore.call_args_list[1][0][4])
+        self.assertFalse(self.args.report.failed)
+
+class DbRestoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.args = argparse.Namespace(cluster='test', database='db1', timestamp='20240101T000000Z', jobs=2,
+            endpoint='localhost', restore_profile='default', existing_db=False)
+        self.args.report = aurora_operation.RunReport('test', 'db1', 'restore', self.args.timestamp)
+        patcher = mock.patch.object(aurora_operation, 'read_manifest', return_value={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def restore(self, returncode=0):
+        with mock.patch.object(aurora_operation, 'run_pg_restore', return_value=returncode) as run_pg_restore:
+            aurora_operation.perform_db_restore('manual', 'postgres', 'password', 5432, '/usr/bin', self.args)
+        return [call[0][4] for call in run_pg_restore.call_args_list]
+
+    def test_new_database_is_created(self):
+        self.assertEqual(self.restore(), ['-C -d postgres -v -j 2'])
+        self.assertFalse(self.args.report.failed)
+
+    def test_existing_database_is_restored_in_place(self):
+        # CREATE DATABASE would fail on every refresh, so the existing database is loaded directly
+        self.args.existing_db = True
+        self.assertEqual(self.restore(), ['--clean --if-exists -d db1 -v -j 2'])
+        self.assertFalse(self.args.report.failed)
+
+    def test_fast_load_over_existing_database(self):
+        self.args.existing_db = True
+        self.args.restore_profile = 'fast-load'
+        with mock.patch.object(aurora_operation, 'is_superuser', return_value=False), \
+                mock.patch.object(aurora_operation, 'load_shards', return_value=[]), \
+                mock.patch.object(aurora_operation, 'restore_post_data', return_value=[]):
+            self.assertEqual(self.restore(), ['--clean --if-exists -d db1 -v --section=pre-data', '-v -a -j 2 -d db1'])
+        self.assertFalse(self.args.report.failed)
+
+    def test_failed_restore_is_reported(self):
+        self.restore(returncode=1)
+        self.assertTrue(self.args.report.failed)
+
+class PipelinedRestoreTest(unittest.TestCase):
+
+    def test_failed_pre_data_skips_data_and_post_data(self):
+        args = argparse.Namespace(cluster='test', database='db1', timestamp='20240101T000000Z', jobs=2,
+            bucket='bucket', endpoint='localhost', existing_db=True)
+        args.report = aurora_operation.RunReport('test', 'db1', 'restore', args.timestamp)
+        engine = mock.Mock()
+        engine.download_file.return_value = get_done_future()
+        objects = {'toc.dat': {'Key': 'manual/toc.dat', 'Size': 10},
+                   '20.dat.gz': {'Key': 'manual/20.dat.gz', 'Size': 100}}
+        with mock.patch.object(aurora_operation, 'get_backup_objects', return_value=objects), \
+                mock.patch.object(aurora_operation, 'read_manifest', return_value={}), \
+                mock.patch.object(aurora_operation, 'get_toc_entries') as get_toc_entries, \
+                mock.patch.object(aurora_operation, 'run_pg_restore', return_value=1) as run_pg_restore:
+            self.assertIsNone(aurora_operation.perform_pipelined_restore(engine, 'manual', 'postgres', 'password',
+                5432, '/usr/bin', args))
+        self.assertEqual([call[0][4] for call in run_pg_restore.call_args_list],
+            ['--clean --if-exists -d db1 -v --section=pre-data'])
+        get_toc_entries.assert_not_called()
+        self.assertEqual([call[0][1] for call in engine.download_file.call_args_list], ['manual/toc.dat'])
+        self.assertTrue(args.report.failed)
+
+class StreamingRestoreTest(unittest.TestCase):
+
+    def test_failed_pre_data_skips_streams(self):
+        args = argparse.Namespace(cluster='test', database='db1', timestamp='20240101T000000Z', jobs=2,
+            bucket='bucket', endpoint='localhost', existing_db=True)
+        args.report = aurora_operation.RunReport('test', 'db1', 'restore', args.timestamp)
+        manifest = {'stream': {'dump': 'database.dump'}}
+        with mock.patch.object(aurora_operation, 'restore_stream_section', return_value=1) as restore_stream_section, \
+                mock.patch.object(aurora_operation, 'load_shard_object') as load_shard_object:
+            self.assertIsNone(aurora_operation.perform_streaming_restore(mock.Mock(), 'manual', 'postgres', 'password',
+                5432, '/usr/bin', manifest, args))
+        self.assertEqual([call[0][5] for call in restore_stream_section.call_args_list],
+            ['--clean --if-exists -d db1 -v --section=pre-data'])
+        load_shard_object.assert_not_called()
+        self.assertTrue(args.report.failed)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+# purpose: unit tests for execute-ssm.py against fake SSM and CloudWatch Logs clients
+# python -m unittest discover -s tests
+
+import asyncio
+import importlib.util
+import io
+import pathlib
+import threading
+import unittest
+from unittest import mock
+from botocore.exceptions import ClientError
+
+def load_execute_ssm():
+    # execute-ssm.py is a script rather than a module, so load it by path
+    script_path = pathlib.Path(__file__).resolve().parent.parent / 'execute-ssm.py'
+    spec = importlib.util.spec_from_file_location('execute_ssm', script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+execute_ssm = load_execute_ssm()
+
+def get_client_error(code, operation):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+class FakeSsmClient:
+    """Commands that finish after a few polls, with the most running at once in each region recorded."""
+
+    def __init__(self, region, account, polls=3, failing=(), throttled=()):
+        self.region = region
+        self.account = account
+        self.polls = polls
+        self.failing = set(failing)
+        self.throttled = set(throttled)
+        self.commands = {}
+        self.send_calls = 0
+
+    def send_command(self, InstanceIds, **kwargs):
+        with self.account.lock:
+            self.send_calls += 1
+            instance = InstanceIds[0]
+            if instance in self.throttled:
+                self.throttled.remove(instance)
+                raise get_client_error('ThrottlingException', 'SendCommand')
+            command_id = f'{self.region}-{instance}'
+            self.commands[command_id] = 0
+            running = self.account.running.get(self.region, 0) + 1
+            self.account.running[self.region] = running
+            self.account.max_running[self.region] = max(self.account.max_running.get(self.region, 0), running)
+        return {'Command': {'CommandId': command_id}}
+
+    def get_command_invocation(self, CommandId, InstanceId):
+        with self.account.lock:
+            self.commands[CommandId] += 1
+            if self.commands[CommandId] < self.polls:
+                return {'Status': 'InProgress'}
+            if self.commands[CommandId] == self.polls:
+                self.account.running[self.region] -= 1
+            return {'Status': 'Failed' if InstanceId in self.failing else 'Success'}
+
+class FakeLogsClient:
+    """Streams that gain a line on every read, paged by forward tokens like get_log_events."""
+
+    def __init__(self):
+        self.streams = {}
+        self.lock = threading.Lock()
+
+    def describe_log_streams(self, logGroupName, logStreamNamePrefix):
+        with self.lock:
+            stream = self.streams.setdefault(f'{logStreamNamePrefix}aws-runShellScript/stdout', [])
+            stream.append(f'line {len(stream)}')
+            return {'logStreams': [{'logStreamName': name} for name in self.streams if name.startswith(logStreamNamePrefix)]}
+
+    def get_log_events(self, logGroupName, logStreamName, startFromHead=False, nextToken=None):
+        with self.lock:
+            stream = self.streams[logStreamName]
+            start = int(nextToken.split('/')[1]) if nextToken else 0
+            # one event per page, so a stream takes several calls to read to its end
+            events = [{'message': message} for message in stream[start:start + 1]]
+            return {'events': events, 'nextForwardToken': f'f/{start + len(events)}'}
+
+class FakeAccount:
+
+    def __init__(self, **kwargs):
+        self.lock = threading.Lock()
+        self.running = {}
+        self.max_running = {}
+        self.kwargs = kwargs
+        self.clients = {}
+
+    def get(self, service, region, profile=None):
+        key = (service, region, profile)
+        if key not in self.clients:
+            self.clients[key] = FakeSsmClient(region, self, **self.kwargs) if service == 'ssm' else FakeLogsClient()
+        return self.clients[key]
+
+def get_job(region, instance):
+    return {'cluster': f'clu-{instance}', 'database': 'db1', 'operation': 'backup', 'bucket': 'bucket',
+            'secret': 'secret', 'endpoint': 'endpoint', 'region': region, 'instance': instance}
+
+class FleetTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(execute_ssm, 'get_backoff_delay', return_value=0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_fleet(self, jobs, account):
+        output = io.StringIO()
+        fleet = execute_ssm.Fleet(account, max_per_region=2, api_rate=1000, log_group='/aws/ssm/test', output=output)
+        return asyncio.run(fleet.run(jobs)), output.getvalue()
+
+    def test_concurrency_is_bounded_per_region(self):
+        account = FakeAccount()
+        jobs = [get_job(region, f'i-{region}-{index}') for region in ['us-east-1', 'eu-west-1'] for index in range(5)]
+        results, _ = self.run_fleet(jobs, account)
+        self.assertEqual(account.max_running, {'us-east-1': 2, 'eu-west-1': 2})
+        self.assertEqual([result['status'] for result in results], ['Success'] * 10)
+        self.assertEqual(execute_ssm.get_exit_code(results), 0)
+
+    def test_throttled_send_command_is_retried(self):
+        account = FakeAccount(throttled=['i-1'])
+        results, _ = self.run_fleet([get_job('us-east-1', 'i-1')], account)
+        self.assertEqual(account.get('ssm', 'us-east-1').send_calls, 2)
+        self.assertEqual(results[0]['status'], 'Success')
+        self.assertEqual(results[0]['command_id'], 'us-east-1-i-1')
+
+    def test_output_lines_are_printed_once(self):
+        results, output = self.run_fleet([get_job('us-east-1', 'i-1')], FakeAccount())
+        lines = [line for line in output.splitlines() if line.startswith('[clu-i-1/db1] line ')]
+        # one line is added per poll, and each is printed exactly once in order
+        self.assertEqual(lines, [f'[clu-i-1/db1] line {index}' for index in range(3)])
+
+    def test_failed_command_fails_the_summary(self):
+        jobs = [get_job('us-east-1', 'i-1'), get_job('us-east-1', 'i-2')]
+        results, _ = self.run_fleet(jobs, FakeAccount(failing=['i-2']))
+        self.assertEqual([result['status'] for result in results], ['Success', 'Failed'])
+        summary = io.StringIO()
+        execute_ssm.print_summary(results, summary)
+        self.assertIn('1 of 2 commands succeeded', summary.getvalue())
+        self.assertEqual(execute_ssm.get_exit_code(results), 1)
+
+if __name__ == '__main__':
+    unittest.main()